@@ -1,21 +1,24 @@
 import logging
 import os
-import threading
+import secrets
 import asyncio
 from dotenv import load_dotenv
 
-from yookassa import Configuration
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode 
 
 from shop_bot.bot import handlers
 from shop_bot.bot import admin_handlers
-from shop_bot.webhook_server.app import create_webhook_app
+from shop_bot.bot.middlewares import callback_debounce
+from shop_bot.webhook_server.app import create_webhook_app, register_telegram_webhook, start_webhook_server
 from shop_bot.data_manager.scheduler import start_subscription_monitor
 from shop_bot.utils.logger import bot_logger
 from shop_bot.config import PLANS
-from shop_bot.data_manager import database
+from shop_bot.data_manager import database, fulfilment, payment_reconciler
+from shop_bot.data_manager.fsm_storage import SQLiteStorage
+from shop_bot.modules import heleket_api, yookassa_api
+from shop_bot.utils import http
 
 def main():
     load_dotenv()
@@ -23,7 +26,6 @@ def main():
     # Отключаем стандартные логи для чистоты
     logging.getLogger('aiogram').setLevel(logging.WARNING)
     logging.getLogger('aiohttp').setLevel(logging.WARNING)
-    logging.getLogger('werkzeug').setLevel(logging.WARNING)
     
     bot_logger.startup("Initializing Remna Shop Bot...")
 
@@ -61,13 +63,13 @@ def main():
         bot_logger.system("PAYMENTS", "Telegram Stars payment disabled", "WARNING")
 
     if payment_methods["yookassa"]:
-        Configuration.account_id = yookassa_shop_id
-        Configuration.secret_key = yookassa_secret_key
+        yookassa_api.configure(yookassa_shop_id, yookassa_secret_key)
         bot_logger.system("PAYMENTS", "YooKassa payment enabled", "OK")
     else:
         bot_logger.system("PAYMENTS", "YooKassa payment disabled (credentials missing)", "WARNING")
 
     if payment_methods["crypto"]:
+        heleket_api.configure(crypto_merchant_id, crypto_api_key)
         bot_logger.system("PAYMENTS", "Crypto payment enabled", "OK")
     else:
         bot_logger.system("PAYMENTS", "Crypto payment disabled (API key missing)", "WARNING")
@@ -90,28 +92,55 @@ def main():
     handlers.ADMIN_TELEGRAM_ID = ADMIN_TELEGRAM_ID
     
     bot = Bot(token=TELEGRAM_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+    # Состояния FSM в SQLite: незавершённые диалоги переживают перезапуск, брошенные истекают
+    fsm_storage = SQLiteStorage(state_ttls={handlers.PromoInput.waiting_for_code: 3600})
+    dp = Dispatcher(storage=fsm_storage)
+    # Повторные нажатия тяжёлых кнопок гасятся до FSM, фильтров и обработчиков
+    dp.callback_query.outer_middleware(callback_debounce)
     dp.include_router(admin_handlers.admin_router)
     dp.include_router(handlers.user_router)
 
-    flask_app = create_webhook_app(bot, handlers.process_successful_payment)
+    webhook_app = create_webhook_app(bot, fulfilment.enqueue)
+
+    # Режим вебхука Telegram (по умолчанию — polling): обновления приходят на тот же порт 1488
+    telegram_webhook_url = (os.getenv("TELEGRAM_WEBHOOK_URL") or "").rstrip("/")
+    telegram_webhook_path = os.getenv("TELEGRAM_WEBHOOK_PATH", "/telegram-webhook")
+    telegram_webhook_secret = os.getenv("TELEGRAM_WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+    if telegram_webhook_url:
+        register_telegram_webhook(webhook_app, dp, bot, telegram_webhook_path, telegram_webhook_secret)
 
     async def start_all():
-        loop = asyncio.get_running_loop()
-        flask_app.config['EVENT_LOOP'] = loop
+        webhook_runner = await start_webhook_server(webhook_app, port=1488)
+        bot_logger.system("WEBHOOK", "Webhook server started on port 1488", "OK")
 
-        flask_thread = threading.Thread(
-            target=lambda: flask_app.run(host='0.0.0.0', port=1488, use_reloader=False),
-            daemon=True
-        )
-        flask_thread.start()
-        bot_logger.system("WEBHOOK", "Flask server started on port 1488", "OK")
+        fsm_storage.start_sweeper()
+        fulfilment.start(bot, handlers.process_successful_payment)
+        bot_logger.system("PAYMENTS", f"Fulfilment queue started ({fulfilment.WORKERS} workers)", "OK")
+        if payment_methods["yookassa"] or payment_methods["crypto"]:
+            asyncio.create_task(payment_reconciler.start_payment_reconciler())
 
         if database.get_all_vpn_users():
             asyncio.create_task(start_subscription_monitor(bot))
 
-        bot_logger.system("TELEGRAM", "Bot polling started", "OK")
-        await dp.start_polling(bot)
+        try:
+            if telegram_webhook_url:
+                await bot.set_webhook(
+                    f"{telegram_webhook_url}{telegram_webhook_path}",
+                    secret_token=telegram_webhook_secret,
+                    allowed_updates=dp.resolve_used_update_types()
+                )
+                bot_logger.system("TELEGRAM", f"Webhook mode: {telegram_webhook_url}{telegram_webhook_path}", "OK")
+                await asyncio.Event().wait()
+            else:
+                # Оставшийся после webhook-режима вебхук блокирует getUpdates
+                await bot.delete_webhook()
+                bot_logger.system("TELEGRAM", "Bot polling started", "OK")
+                await dp.start_polling(bot)
+        finally:
+            await fulfilment.stop()
+            await fsm_storage.close()
+            await webhook_runner.cleanup()
+            await http.close_session()
 
     try:
         asyncio.run(start_all())
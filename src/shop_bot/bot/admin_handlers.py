@@ -1,18 +1,29 @@
+import asyncio
 import logging
 import os
 from urllib.parse import urlparse
 
 from aiogram import Router, F, types
+from aiogram.types import BufferedInputFile
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from shop_bot.data_manager.database import update_setting
-from . import keyboards
+from shop_bot.data_manager import campaigns, promo_batches
+from shop_bot.data_manager.database import (
+    update_setting, get_active_vpn_user_ids, get_extension_campaign, get_unfinished_extension_campaigns
+)
+from . import keyboards, outbound
+from .callbacks import CallbackTable, EditSetting
 
 ADMIN_ID = os.getenv("ADMIN_TELEGRAM_ID")
 logger = logging.getLogger(__name__)
 admin_router = Router()
+callbacks = CallbackTable()
+admin_router.callback_query(callbacks)(callbacks.dispatch)
+
+# Ссылки на фоновые задачи кампаний, чтобы их не собрал GC
+_campaign_tasks: set[asyncio.Task] = set()
 
 class AdminEdit(StatesGroup):
     waiting_for_about_text = State()
@@ -34,9 +45,9 @@ async def admin_panel_handler(message: types.Message):
         return
     await message.answer("Добро пожаловать в админ-панель!", reply_markup=keyboards.create_admin_keyboard())
 
-@admin_router.callback_query(F.data.startswith("admin_edit_"))
-async def start_editing_handler(callback: types.CallbackQuery, state: FSMContext):
-    action = callback.data.removeprefix("admin_edit_") 
+@callbacks.route(EditSetting)
+async def start_editing_handler(callback: types.CallbackQuery, callback_data: EditSetting, state: FSMContext):
+    action = callback_data.field
     
     logger.info(f"Received callback to edit '{action}'")
 
@@ -50,23 +61,25 @@ async def start_editing_handler(callback: types.CallbackQuery, state: FSMContext
 
     if action in prompts:
         prompt_text, new_state = prompts[action]
-        await callback.message.edit_text(prompt_text, reply_markup=keyboards.create_admin_cancel_keyboard())
+        await outbound.edit_text(callback.message, prompt_text, reply_markup=keyboards.create_admin_cancel_keyboard())
         await state.set_state(new_state)
     else:
         logger.warning(f"Action '{action}' not found in prompts dictionary.")
 
     await callback.answer()
 
-@admin_router.callback_query(F.data == "admin_cancel_edit")
+@callbacks.route("admin_cancel_edit")
 async def cancel_editing_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.edit_text("Действие отменено. Вы в админ-панели.", reply_markup=keyboards.create_admin_keyboard())
+    await outbound.edit_text(callback.message, "Действие отменено. Вы в админ-панели.", reply_markup=keyboards.create_admin_keyboard())
     await callback.answer()
 
 async def process_new_content(message: types.Message, state: FSMContext, db_key: str):
     logger.info(f"Updating setting: {db_key} with value: {message.text}")
     try:
         update_setting(db_key, message.text)
+        # Экраны «О проекте»/«Поддержка» закешированы до смены настроек
+        keyboards.invalidate_cache()
         logger.info(f"Setting '{db_key}' updated successfully.")
     except Exception as e:
         logger.error(f"Error updating setting '{db_key}': {e}")
@@ -111,4 +124,128 @@ async def process_support_user(message: types.Message, state: FSMContext):
 @admin_router.message(AdminEdit.waiting_for_support_text)
 async def process_support_text(message: types.Message, state: FSMContext):
     logger.info(f"process_support_text called with text: {message.text}")
-    await process_new_content(message, state, "support_text")
\ No newline at end of file
+    await process_new_content(message, state, "support_text")
+
+def _format_campaign_progress(progress: dict, finished: bool = False) -> str:
+    processed = progress['done'] + progress['failed'] + progress['not_found']
+    total = progress['total'] or 1
+    header = "✅ Кампания завершена" if finished else "⏳ Кампания продления выполняется"
+    return (
+        f"{header} #{progress['campaign_id']}\n\n"
+        f"Обработано: {processed}/{progress['total']} ({processed * 100 // total}%)\n"
+        f"├ Продлено: {progress['done']}\n"
+        f"├ Не найдено в панели: {progress['not_found']}\n"
+        f"└ Ошибок: {progress['failed']}"
+    )
+
+def _launch_campaign(campaign_id: int, status_message: types.Message):
+    async def on_progress(progress: dict):
+        try:
+            await outbound.edit_text(status_message, _format_campaign_progress(progress))
+        except Exception:
+            pass
+
+    async def run():
+        result = await campaigns.run_extension_campaign(campaign_id, on_progress=on_progress)
+        if result is None:
+            await outbound.edit_text(status_message, f"❌ Кампания #{campaign_id} не найдена или уже выполняется.")
+            return
+        text = _format_campaign_progress(result, finished=True)
+        if result['failed']:
+            text += f"\n\nПовторить для ошибок: /bulk_resume {campaign_id}"
+        await outbound.edit_text(status_message, text)
+
+    task = asyncio.create_task(run())
+    _campaign_tasks.add(task)
+    task.add_done_callback(_campaign_tasks.discard)
+
+@admin_router.message(Command("bulk_extend"))
+async def bulk_extend_handler(message: types.Message):
+    """/bulk_extend <дни> [telegram_id ...] — без списка id продлеваются все активные пользователи."""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        days = int(args[0])
+        telegram_ids = [int(a.strip(',')) for a in args[1:]]
+        if days <= 0 or days > 365:
+            raise ValueError
+    except (IndexError, ValueError):
+        await message.answer("Использование: /bulk_extend <дни 1-365> [telegram_id ...]")
+        return
+    if not telegram_ids:
+        telegram_ids = get_active_vpn_user_ids()
+    if not telegram_ids:
+        await message.answer("Нет пользователей для продления.")
+        return
+    campaign_id = campaigns.start_extension_campaign(telegram_ids, days)
+    if not campaign_id:
+        await message.answer("❌ Не удалось создать кампанию.")
+        return
+    logger.info(f"Extension campaign {campaign_id}: +{days} days for {len(telegram_ids)} users")
+    status_message = await message.answer(f"⏳ Кампания #{campaign_id}: +{days} дн. для {len(set(telegram_ids))} пользователей...")
+    _launch_campaign(campaign_id, status_message)
+
+@admin_router.message(Command("bulk_resume"))
+async def bulk_resume_handler(message: types.Message):
+    """/bulk_resume [id] — продолжает прерванную кампанию; без id показывает незавершённые."""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    args = (message.text or "").split()[1:]
+    if not args:
+        unfinished = get_unfinished_extension_campaigns()
+        if not unfinished:
+            await message.answer("Незавершённых кампаний нет.")
+            return
+        lines = ["<b>Незавершённые кампании</b>"]
+        for c in unfinished:
+            lines.append(f"#{c['campaign_id']}: +{c['days']} дн., пользователей {c['total']} (создана {c['created_at']})")
+        await message.answer("\n".join(lines))
+        return
+    try:
+        campaign_id = int(args[0])
+    except ValueError:
+        await message.answer("Использование: /bulk_resume [id]")
+        return
+    if not get_extension_campaign(campaign_id):
+        await message.answer("❌ Кампания не найдена.")
+        return
+    if campaigns.is_running(campaign_id):
+        await message.answer("Кампания уже выполняется.")
+        return
+    status_message = await message.answer(f"⏳ Продолжаю кампанию #{campaign_id}...")
+    _launch_campaign(campaign_id, status_message)
+
+@admin_router.message(Command("bulk_promos"))
+async def bulk_promos_handler(message: types.Message):
+    """/bulk_promos <кол-во> <скидка %> <дни> [префикс] — выпускает пакет одноразовых кодов и присылает CSV."""
+    if str(message.from_user.id) != ADMIN_ID:
+        return
+    args = (message.text or "").split()[1:]
+    try:
+        count, discount, free_days = int(args[0]), int(args[1]), int(args[2])
+        prefix = args[3].upper() if len(args) > 3 else ""
+        if not 1 <= count <= promo_batches.MAX_BATCH_SIZE or not 0 <= discount <= 90 or not 0 <= free_days <= 365:
+            raise ValueError
+        if len(prefix) > promo_batches.MAX_PREFIX_LENGTH or (prefix and not (prefix.isascii() and prefix.isalnum())):
+            raise ValueError
+        if discount == 0 and free_days == 0:
+            raise ValueError
+    except (IndexError, ValueError):
+        await message.answer(
+            f"Использование: /bulk_promos <кол-во 1-{promo_batches.MAX_BATCH_SIZE}> <скидка 0-90> <дни 0-365> [префикс]\n"
+            f"Префикс — латиница и цифры, до {promo_batches.MAX_PREFIX_LENGTH} символов."
+        )
+        return
+    status_message = await message.answer(f"⏳ Генерирую {count} промокодов...")
+    try:
+        # Генерация и вставка синхронные — уводим их из event loop
+        batch, codes = await asyncio.to_thread(promo_batches.create_promo_batch, count, discount, free_days, 1, prefix)
+        csv_bytes = await asyncio.to_thread(promo_batches.export_csv, codes, discount, free_days, 1)
+    except RuntimeError as e:
+        logger.error(f"Bulk promo generation failed: {e}")
+        await outbound.edit_text(status_message, "❌ Не удалось сохранить промокоды.")
+        return
+    logger.info(f"Promo batch {batch}: {len(codes)} codes, {discount}% / {free_days} days")
+    await outbound.edit_text(status_message, f"✅ Пакет {batch}: создано {len(codes)} из {count} промокодов.")
+    await message.answer_document(BufferedInputFile(csv_bytes, filename=f"promos_{batch}.csv"))
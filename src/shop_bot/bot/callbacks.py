@@ -0,0 +1,146 @@
+"""
+Типизированные callback_data кнопок и таблица маршрутизации по префиксу.
+
+Вместо цепочки фильтров F.data == ... / F.data.startswith(...), которые aiogram
+проверяет по очереди, роутер регистрирует один обработчик callback_query с
+фильтром-таблицей: строка разбирается один раз, обработчик ищется в словаре —
+по всей строке для простых кнопок ("show_profile") или по префиксу до ":" для
+кнопок с параметрами ("key:42"). Стоимость маршрутизации не зависит от числа
+обработчиков, а параметры приходят в обработчик уже разобранными (int — int).
+
+    callbacks = CallbackTable()
+    user_router.callback_query(callbacks)(callbacks.dispatch)
+
+    @callbacks.route(ShowKey)
+    async def show_key_handler(callback: types.CallbackQuery, callback_data: ShowKey): ...
+"""
+import inspect
+import logging
+from typing import Any, Awaitable, Callable, NamedTuple, Optional, Type, Union
+
+from aiogram.filters import Filter
+from aiogram.filters.callback_data import CallbackData
+from aiogram.fsm.state import State
+from aiogram.types import CallbackQuery
+
+logger = logging.getLogger(__name__)
+
+# --- Кнопки с параметрами (Telegram ограничивает callback_data 64 байтами) ---
+
+class ShowKey(CallbackData, prefix="key"):
+    key_id: int
+
+class KeyQR(CallbackData, prefix="qr"):
+    key_id: int
+
+class KeyInstruction(CallbackData, prefix="howto"):
+    key_id: int
+
+class ExtendKey(CallbackData, prefix="extend"):
+    key_id: int
+
+class TrafficPacks(CallbackData, prefix="packs"):
+    key_id: int
+
+class BuyPack(CallbackData, prefix="pack"):
+    pack_id: str
+    key_id: int
+
+class ChoosePlan(CallbackData, prefix="plan"):
+    plan_id: str
+    action: str
+    key_id: int
+
+class Pay(CallbackData, prefix="pay"):
+    method: str
+    plan_id: str
+    action: str
+    key_id: int
+
+class PromoToggle(CallbackData, prefix="promo_toggle"):
+    # rowid, а не сам код: в коде может быть ':' и он может не поместиться в 64 байта
+    promo_id: int
+
+class EditSetting(CallbackData, prefix="admin_edit"):
+    field: str
+
+class KeysPage(CallbackData, prefix="keys"):
+    cursor: int   # key_id границы страницы
+    back: bool    # False — ключи после cursor, True — перед ним
+    number: int   # номер («Ключ #N») первого ключа после cursor, а при back — самого cursor
+
+class PromosPage(CallbackData, prefix="promos"):
+    cursor: int  # rowid крайнего промокода страницы
+    back: bool
+
+# --- Таблица маршрутизации ---
+
+class _Route(NamedTuple):
+    handler: Callable[..., Awaitable[Any]]
+    factory: Optional[Type[CallbackData]]
+    state: Optional[str]
+    params: frozenset
+    accepts_any: bool
+
+class CallbackTable(Filter):
+    """Фильтр и диспетчер callback_query для одного роутера.
+
+    Как фильтр пропускает только известные таблице callback_data, поэтому
+    остальные запросы уходят дальше по роутерам, как и раньше.
+    """
+
+    def __init__(self):
+        self._exact: dict[str, _Route] = {}
+        self._prefixed: dict[str, _Route] = {}
+
+    def route(self, key: Union[str, Type[CallbackData]], state: Optional[State] = None):
+        """Регистрирует обработчик для строки callback_data или фабрики CallbackData.
+
+        state — обработчик срабатывает только в этом состоянии FSM.
+        """
+        def decorator(handler):
+            signature = inspect.signature(handler)
+            route = _Route(
+                handler=handler,
+                factory=None if isinstance(key, str) else key,
+                state=state.state if state is not None else None,
+                params=frozenset(signature.parameters),
+                accepts_any=any(p.kind is inspect.Parameter.VAR_KEYWORD for p in signature.parameters.values()),
+            )
+            table, name = (self._exact, key) if isinstance(key, str) else (self._prefixed, key.__prefix__)
+            if name in table:
+                raise ValueError(f"Callback route '{name}' is already registered")
+            table[name] = route
+            return handler
+        return decorator
+
+    def resolve(self, data: Optional[str], raw_state: Optional[str] = None) -> Optional[tuple[_Route, Optional[CallbackData]]]:
+        if not data:
+            return None
+        route = self._exact.get(data)
+        if route is None:
+            route = self._prefixed.get(data.partition(":")[0])
+            if route is None:
+                return None
+        if route.state is not None and route.state != raw_state:
+            return None
+        if route.factory is None:
+            return route, None
+        try:
+            return route, route.factory.unpack(data)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Malformed callback data '{data}': {e}")
+            return None
+
+    async def __call__(self, callback: CallbackQuery, raw_state: Optional[str] = None) -> Union[bool, dict]:
+        resolved = self.resolve(callback.data, raw_state)
+        if resolved is None:
+            return False
+        route, callback_data = resolved
+        return {"callback_route": route, "callback_data": callback_data}
+
+    async def dispatch(self, callback: CallbackQuery, callback_route: _Route, **kwargs):
+        """Единственный обработчик callback_query роутера: вызывает найденный маршрут."""
+        if not callback_route.accepts_any:
+            kwargs = {name: value for name, value in kwargs.items() if name in callback_route.params}
+        return await callback_route.handler(callback, **kwargs)
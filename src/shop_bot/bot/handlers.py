@@ -1,60 +1,54 @@
+import asyncio
 import logging
-import uuid
-from io import BytesIO
+import secrets
 from datetime import datetime, timedelta
-import qrcode
-from yookassa import Payment
-import aiohttp
 import os
 import hashlib
-import json
 import tarfile
 import shutil
 from pathlib import Path
 
 from aiogram import Bot, Router, F, types, html
 from aiogram.filters import Command
-from aiogram.types import BufferedInputFile
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, FSInputFile
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
 # Универсальная функция для безопасного редактирования сообщений
 async def safe_edit_message(message: types.Message, text: str, reply_markup=None):
     """
-    Безопасно редактирует сообщение, обрабатывая ошибки Telegram
+    Редактирует сообщение через outbound: неизменённый экран не отправляется,
+    частые обновления схлопываются. Новое сообщение отправляется, только если
+    старое отредактировать нельзя (удалено, слишком старое).
     """
     try:
-        await message.edit_text(text, reply_markup=reply_markup)
-    except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            # Добавляем невидимый символ для принудительного обновления
-            modified_text = text + "‎"  # Добавляем невидимый символ
-            try:
-                await message.edit_text(modified_text, reply_markup=reply_markup)
-            except:
-                # Если всё равно не получается, отправляем новое сообщение
-                await message.answer(text, reply_markup=reply_markup)
-        else:
-            # Для других ошибок отправляем новое сообщение
-            await message.answer(text, reply_markup=reply_markup)
-    except Exception:
-        # Для любых других ошибок отправляем новое сообщение
+        await outbound.edit_text(message, text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.warning(f"Could not edit message, sending a new one: {e}")
         await message.answer(text, reply_markup=reply_markup)
 
-from shop_bot.bot import keyboards
-from shop_bot.modules import remnawave_api
+from shop_bot.bot import keyboards, media, outbound
+from shop_bot.bot.middlewares import callback_debounce
+from shop_bot.bot.callbacks import (
+    CallbackTable, BuyPack, ChoosePlan, ExtendKey, KeyInstruction, KeyQR, KeysPage, Pay, PromosPage, PromoToggle,
+    ShowKey, TrafficPacks
+)
+from shop_bot.modules import remnawave_api, yookassa_api
+from shop_bot.data_manager import fulfilment
 from shop_bot.data_manager.database import (
     get_user, add_new_key, get_user_keys, update_user_stats,
-    register_user_if_not_exists, get_next_key_number, get_key_by_id,
+    register_user_if_not_exists, get_next_key_number, get_key_by_id, get_key_by_email, set_key_plan,
     update_key_info, set_trial_used, reset_trial_used, set_terms_agreed, get_setting,
     get_promo, apply_promo_usage, ensure_user_ref_code, link_referral, count_referrals,
     set_auto_renew, get_auto_renew, log_action, has_action, add_traffic_extra,
-    create_promo, get_all_promos
+    create_promo, get_promos_page, get_promo_by_id, set_promo_active, get_panel_user, create_pending_order,
+    get_user_keys_page, set_pending_order_payment_id
 )
 from shop_bot.config import (
     PLANS, get_profile_text, get_vpn_active_text, VPN_INACTIVE_TEXT, VPN_NO_DATA_TEXT,
-    get_key_info_text, CHOOSE_PAYMENT_METHOD_MESSAGE, get_purchase_success_text, ABOUT_TEXT, TERMS_URL, PRIVACY_URL, SUPPORT_USER, SUPPORT_TEXT
+    get_key_info_text, CHOOSE_PAYMENT_METHOD_MESSAGE, get_purchase_success_text, ABOUT_TEXT, TERMS_URL, PRIVACY_URL, SUPPORT_USER, SUPPORT_TEXT,
+    get_data_age_text
 )
 from shop_bot.config import TRAFFIC_PACKS
 from shop_bot.modules.remnawave_api import add_extra_traffic
@@ -70,6 +64,75 @@ logger = logging.getLogger(__name__)
 
 # Импорт красивого логгера
 from shop_bot.utils.logger import bot_logger
+from shop_bot.utils import json_codec, qr
+from shop_bot.utils.cache import TTLCache
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Лимит Telegram на документ от бота — 50 МБ; части берутся с запасом
+BACKUP_PART_SIZE = int(os.getenv("BACKUP_PART_SIZE_MB", "49")) * 1024 * 1024
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "10"))
+_COPY_CHUNK = 1024 * 1024
+
+def _split_file(path: Path, part_size: int) -> list[Path]:
+    """Режет файл на части name.part_aa, name.part_ab, ... (как split), потоково."""
+    parts = []
+    with open(path, 'rb') as src:
+        index = 0
+        while True:
+            chunk = src.read(min(_COPY_CHUNK, part_size))
+            if not chunk:
+                break
+            suffix = chr(ord('a') + index // 26) + chr(ord('a') + index % 26)
+            part_path = path.with_name(f"{path.name}.part_{suffix}")
+            written = 0
+            with open(part_path, 'wb') as dst:
+                while chunk:
+                    dst.write(chunk)
+                    written += len(chunk)
+                    if written >= part_size:
+                        break
+                    chunk = src.read(min(_COPY_CHUNK, part_size - written))
+            parts.append(part_path)
+            index += 1
+    path.unlink()
+    return parts
+
+def _cleanup_backups(backups_dir: Path, keep: int):
+    """Оставляет keep последних бэкапов (все части одного бэкапа считаются одним)."""
+    sets: dict[str, list[Path]] = {}
+    for path in backups_dir.glob("backup_[0-9]*.tar.gz*"):
+        sets.setdefault(path.name.split('.tar.gz')[0], []).append(path)
+    for name in sorted(sets)[:-keep] if keep > 0 else []:
+        for path in sets[name]:
+            path.unlink(missing_ok=True)
+
+def _build_backup(db_path: Path, backups_dir: Path, backup_name: str) -> tuple[list[Path], int, str]:
+    """Выполняется в потоке: снимок БД через sqlite backup API, tar.gz, нарезка на части.
+
+    Возвращает (файлы для отправки, размер архива, sha256 снимка).
+    """
+    import sqlite3
+
+    snapshot = backups_dir / f".{backup_name}.db"
+    archive = backups_dir / f"{backup_name}.tar.gz"
+    try:
+        with sqlite3.connect(db_path) as src, sqlite3.connect(snapshot) as dst:
+            src.backup(dst)
+        digest = _file_sha256(snapshot)
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(snapshot, arcname=db_path.name)
+    finally:
+        snapshot.unlink(missing_ok=True)
+    size = archive.stat().st_size
+    files = _split_file(archive, BACKUP_PART_SIZE) if size > BACKUP_PART_SIZE else [archive]
+    _cleanup_backups(backups_dir, BACKUP_KEEP)
+    return files, size, digest
 
 async def create_backup_and_send(bot: Bot, admin_id: str, is_auto: bool = False) -> bool:
     """Создает бэкап базы данных и отправляет админу.
@@ -97,17 +160,12 @@ async def create_backup_and_send(bot: Bot, admin_id: str, is_auto: bool = False)
         
         # Генерируем имя файла бэкапа
         timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        backup_name = f"backup_part_aa"
-        
-        # Создаем tar.gz архив
-        backup_file = backups_dir / f"{backup_name}.tar.gz"
-        bot_logger.backup("CREATE_ARCHIVE", f"Creating: {backup_file.name}")
+        backup_name = f"backup_{timestamp}"
         
-        with tarfile.open(backup_file, "w:gz") as tar:
-            tar.add(db_path, arcname=db_path.name)
+        # Архив собирается в отдельном потоке и не держится в памяти целиком
+        bot_logger.backup("CREATE_ARCHIVE", f"Creating: {backup_name}.tar.gz")
+        backup_files, file_size, db_digest = await asyncio.to_thread(_build_backup, db_path, backups_dir, backup_name)
         
-        # Получаем информацию о файле
-        file_size = backup_file.stat().st_size
         # Исправляем расчет размера - если меньше 1 МБ, показываем в КБ
         if file_size >= 1024 * 1024:
             file_size_str = f"{file_size / (1024 * 1024):.1f} MB"
@@ -131,20 +189,25 @@ async def create_backup_and_send(bot: Bot, admin_id: str, is_auto: bool = False)
             f"📅 <b>Backup Time:</b> <code>{datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC</code>\n"
             f"📊 <b>File Size:</b> <code>{file_size_str}</code>"
         )
+        if len(backup_files) > 1:
+            backup_text += (
+                f"\n🧩 <b>Parts:</b> <code>{len(backup_files)}</code>\n"
+                f"<i>Сборка: cat {backup_name}.tar.gz.part_* > {backup_name}.tar.gz</i>"
+            )
         
-        # Отправляем файл админу
-        bot_logger.backup("SEND_TO_ADMIN", f"Sending backup ({file_size_str})")
+        # Отправляем файлы админу с диска; неизменившаяся база уходит по сохранённому file_id
+        bot_logger.backup("SEND_TO_ADMIN", f"Sending backup ({file_size_str}, {len(backup_files)} file(s))")
         try:
-            with open(backup_file, 'rb') as f:
-                backup_document = BufferedInputFile(f.read(), filename=f"{backup_name}.tar.gz")
-                
-            await bot.send_document(
-                chat_id=admin_id,
-                document=backup_document,
-                caption=backup_text
-            )
+            for index, backup_file in enumerate(backup_files):
+                async def load_backup(path=backup_file):
+                    return FSInputFile(path, filename=path.name)
+
+                await media.send_cached(
+                    bot, admin_id, "document", media.cache_key("backup", db_digest, str(index), str(len(backup_files))),
+                    load_backup, caption=backup_text if index == 0 else None
+                )
             
-            bot_logger.backup("SUCCESS", f"Backup sent: {backup_file.name} ({file_size_str})", "OK")
+            bot_logger.backup("SUCCESS", f"Backup sent: {backup_name} ({file_size_str})", "OK")
             return True
             
         except Exception as e:
@@ -157,6 +220,9 @@ async def create_backup_and_send(bot: Bot, admin_id: str, is_auto: bool = False)
 
 admin_router = Router()
 user_router = Router()
+# Все callback_query роутера идут через таблицу: один фильтр, поиск по словарю
+callbacks = CallbackTable()
+user_router.callback_query(callbacks)(callbacks.dispatch)
 
 async def show_main_menu(message: types.Message, edit_message: bool = False):
     user_id = message.chat.id
@@ -172,7 +238,7 @@ async def show_main_menu(message: types.Message, edit_message: bool = False):
     
     if edit_message:
         try:
-            await message.edit_text(text, reply_markup=keyboard)
+            await outbound.edit_text(message, text, reply_markup=keyboard)
         except TelegramBadRequest:
             pass
     else:
@@ -228,7 +294,7 @@ async def start_handler(message: types.Message, state: FSMContext):
         await message.answer(agreement_text, reply_markup=keyboards.create_agreement_keyboard(), disable_web_page_preview=True)
         await state.set_state(UserAgreement.waiting_for_agreement)
 
-@user_router.callback_query(UserAgreement.waiting_for_agreement, F.data == "agree_to_terms")
+@callbacks.route("agree_to_terms", state=UserAgreement.waiting_for_agreement)
 async def agree_to_terms_handler(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
@@ -253,12 +319,12 @@ async def agreement_fallback_handler(message: types.Message):
 async def main_menu_handler(message: types.Message):
     await show_main_menu(message)
 
-@user_router.callback_query(F.data == "back_to_main_menu")
+@callbacks.route("back_to_main_menu")
 async def back_to_main_menu_handler(callback: types.CallbackQuery):
     await callback.answer()
     await show_main_menu(callback.message, edit_message=True)
 
-@user_router.callback_query(F.data == "show_profile")
+@callbacks.route("show_profile")
 async def profile_handler_callback(callback: types.CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
@@ -270,20 +336,35 @@ async def profile_handler_callback(callback: types.CallbackQuery):
     username = html.bold(user_db_data.get('username', 'Пользователь'))
     total_spent, total_months = user_db_data.get('total_spent', 0), user_db_data.get('total_months', 0)
     now = datetime.now()
+    # Дата окончания из зеркала панели (без запроса к панели), иначе из локальных ключей
+    mirror = get_panel_user(user_id) if user_keys else None
+    mirror_expiry = None
+    if mirror and mirror.get('expire_at'):
+        try:
+            mirror_expiry = datetime.fromisoformat(mirror['expire_at'].replace('Z', '+00:00')).replace(tzinfo=None)
+        except ValueError:
+            mirror_expiry = None
     active_keys = [key for key in user_keys if datetime.fromisoformat(key['expiry_date']) > now]
-    if active_keys:
+    if mirror_expiry:
+        latest_expiry_date = mirror_expiry
+    elif active_keys:
         latest_key = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']))
         latest_expiry_date = datetime.fromisoformat(latest_key['expiry_date'])
+    else:
+        latest_expiry_date = None
+    if latest_expiry_date and latest_expiry_date > now:
         time_left = latest_expiry_date - now
         vpn_status_text = get_vpn_active_text(time_left.days, time_left.seconds // 3600)
     elif user_keys: vpn_status_text = VPN_INACTIVE_TEXT
     else: vpn_status_text = VPN_NO_DATA_TEXT
+    if mirror_expiry:
+        vpn_status_text += f"\n{get_data_age_text(mirror['age_seconds'])}"
     ref_code = ensure_user_ref_code(user_id)
     ref_count = count_referrals(ref_code)
     final_text = get_profile_text(username, total_spent, total_months, vpn_status_text) + f"\n\n👥 Ваш реф-код: <code>{ref_code}</code>\nПриглашено: {ref_count}"
-    await callback.message.edit_text(final_text, reply_markup=keyboards.create_back_to_menu_keyboard())
+    await outbound.edit_text(callback.message, final_text, reply_markup=keyboards.create_back_to_menu_keyboard())
 
-@user_router.callback_query(F.data == "show_referrals")
+@callbacks.route("show_referrals")
 async def referrals_handler(callback: types.CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
@@ -300,141 +381,137 @@ async def referrals_handler(callback: types.CallbackQuery):
         f"• При покупке подписки вы оба получите +3 дня\n"
         f"• Делитесь ссылкой и получайте бонусы!\n\n"
         f"🔗 <b>Ваша реферальная ссылка:</b>\n"
-        f"https://t.me/{(await callback.bot.get_me()).username}?start=ref_{ref_code}"
+        f"https://t.me/{(await callback.bot.me()).username}?start=ref_{ref_code}"
     )
     
-    await callback.message.edit_text(ref_text, reply_markup=keyboards.create_back_to_menu_keyboard())
+    await outbound.edit_text(callback.message, ref_text, reply_markup=keyboards.create_back_to_menu_keyboard())
 
-@user_router.callback_query(F.data == "show_about")
-async def about_handler(callback: types.CallbackQuery):
-    await callback.answer()
-    
+@keyboards.cached_render
+def _about_screen() -> tuple[str, types.InlineKeyboardMarkup]:
     about_text = get_setting("about_text")
     terms_url = get_setting("terms_url")
     privacy_url = get_setting("privacy_url")
 
     if about_text == ABOUT_TEXT and terms_url == TERMS_URL and privacy_url == PRIVACY_URL:
-        await callback.message.edit_text(
-            "Информация о проекте не установлена. Установите её в админ-панели.",
-            reply_markup=keyboards.create_back_to_menu_keyboard()
-        )
+        return "Информация о проекте не установлена. Установите её в админ-панели.", keyboards.create_back_to_menu_keyboard()
     elif terms_url == TERMS_URL and privacy_url == PRIVACY_URL:
-        await callback.message.edit_text(
-            about_text,
-            reply_markup=keyboards.create_back_to_menu_keyboard()
-        )
+        return about_text, keyboards.create_back_to_menu_keyboard()
     elif terms_url == TERMS_URL:
-        await callback.message.edit_text(
-            about_text,
-            reply_markup=keyboards.create_about_keyboard_terms(privacy_url)
-        )
+        return about_text, keyboards.create_about_keyboard_terms(privacy_url)
     elif privacy_url == PRIVACY_URL:
-        await callback.message.edit_text(
-            about_text,
-            reply_markup=keyboards.create_about_keyboard_privacy(terms_url)
-        )
+        return about_text, keyboards.create_about_keyboard_privacy(terms_url)
     else:
-        await callback.message.edit_text(
-        about_text,
-        reply_markup=keyboards.create_about_keyboard(terms_url, privacy_url)
-        )
+        return about_text, keyboards.create_about_keyboard(terms_url, privacy_url)
+
+@callbacks.route("show_about")
+async def about_handler(callback: types.CallbackQuery):
+    await callback.answer()
+    # Экран зависит только от настроек; пересобирается после их изменения в админке
+    text, markup = _about_screen()
+    await outbound.edit_text(callback.message, text, reply_markup=markup)
 
-@user_router.callback_query(F.data == "show_traffic")
-async def traffic_status_handler(callback: types.CallbackQuery):
+@callbacks.route("show_traffic")
+async def traffic_status_handler(callback: types.CallbackQuery, force_refresh: bool = False):
     await callback.answer()
     user_id = callback.from_user.id
     keys = get_user_keys(user_id)
     if not keys:
-        await callback.message.edit_text("У вас нет ключей для отображения трафика.", reply_markup=keyboards.create_back_to_menu_keyboard())
+        await outbound.edit_text(callback.message, "У вас нет ключей для отображения трафика.", reply_markup=keyboards.create_back_to_menu_keyboard())
         return
-    from shop_bot.modules.remnawave_api import get_user_by_telegram_id
     from shop_bot.config import build_progress_bar
-    async with aiohttp.ClientSession() as session:
-        lines = ["<b>📊 Использование трафика</b>"]
+    lines = ["<b>📊 Использование трафика</b>"]
+    
+    # Читаем локальное зеркало; панель опрашивается только если данные устарели
+    remote = await remnawave_api.get_cached_user(user_id, force_refresh=force_refresh)
+    if not remote:
+        lines.append("❌ Не удалось получить данные с сервера")
+    else:
+        used = remote.get('used_bytes') or 0
+        base_limit = remote.get('limit_bytes') or 0
         
-        # Получаем общую информацию о пользователе (теперь все ключи в одном профиле)
-        remote = await get_user_by_telegram_id(session, str(user_id))
-        if not remote:
-            lines.append("❌ Не удалось получить данные с сервера")
-        else:
-            used = remote.get('usedTrafficBytes', 0)
-            base_limit = remote.get('trafficLimitBytes', 0)
+        # Суммируем дополнительный трафик из всех ключей
+        total_extra = sum(key.get('traffic_extra_bytes', 0) or 0 for key in keys)
+        limit = base_limit + total_extra
+        
+        if limit > 0:
+            percent = min(100, (used/limit)*100)
+            bar = build_progress_bar(percent)
+            used_gb = used / (1024**3)
+            limit_gb = limit / (1024**3)
             
-            # Суммируем дополнительный трафик из всех ключей
-            total_extra = sum(key.get('traffic_extra_bytes', 0) or 0 for key in keys)
-            limit = base_limit + total_extra
+            lines.append(f"📊 Общее использование:")
+            lines.append(f"{bar} {percent:.1f}%")
+            lines.append(f"📈 {used_gb:.2f} ГБ из {limit_gb:.1f} ГБ")
             
-            if limit > 0:
-                percent = min(100, (used/limit)*100)
-                bar = build_progress_bar(percent)
-                used_gb = used / (1024**3)
-                limit_gb = limit / (1024**3)
-                
-                lines.append(f"📊 Общее использование:")
-                lines.append(f"{bar} {percent:.1f}%")
-                lines.append(f"📈 {used_gb:.2f} ГБ из {limit_gb:.1f} ГБ")
-                
-                if total_extra > 0:
-                    extra_gb = total_extra / (1024**3)
-                    lines.append(f"➕ Доп. трафик: {extra_gb:.1f} ГБ")
-            else:
-                lines.append("♾️ Безлимитный трафик")
-        
-        # Показываем информацию о ключах
-        lines.append(f"\n🔑 Активных ключей: {len(keys)}")
-        for idx, key in enumerate(keys, start=1):
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            status = "✅" if expiry_date > datetime.now() else "❌"
-            lines.append(f"{status} Ключ #{idx}: до {expiry_date.strftime('%d.%m.%Y')}")
+            if total_extra > 0:
+                extra_gb = total_extra / (1024**3)
+                lines.append(f"➕ Доп. трафик: {extra_gb:.1f} ГБ")
+        else:
+            lines.append("♾️ Безлимитный трафик")
     
-    # Добавляем timestamp для уникальности сообщения
-    from datetime import datetime
-    current_time = datetime.now().strftime("%H:%M:%S")
-    lines.append(f"\nОбновлено: {current_time}")
+    # Показываем информацию о ключах
+    lines.append(f"\n🔑 Активных ключей: {len(keys)}")
+    for idx, key in enumerate(keys, start=1):
+        expiry_date = datetime.fromisoformat(key['expiry_date'])
+        status = "✅" if expiry_date > datetime.now() else "❌"
+        lines.append(f"{status} Ключ #{idx}: до {expiry_date.strftime('%d.%m.%Y')}")
+    
+    if remote:
+        lines.append(f"\n{get_data_age_text(remote['age_seconds'])}")
     lines.append("Нажмите 'Обновить' для актуализации.")
     
     await safe_edit_message(callback.message, "\n".join(lines), keyboards.create_traffic_keyboard())
 
-@user_router.callback_query(F.data == "refresh_traffic")
+@callbacks.route("refresh_traffic")
 async def refresh_traffic_handler(callback: types.CallbackQuery):
     await callback.answer("🔄 Обновляю данные...")
-    # Просто вызываем обновление данных
-    await traffic_status_handler(callback)
-
-@user_router.callback_query(F.data == "show_help")
-async def about_handler(callback: types.CallbackQuery):
-    await callback.answer()
+    # Кнопка «Обновить» всегда идёт в панель мимо зеркала
+    await traffic_status_handler(callback, force_refresh=True)
 
+@keyboards.cached_render
+def _help_screen() -> tuple[str, types.InlineKeyboardMarkup]:
     support_user = get_setting("support_user")
     support_text = get_setting("support_text")
 
     if support_user == SUPPORT_USER and support_text == SUPPORT_TEXT:
-        await callback.message.edit_text(
-            support_user,
-            reply_markup=keyboards.create_back_to_menu_keyboard()
-        )
+        return support_user, keyboards.create_back_to_menu_keyboard()
     elif support_text == SUPPORT_TEXT:
-        await callback.message.edit_text(
-            "Для связи с поддержкой используйте кнопку ниже.",
-            reply_markup=keyboards.create_support_keyboard(support_user)
-        )
+        return "Для связи с поддержкой используйте кнопку ниже.", keyboards.create_support_keyboard(support_user)
     else:
-        await callback.message.edit_text(
-            support_text + "\n\n" + "Для связи с поддержкой используйте кнопку ниже.",
-            reply_markup=keyboards.create_support_keyboard(support_user)
-        )
+        return support_text + "\n\n" + "Для связи с поддержкой используйте кнопку ниже.", keyboards.create_support_keyboard(support_user)
 
-@user_router.callback_query(F.data == "manage_keys")
-async def manage_keys_handler(callback: types.CallbackQuery):
+@callbacks.route("show_help")
+async def help_handler(callback: types.CallbackQuery):
     await callback.answer()
-    user_id = callback.from_user.id
-    user_keys = get_user_keys(user_id)
-    await callback.message.edit_text(
-        "Ваши ключи:" if user_keys else "У вас пока нет ключей, давайте создадим первый!",
-        reply_markup=keyboards.create_keys_management_keyboard(user_keys)
+    text, markup = _help_screen()
+    await outbound.edit_text(callback.message, text, reply_markup=markup)
+
+KEYS_PAGE_SIZE = 10
+PROMOS_PAGE_SIZE = 20
+
+async def _show_keys_page(callback: types.CallbackQuery, cursor: int = 0, back: bool = False, number: int = 1):
+    # Одна страница по key_id: стоимость не зависит от числа ключей пользователя
+    keys, has_more = get_user_keys_page(callback.from_user.id, cursor, KEYS_PAGE_SIZE, backward=back)
+    if back:
+        start_number, has_prev, has_next = number - len(keys), has_more, True
+    else:
+        start_number, has_prev, has_next = number, cursor > 0, has_more
+    await outbound.edit_text(callback.message, 
+        "Ваши ключи:" if keys else "У вас пока нет ключей, давайте создадим первый!",
+        reply_markup=keyboards.create_keys_management_keyboard(keys, start_number, has_prev, has_next)
     )
 
-@user_router.callback_query(F.data == "toggle_autorenew")
+@callbacks.route("manage_keys")
+async def manage_keys_handler(callback: types.CallbackQuery):
+    await callback.answer()
+    await _show_keys_page(callback)
+
+@callbacks.route(KeysPage)
+async def keys_page_handler(callback: types.CallbackQuery, callback_data: KeysPage):
+    await callback.answer()
+    await _show_keys_page(callback, callback_data.cursor, callback_data.back, callback_data.number)
+
+@callbacks.route("toggle_autorenew")
 async def toggle_autorenew_handler(callback: types.CallbackQuery):
     await callback.answer()
     uid = callback.from_user.id
@@ -443,39 +520,37 @@ async def toggle_autorenew_handler(callback: types.CallbackQuery):
     log_action(uid, 'auto_renew_toggle', str(not current))
     await show_main_menu(callback.message, edit_message=True)
 
-@user_router.callback_query(F.data.startswith("traffic_packs_"))
-async def show_traffic_packs(callback: types.CallbackQuery):
+@callbacks.route(TrafficPacks)
+async def show_traffic_packs(callback: types.CallbackQuery, callback_data: TrafficPacks):
     await callback.answer()
-    key_id = int(callback.data.split('_')[2])
-    await callback.message.edit_text("Выберите пакет дополнительного трафика:", reply_markup=keyboards.create_traffic_packs_keyboard(TRAFFIC_PACKS, key_id))
+    key_id = callback_data.key_id
+    await outbound.edit_text(callback.message, "Выберите пакет дополнительного трафика:", reply_markup=keyboards.create_traffic_packs_keyboard(TRAFFIC_PACKS, key_id))
 
-@user_router.callback_query(F.data.startswith("buy_pack_"))
-async def buy_traffic_pack(callback: types.CallbackQuery):
+@callbacks.route(BuyPack)
+async def buy_traffic_pack(callback: types.CallbackQuery, callback_data: BuyPack):
     await callback.answer()
-    parts = callback.data.split('_')
-    pack_id = parts[2]
-    key_id = int(parts[3])
+    pack_id, key_id = callback_data.pack_id, callback_data.key_id
     if pack_id not in TRAFFIC_PACKS:
-        await callback.message.edit_text("Пакет не найден", reply_markup=keyboards.create_back_to_key_keyboard(key_id))
+        await outbound.edit_text(callback.message, "Пакет не найден", reply_markup=keyboards.create_back_to_key_keyboard(key_id))
         return
     title, price_rub, gb = TRAFFIC_PACKS[pack_id]
     # Используем платеж только как "extend" с особыми метаданными action=pack
     payment_methods = PAYMENT_METHODS
-    await callback.message.edit_text(
+    await outbound.edit_text(callback.message, 
         f"Покупка пакета: {title}\nОбъем: {gb} ГБ\nЦена: {price_rub} RUB\nВыберите способ оплаты:",
         reply_markup=keyboards.create_payment_method_keyboard(payment_methods, pack_id, "pack", key_id)
     )
 
-@user_router.callback_query(F.data == "enter_promo")
+@callbacks.route("enter_promo")
 async def enter_promo_info(callback: types.CallbackQuery):
     await callback.answer()
-    await callback.message.edit_text("Вы можете ввести промокод перед оплатой. Нажмите кнопку ниже.", reply_markup=keyboards.create_promo_enter_keyboard())
+    await outbound.edit_text(callback.message, "Вы можете ввести промокод перед оплатой. Нажмите кнопку ниже.", reply_markup=keyboards.create_promo_enter_keyboard())
 
-@user_router.callback_query(F.data == "enter_promo_start")
+@callbacks.route("enter_promo_start")
 async def enter_promo_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     await state.set_state(PromoInput.waiting_for_code)
-    await callback.message.edit_text("Введите промокод одним сообщением:")
+    await outbound.edit_text(callback.message, "Введите промокод одним сообщением:")
 
 @user_router.message(PromoInput.waiting_for_code)
 async def promo_code_received(message: types.Message, state: FSMContext):
@@ -496,7 +571,7 @@ async def promo_code_received(message: types.Message, state: FSMContext):
     await state.clear()
     await show_main_menu(message)
 
-@user_router.callback_query(F.data == "get_trial")
+@callbacks.route("get_trial")
 async def trial_period_handler(callback: types.CallbackQuery):
     await callback.answer("Проверяю доступность...", show_alert=False)
     user_id = callback.from_user.id
@@ -508,7 +583,7 @@ async def trial_period_handler(callback: types.CallbackQuery):
     # Устанавливаем флаг использования пробного периода сразу, чтобы предотвратить повторное использование
     set_trial_used(user_id)
     
-    await callback.message.edit_text("Отлично! Создаю для вас бесплатный ключ на 3 дня...")
+    await outbound.edit_text(callback.message, "Отлично! Создаю для вас бесплатный ключ на 3 дня...")
     try:
         key_number = get_next_key_number(user_id)
         email = f"user{user_id}-key{key_number}-trial@kitsura.fun"
@@ -516,7 +591,7 @@ async def trial_period_handler(callback: types.CallbackQuery):
         if not uri or not expire_iso or not vless_uuid:
             # Сбрасываем флаг при ошибке создания ключа
             reset_trial_used(user_id)
-            await callback.message.edit_text("❌ Не удалось создать пробный ключ.")
+            await outbound.edit_text(callback.message, "❌ Не удалось создать пробный ключ.")
             return
         # convert ISO to timestamp ms for storage
         expiry_dt = datetime.fromisoformat(expire_iso.replace('Z', '+00:00'))
@@ -537,7 +612,7 @@ async def trial_period_handler(callback: types.CallbackQuery):
         is_admin = str(user_id) == ADMIN_ID
         auto_renew = user_data.get('auto_renew', False) if user_data else False
         
-        await callback.message.edit_text(
+        await outbound.edit_text(callback.message, 
             message_text,
             parse_mode="Markdown",
             reply_markup=create_main_menu_keyboard(user_keys, trial_available=False, is_admin=is_admin, auto_renew=auto_renew)
@@ -546,21 +621,21 @@ async def trial_period_handler(callback: types.CallbackQuery):
         logger.error(f"Error creating trial key for user {user_id}: {e}", exc_info=True)
         # Сбрасываем флаг при любой ошибке
         reset_trial_used(user_id)
-        await callback.message.edit_text("❌ Произошла ошибка при создании пробного ключа.")
+        await outbound.edit_text(callback.message, "❌ Произошла ошибка при создании пробного ключа.")
 
-@user_router.callback_query(F.data == "open_admin_panel")
+@callbacks.route("open_admin_panel")
 async def open_admin_panel_handler(callback: types.CallbackQuery):
     if str(callback.from_user.id) != ADMIN_ID:
         await callback.answer("У вас нет доступа.", show_alert=True)
         return
     
     await callback.answer()
-    await callback.message.edit_text(
+    await outbound.edit_text(callback.message, 
         "Добро пожаловать в админ-панель!",
         reply_markup=keyboards.create_admin_keyboard()
     )
 
-@user_router.callback_query(F.data == "admin_stats")
+@callbacks.route("admin_stats")
 async def admin_stats_handler(callback: types.CallbackQuery):
     if str(callback.from_user.id) != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True); return
@@ -579,6 +654,7 @@ async def admin_stats_handler(callback: types.CallbackQuery):
     
     # Процент активных ключей
     keys_percentage = round((active_keys / total_keys * 100) if total_keys > 0 else 0, 1)
+    suppressed_presses = sum(callback_debounce.suppressed.values())
     
     text = (
         "📊 <b>СТАТИСТИКА БОТА</b>\n"
@@ -603,14 +679,15 @@ async def admin_stats_handler(callback: types.CallbackQuery):
         f"└ Активных: <code>{active_promos:,}</code>\n\n"
         
         "💾 <b>СИСТЕМА</b>\n"
-        f"└ Последний бэкап: <code>{last_backup}</code>\n\n"
+        f"├ Последний бэкап: <code>{last_backup}</code>\n"
+        f"└ Погашено повторных нажатий: <code>{suppressed_presses:,}</code>\n\n"
         
         "═══════════════════════\n"
         f"📅 Обновлено: <code>{datetime.now().strftime('%d.%m.%Y %H:%M')}</code>"
     )
-    await callback.message.edit_text(text, reply_markup=keyboards.create_admin_keyboard())
+    await outbound.edit_text(callback.message, text, reply_markup=keyboards.create_admin_keyboard())
 
-@user_router.callback_query(F.data == "admin_backup")
+@callbacks.route("admin_backup")
 async def admin_backup_handler(callback: types.CallbackQuery):
     if str(callback.from_user.id) != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True)
@@ -620,7 +697,7 @@ async def admin_backup_handler(callback: types.CallbackQuery):
     
     # Изменяем сообщение, чтобы показать прогресс
     try:
-        await callback.message.edit_text("⏳ Создание бэкапа...", reply_markup=None)
+        await outbound.edit_text(callback.message, "⏳ Создание бэкапа...", reply_markup=None)
     except Exception:
         pass  # Игнорируем ошибки редактирования
     
@@ -633,30 +710,31 @@ async def admin_backup_handler(callback: types.CallbackQuery):
         final_text = "❌ Ошибка создания бэкапа. Проверьте логи."
     
     try:
-        await callback.message.edit_text(final_text, reply_markup=keyboards.create_admin_keyboard())
+        await outbound.edit_text(callback.message, final_text, reply_markup=keyboards.create_admin_keyboard())
     except Exception:
         # Если не удается отредактировать, отправляем новое сообщение
         await callback.message.answer(final_text, reply_markup=keyboards.create_admin_keyboard())
 
-@user_router.callback_query(F.data == "admin_promos")
+@callbacks.route("admin_promos")
 async def admin_promos_menu(callback: types.CallbackQuery):
     if str(callback.from_user.id) != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True); return
     await callback.answer()
-    await callback.message.edit_text("Управление промокодами:", reply_markup=keyboards.create_admin_promos_keyboard())
+    await outbound.edit_text(callback.message, "Управление промокодами:\n\nМассовый выпуск одноразовых кодов: /bulk_promos", reply_markup=keyboards.create_admin_promos_keyboard())
 
-@user_router.callback_query(F.data == "admin_promo_create")
+@callbacks.route("admin_promo_create")
 async def admin_promo_create_start(callback: types.CallbackQuery, state: FSMContext):
     if str(callback.from_user.id) != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True); return
     await callback.answer()
     await state.set_state(PromoCreate.waiting_for_code)
-    await callback.message.edit_text("Введите код промокода (латиница/цифры):")
+    await outbound.edit_text(callback.message, "Введите код промокода (латиница/цифры):")
 
 @user_router.message(PromoCreate.waiting_for_code)
 async def admin_promo_code(message: types.Message, state: FSMContext):
     code = (message.text or '').strip()
-    if not code or len(code) > 32:
+    # ":" — разделитель в callback_data кнопок постраничного списка
+    if not code or len(code) > 32 or ":" in code:
         await message.answer("Некорректный код, попробуйте снова.")
         return
     await state.update_data(code=code)
@@ -708,115 +786,117 @@ async def admin_promo_limit(message: types.Message, state: FSMContext):
         await message.answer("❌ Ошибка создания промокода.")
     await message.answer("Меню промокодов:", reply_markup=keyboards.create_admin_promos_keyboard())
 
-@user_router.callback_query(F.data == "admin_promo_list")
+async def _show_promos_page(callback: types.CallbackQuery, cursor: int = 0, back: bool = False):
+    # Keyset по rowid: страница любой глубины — один запрос на PROMOS_PAGE_SIZE строк,
+    # а в callback_data — число, а не код с произвольными символами
+    promos, has_more = get_promos_page(cursor, PROMOS_PAGE_SIZE, backward=back)
+    if not promos:
+        await outbound.edit_text(callback.message, "Промокодов нет.", reply_markup=keyboards.create_admin_promos_keyboard())
+        return
+    has_prev, has_next = (has_more, True) if back else (bool(cursor), has_more)
+    lines = ["<b>Список промокодов</b>"]
+    for p in promos:
+        lines.append(f"{html.quote(p['code'])}: {p['discount_percent']}% / +{p['free_days']}д / использовано {p['uses_count']}/{p['uses_limit'] or '∞'} {'✅' if p['active'] else '⛔'}")
+    await outbound.edit_text(callback.message, "\n".join(lines), reply_markup=keyboards.create_admin_promo_list_keyboard(
+        promos[0]['id'], promos[-1]['id'], has_prev, has_next
+    ))
+
+@callbacks.route("admin_promo_list")
 async def admin_promo_list(callback: types.CallbackQuery):
     if str(callback.from_user.id) != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True); return
-    promos = get_all_promos()
-    if not promos:
-        text = "Промокодов нет."
-    else:
-        lines = ["<b>Список промокодов</b>"]
-        for p in promos:
-            lines.append(f"{p['code']}: {p['discount_percent']}% / +{p['free_days']}д / использовано {p['uses_count']}/{p['uses_limit'] or '∞'} {'✅' if p['active'] else '⛔'}")
-        text = "\n".join(lines)
-    await callback.message.edit_text(text, reply_markup=keyboards.create_admin_promos_keyboard())
-
-@user_router.callback_query(F.data.startswith("admin_promo_toggle_"))
-async def admin_promo_toggle(callback: types.CallbackQuery):
+    await callback.answer()
+    await _show_promos_page(callback)
+
+@callbacks.route(PromosPage)
+async def admin_promos_page(callback: types.CallbackQuery, callback_data: PromosPage):
+    if str(callback.from_user.id) != ADMIN_ID:
+        await callback.answer("Нет доступа", show_alert=True); return
+    await callback.answer()
+    await _show_promos_page(callback, callback_data.cursor, callback_data.back)
+
+@callbacks.route(PromoToggle)
+async def admin_promo_toggle(callback: types.CallbackQuery, callback_data: PromoToggle):
     if str(callback.from_user.id) != ADMIN_ID:
         await callback.answer("Нет доступа", show_alert=True); return
-    code = callback.data.split("admin_promo_toggle_")[1]
-    from shop_bot.data_manager.database import get_promo, set_promo_active
-    p = get_promo(code)
-    was_active = bool(p)
-    # Если активен, выключаем; если не найден активный, пробуем включить (существует ли в общем списке)
-    if was_active:
-        set_promo_active(code, False)
-        await callback.answer("Выключено")
+    p = get_promo_by_id(callback_data.promo_id)
+    if not p:
+        await callback.answer("Нет такого кода", show_alert=True)
     else:
-        # нужен доступ к неактивным - получим напрямую
-        import sqlite3
-        from shop_bot.data_manager.database import DB_FILE
-        restored = False
-        try:
-            with sqlite3.connect(DB_FILE) as conn:
-                c = conn.cursor(); c.execute("SELECT code FROM promo_codes WHERE code = ?", (code,))
-                if c.fetchone():
-                    set_promo_active(code, True); restored = True
-        except Exception:
-            pass
-        await callback.answer("Включено" if restored else "Нет такого кода", show_alert=not restored)
+        # Активный выключаем, выключенный включаем
+        active = not p['active']
+        set_promo_active(p['code'], active)
+        await callback.answer("Включено" if active else "Выключено")
     # Обновим список
-    promos = get_all_promos()
-    lines = ["<b>Список промокодов</b>"]
-    for p in promos:
-        lines.append(f"{p['code']}: {p['discount_percent']}% / +{p['free_days']}д / {p['uses_count']}/{p['uses_limit'] or '∞'} {'✅' if p['active'] else '⛔'}")
-    await callback.message.edit_text("\n".join(lines), reply_markup=keyboards.create_admin_promos_keyboard())
+    await _show_promos_page(callback)
 
-@user_router.callback_query(F.data.startswith("show_key_"))
-async def show_key_handler(callback: types.CallbackQuery):
-    key_id_to_show = int(callback.data.split("_")[2])
-    await callback.message.edit_text("Загружаю информацию о ключе...")
+@callbacks.route(ShowKey)
+async def show_key_handler(callback: types.CallbackQuery, callback_data: ShowKey):
+    key_id_to_show = callback_data.key_id
+    await outbound.edit_text(callback.message, "Загружаю информацию о ключе...")
     user_id = callback.from_user.id
     key_data = get_key_by_id(key_id_to_show)
 
     if not key_data or key_data['user_id'] != user_id:
-        await callback.message.edit_text("❌ Ошибка: ключ не найден.")
+        await outbound.edit_text(callback.message, "❌ Ошибка: ключ не найден.")
         return
         
     try:
         # We cannot re-build original without inbound each time; fetch inbound once
         from shop_bot.modules.remnawave_api import get_inbound, build_vless_uri
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
+        async with json_codec.client_session() as session:
             inbound = await get_inbound(session)
             if not inbound:
-                await callback.message.edit_text("❌ Ошибка: inbound не найден.")
+                await outbound.edit_text(callback.message, "❌ Ошибка: inbound не найден.")
                 return
             user_uuid = key_data['vless_uuid']
             email = key_data['key_email']
             connection_string = build_vless_uri(inbound, user_uuid, email)
             if not connection_string:
-                await callback.message.edit_text("❌ Не удалось сгенерировать строку подключения.")
+                await outbound.edit_text(callback.message, "❌ Не удалось сгенерировать строку подключения.")
                 return
         expiry_date = datetime.fromisoformat(key_data['expiry_date'])
         created_date = datetime.fromisoformat(key_data['created_date'])
         all_user_keys = get_user_keys(user_id)
         key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id_to_show), 0)
         final_text = get_key_info_text(key_number, expiry_date, created_date, connection_string)
-        await callback.message.edit_text(text=final_text, reply_markup=keyboards.create_key_info_keyboard(key_id_to_show))
+        await outbound.edit_text(callback.message, text=final_text, reply_markup=keyboards.create_key_info_keyboard(key_id_to_show))
     except Exception as e:
         logger.error(f"Error showing key {key_id_to_show}: {e}")
-        await callback.message.edit_text("❌ Произошла ошибка при получении данных ключа.")
+        await outbound.edit_text(callback.message, "❌ Произошла ошибка при получении данных ключа.")
 
-@user_router.callback_query(F.data.startswith("show_qr_"))
-async def show_qr_handler(callback: types.CallbackQuery):
+@callbacks.route(KeyQR)
+async def show_qr_handler(callback: types.CallbackQuery, callback_data: KeyQR):
     await callback.answer("Генерирую QR-код...")
-    key_id = int(callback.data.split("_")[2])
+    key_id = callback_data.key_id
     key_data = get_key_by_id(key_id)
     if not key_data or key_data['user_id'] != callback.from_user.id: return
     
     try:
         from shop_bot.modules.remnawave_api import get_inbound, build_vless_uri
-        import aiohttp
-        async with aiohttp.ClientSession() as session:
+        async with json_codec.client_session() as session:
             inbound = await get_inbound(session)
             if not inbound: return
             connection_string = build_vless_uri(inbound, key_data['vless_uuid'], key_data['key_email'])
             if not connection_string: return
 
-        qr_img = qrcode.make(connection_string)
-        bio = BytesIO(); qr_img.save(bio, "PNG"); bio.seek(0)
-        qr_code_file = BufferedInputFile(bio.read(), filename="vpn_qr.png")
-        await callback.message.answer_photo(photo=qr_code_file)
+        async def load_qr():
+            # PNG рендерится в пуле потоков и кешируется, цикл событий не блокируется
+            png = await qr.render_png(connection_string, inbound.version)
+            return BufferedInputFile(png, filename="vpn_qr.png")
+
+        # Повторные показы отправляют сохранённый file_id без загрузки PNG
+        await media.send_cached(
+            callback.bot, callback.message.chat.id, "photo",
+            media.cache_key("qr", inbound.version, connection_string), load_qr
+        )
     except Exception as e:
         logger.error(f"Error showing QR for key {key_id}: {e}")
 
-@user_router.callback_query(F.data.startswith("show_instruction_"))
-async def show_instruction_handler(callback: types.CallbackQuery):
+@callbacks.route(KeyInstruction)
+async def show_instruction_handler(callback: types.CallbackQuery, callback_data: KeyInstruction):
     await callback.answer()
-    key_id = int(callback.data.split("_")[2])
+    key_id = callback_data.key_id
 
     instruction_text = (
         "<b>Как подключиться?</b>\n\n"
@@ -828,41 +908,63 @@ async def show_instruction_handler(callback: types.CallbackQuery):
         "3. Посмотреть и полностью прочитать туториал по использованию ключей можно на: https://web.archive.org/web/20250622005028/https://wiki.aeza.net/nekoray-universal-client.\n"
     )
     
-    await callback.message.edit_text(
+    await outbound.edit_text(callback.message, 
         instruction_text,
         reply_markup=keyboards.create_back_to_key_keyboard(key_id),
         disable_web_page_preview=True
     )
 
-@user_router.callback_query(F.data == "buy_new_key")
+@callbacks.route("buy_new_key")
 async def buy_new_key_handler(callback: types.CallbackQuery):
     await callback.answer()
-    await callback.message.edit_text("Выберите тариф для нового ключа:", reply_markup=keyboards.create_plans_keyboard(PLANS, action="new"))
+    await outbound.edit_text(callback.message, "Выберите тариф для нового ключа:", reply_markup=keyboards.create_plans_keyboard(PLANS, action="new"))
 
-@user_router.callback_query(F.data.startswith("extend_key_"))
-async def extend_key_handler(callback: types.CallbackQuery):
-    key_id = int(callback.data.split("_")[2])
+@callbacks.route(ExtendKey)
+async def extend_key_handler(callback: types.CallbackQuery, callback_data: ExtendKey):
+    key_id = callback_data.key_id
     await callback.answer()
-    await callback.message.edit_text("Выберите тариф для продления ключа:", reply_markup=keyboards.create_plans_keyboard(PLANS, action="extend", key_id=key_id))
+    await outbound.edit_text(callback.message, "Выберите тариф для продления ключа:", reply_markup=keyboards.create_plans_keyboard(PLANS, action="extend", key_id=key_id))
 
-@user_router.callback_query(F.data.startswith("buy_") & F.data.contains("_month"))
-async def choose_payment_method_handler(callback: types.CallbackQuery):
+@callbacks.route(ChoosePlan)
+async def choose_payment_method_handler(callback: types.CallbackQuery, callback_data: ChoosePlan):
     await callback.answer()
-    parts = callback.data.split("_")
-    plan_id, action, key_id = "_".join(parts[:-2]), parts[-2], int(parts[-1])
-    await callback.message.edit_text(
+    plan_id, action, key_id = callback_data.plan_id, callback_data.action, callback_data.key_id
+    await outbound.edit_text(callback.message, 
         CHOOSE_PAYMENT_METHOD_MESSAGE,
         reply_markup=keyboards.create_payment_method_keyboard(PAYMENT_METHODS, plan_id, action, key_id)
     )
 
-@user_router.callback_query(F.data.startswith("pay_yookassa_"))
-async def create_yookassa_payment_handler(callback: types.CallbackQuery, state: FSMContext):
+# Повторные нажатия той же кнопки оплаты получают уже выставленный счёт.
+# TTL меньше срока жизни счетов у провайдеров.
+INVOICE_CACHE_TTL_SECONDS = float(os.getenv("INVOICE_CACHE_TTL_SECONDS", "600"))
+_invoice_cache = TTLCache(maxsize=4096, ttl=INVOICE_CACHE_TTL_SECONDS)
+
+def _invoice_key(provider: str, user_id: int, plan_id: str, action: str, key_id: int, promo_code: str | None) -> tuple:
+    return (user_id, plan_id, action, key_id, promo_code or "", provider)
+
+def forget_user_invoices(user_id: int):
+    """После оплаты закешированные счета пользователя больше не действительны."""
+    for key in _invoice_cache.keys():
+        if key[0] == user_id:
+            _invoice_cache.pop(key)
+
+def _create_order(provider: str, user_id: int, plan_id: str, action: str, key_id: int, months: int,
+                  price, promo_code: str | None, chat_id: int, message_id: int) -> str:
+    """Сохраняет заказ в pending_orders и возвращает короткий order_id для счёта."""
+    order_id = secrets.token_urlsafe(12)
+    stored = create_pending_order(order_id, {
+        "user_id": user_id, "provider": provider, "plan_id": plan_id, "action": action,
+        "key_id": key_id, "months": months, "price": float(price), "promo_code": promo_code,
+        "chat_id": chat_id, "message_id": message_id,
+    })
+    if not stored:
+        raise RuntimeError("Failed to store pending order")
+    return order_id
+
+async def create_yookassa_payment_handler(callback: types.CallbackQuery, callback_data: Pay, state: FSMContext):
     await callback.answer("Создаю ссылку на оплату...")
     
-    parts = callback.data.split("_")[2:]
-    plan_id = "_".join(parts[:-2])
-    action = parts[-2]
-    key_id = int(parts[-1])
+    plan_id, action, key_id = callback_data.plan_id, callback_data.action, callback_data.key_id
     
     if plan_id not in PLANS:
         await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -889,21 +991,26 @@ async def create_yookassa_payment_handler(callback: types.CallbackQuery, state:
                 disc = promo.get('discount_percent', 0)
                 if disc and 0 < disc < 100:
                     amount_value = f"{float(price_rub) * (100-disc)/100:.2f}"
-        payment = Payment.create({
-            "amount": {"value": amount_value, "currency": "RUB"},
-            "confirmation": {"type": "redirect", "return_url": f"https://t.me/{TELEGRAM_BOT_USERNAME}"},
-            "capture": True, "description": description,
-            "metadata": {
-                "user_id": user_id, "months": months, "price": amount_value,
-                "action": action, "key_id": key_id,
-                "chat_id": chat_id_to_delete, "message_id": message_id_to_delete,
-                "plan_id": plan_id,
-                "promo_code": promo_code
-            }
-        }, uuid.uuid4())
-        await callback.message.edit_text(
+        invoice_key = _invoice_key("yookassa", user_id, plan_id, action, key_id, promo_code)
+        payment_url = _invoice_cache.get(invoice_key)
+        if not payment_url:
+            order_id = _create_order("yookassa", user_id, plan_id, action, key_id, months, amount_value, promo_code,
+                                     chat_id_to_delete, message_id_to_delete)
+            payment = await yookassa_api.create_payment({
+                "amount": {"value": str(amount_value), "currency": "RUB"},
+                "confirmation": {"type": "redirect", "return_url": f"https://t.me/{TELEGRAM_BOT_USERNAME}"},
+                "capture": True, "description": description,
+                "metadata": {"order_id": order_id}
+            }, order_id)
+            payment_url = yookassa_api.confirmation_url(payment)
+            if not payment_url:
+                raise RuntimeError("YooKassa returned no confirmation URL")
+            # id нужен сверке на случай потери вебхука
+            set_pending_order_payment_id(order_id, payment["id"])
+            _invoice_cache.set(invoice_key, payment_url)
+        await outbound.edit_text(callback.message, 
             "Нажмите на кнопку ниже для оплаты:",
-            reply_markup=keyboards.create_payment_keyboard(payment.confirmation.confirmation_url)
+            reply_markup=keyboards.create_payment_keyboard(payment_url)
         )
     except Exception as e:
         logger.error(f"Failed to create YooKassa payment: {e}", exc_info=True)
@@ -942,15 +1049,10 @@ def create_heleket_signature(payload: dict, api_key: str) -> str:
     
     return hashlib.sha256(string_to_hash.encode('utf-8')).hexdigest()
 
-@user_router.callback_query(F.data.startswith("pay_crypto_"))
-async def create_crypto_payment_handler(callback: types.CallbackQuery, state: FSMContext):
+async def create_crypto_payment_handler(callback: types.CallbackQuery, callback_data: Pay, state: FSMContext):
     await callback.answer("Создаю счет для оплаты в криптовалюте...")
     
-    # Ваша логика парсинга callback.data остается без изменений
-    parts = callback.data.split("_")[2:]
-    plan_id = "_".join(parts[:-2])
-    action = parts[-2]
-    key_id = int(parts[-1])
+    plan_id, action, key_id = callback_data.plan_id, callback_data.action, callback_data.key_id
 
     if plan_id not in PLANS:
         await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -971,7 +1073,7 @@ async def create_crypto_payment_handler(callback: types.CallbackQuery, state: FS
         else:
             description = f"Оплата подписки на {months} месяцев"
             
-        async with aiohttp.ClientSession() as session:
+        async with json_codec.client_session() as session:
             # 1. Формируем payload со всеми необходимыми полями
             data_state = await state.get_data()
             promo_code = data_state.get('promo_code')
@@ -982,25 +1084,28 @@ async def create_crypto_payment_handler(callback: types.CallbackQuery, state: FS
                     disc = promo.get('discount_percent', 0)
                     if disc and 0 < disc < 100:
                         amount_value = round(float(price_rub) * (100-disc)/100, 2)
+            invoice_key = _invoice_key("heleket", user_id, plan_id, action, key_id, promo_code)
+            cached_url = _invoice_cache.get(invoice_key)
+            if cached_url:
+                await outbound.edit_text(callback.message, 
+                    "✅ Счет создан!\n\nНажмите на кнопку ниже для оплаты криптовалютой:",
+                    reply_markup=keyboards.create_payment_keyboard(cached_url)
+                )
+                return
+            order_id = _create_order("heleket", user_id, plan_id, action, key_id, months, amount_value, promo_code,
+                                     callback.message.chat.id, callback.message.message_id)
             payload = {
                 # ---- Поля, участвующие в подписи ----
                 "merchant_id": CRYPTO_MERCHANT_ID,
                 "amount": amount_value, # со скидкой при наличии
                 "currency": "RUB",
-                "order_id": str(uuid.uuid4()),
+                "order_id": order_id,
                 "description": description,
                 "callback_url": crypto_webhook_url,
                 "success_url": f"https://t.me/{bot_username}",
                 "fail_url": f"https://t.me/{bot_username}",
                 # ---- Поля, НЕ участвующие в подписи ----
-                "metadata": {
-                    "user_id": user_id, "months": months, "price": amount_value, 
-                    "action": action, "key_id": key_id,
-                    "chat_id": callback.message.chat.id, 
-                    "message_id": callback.message.message_id,
-                    "plan_id": plan_id,
-                    "promo_code": promo_code
-                }
+                "metadata": {"order_id": order_id}
             }
 
             # 2. Создаем подпись с помощью нашей новой, надежной функции
@@ -1016,37 +1121,36 @@ async def create_crypto_payment_handler(callback: types.CallbackQuery, state: FS
             # logger.info(f"Sending payload to Heleket: {payload}")
             
             async with session.post(api_url, json=payload, headers=headers) as response:
-                response_text = await response.text()
+                raw, data = await json_codec.read_json(response)
+                response_text = json_codec.preview(raw, 1000)
                 
                 if response.status == 201:
-                    data = json.loads(response_text)
-                    payment_url = data.get("pay_url")
+                    payment_url = (data or {}).get("pay_url")
                     
                     if not payment_url:
                         logger.error(f"Heleket API success, but no pay_url in response: {response_text}")
-                        await callback.message.edit_text("❌ Ошибка получения ссылки на оплату.")
+                        await outbound.edit_text(callback.message, "❌ Ошибка получения ссылки на оплату.")
                         return
+                    if (data or {}).get("uuid"):
+                        set_pending_order_payment_id(order_id, data["uuid"])
+                    _invoice_cache.set(invoice_key, payment_url)
 
-                    await callback.message.edit_text(
+                    await outbound.edit_text(callback.message, 
                         "✅ Счет создан!\n\nНажмите на кнопку ниже для оплаты криптовалютой:",
                         reply_markup=keyboards.create_payment_keyboard(payment_url)
                     )
                 else:
                     logger.error(f"Heleket API error: {response.status} - {response_text}")
-                    await callback.message.edit_text("❌ Не удалось создать счет для оплаты криптовалютой.")
+                    await outbound.edit_text(callback.message, "❌ Не удалось создать счет для оплаты криптовалютой.")
 
     except Exception as e:
         logger.error(f"Exception during crypto payment creation: {e}", exc_info=True)
-        await callback.message.edit_text("❌ Произошла критическая ошибка. Попробуйте позже.")
+        await outbound.edit_text(callback.message, "❌ Произошла критическая ошибка. Попробуйте позже.")
 
-@user_router.callback_query(F.data.startswith("pay_stars_"))
-async def create_stars_payment_handler(callback: types.CallbackQuery, state: FSMContext, bot: Bot):
+async def create_stars_payment_handler(callback: types.CallbackQuery, callback_data: Pay, state: FSMContext):
     await callback.answer("Создаю счет для оплаты звездами...")
     
-    parts = callback.data.split("_")[2:]
-    plan_id = "_".join(parts[:-2])
-    action = parts[-2]
-    key_id = int(parts[-1])
+    plan_id, action, key_id = callback_data.plan_id, callback_data.action, callback_data.key_id
     
     if plan_id not in PLANS:
         await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1082,27 +1186,22 @@ async def create_stars_payment_handler(callback: types.CallbackQuery, state: FSM
         # Создаем инвойс для Telegram Stars
         from aiogram.types import LabeledPrice
         
-        # Telegram Stars payload ограничен 128 байтами, поэтому минимизируем данные
-        payload_data = {
-            "u": user_id,  # user_id
-            "m": months,   # months
-            "p": amount_value,  # price
-            "a": action,   # action
-            "k": key_id,   # key_id
-            "pl": plan_id, # plan_id
-            "pr": promo_code[:10] if promo_code else None,  # promo_code (первые 10 символов)
-            "c": callback.message.chat.id,  # chat_id
-            "mid": callback.message.message_id  # message_id
-        }
-        
-        invoice = await bot.create_invoice_link(
-            title=f"VPN подписка - {name}",
-            description=description,
-            payload=json.dumps(payload_data, separators=(',', ':')),  # без пробелов
-            provider_token="",  # Для Telegram Stars токен должен быть пустым
-            currency="XTR",  # Telegram Stars currency
-            prices=[LabeledPrice(label=name, amount=stars_amount)]
-        )
+        invoice_key = _invoice_key("stars", user_id, plan_id, action, key_id, promo_code)
+        invoice = _invoice_cache.get(invoice_key)
+        if not invoice:
+            # Параметры заказа хранятся на сервере, в payload (до 128 байт) — только order_id
+            order_id = _create_order("stars", user_id, plan_id, action, key_id, months, amount_value, promo_code,
+                                     callback.message.chat.id, callback.message.message_id)
+
+            invoice = await callback.bot.create_invoice_link(
+                title=f"VPN подписка - {name}",
+                description=description,
+                payload=order_id,
+                provider_token="",  # Для Telegram Stars токен должен быть пустым
+                currency="XTR",  # Telegram Stars currency
+                prices=[LabeledPrice(label=name, amount=stars_amount)]
+            )
+            _invoice_cache.set(invoice_key, invoice)
         
         # Создаем инлайн-кнопку для оплаты
         from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -1110,7 +1209,7 @@ async def create_stars_payment_handler(callback: types.CallbackQuery, state: FSM
             [InlineKeyboardButton(text=f"💫 Оплатить {stars_amount} звездами", url=invoice)]
         ])
         
-        await callback.message.edit_text(
+        await outbound.edit_text(callback.message, 
             f"💫 Оплата звездами Telegram\n\n"
             f"Стоимость: {stars_amount} ⭐\n"
             f"Период: {months} мес.\n\n"
@@ -1122,6 +1221,20 @@ async def create_stars_payment_handler(callback: types.CallbackQuery, state: FSM
         logger.error(f"Failed to create Telegram Stars payment: {e}", exc_info=True)
         await callback.message.answer("Не удалось создать счет для оплаты звездами.")
 
+_PAYMENT_HANDLERS = {
+    "yookassa": create_yookassa_payment_handler,
+    "crypto": create_crypto_payment_handler,
+    "stars": create_stars_payment_handler,
+}
+
+@callbacks.route(Pay)
+async def pay_handler(callback: types.CallbackQuery, callback_data: Pay, state: FSMContext):
+    handler = _PAYMENT_HANDLERS.get(callback_data.method)
+    if handler is None:
+        await callback.answer("Способ оплаты недоступен.", show_alert=True)
+        return
+    await handler(callback, callback_data, state)
+
 @user_router.pre_checkout_query()
 async def pre_checkout_handler(pre_checkout_query: types.PreCheckoutQuery):
     """Обрабатываем предварительную проверку платежа звездами"""
@@ -1136,139 +1249,232 @@ async def successful_payment_handler(message: types.Message, bot: Bot):
         user_id = message.from_user.id
         bot_logger.payment(user_id, "TELEGRAM_STARS", payment.total_amount, "RECEIVED")
         
-        payload_data = json.loads(payment.invoice_payload)
-        
-        # Конвертируем сокращенные ключи обратно в полные для совместимости с process_successful_payment
-        metadata = {
-            "user_id": payload_data.get("u"),
-            "months": payload_data.get("m"),
-            "price": payload_data.get("p"),
-            "action": payload_data.get("a"),
-            "key_id": payload_data.get("k"),
-            "plan_id": payload_data.get("pl"),
-            "promo_code": payload_data.get("pr"),
-            "chat_id": payload_data.get("c"),
-            "message_id": payload_data.get("mid")
-        }
-        
-        logger.info(f"Converted metadata: {metadata}")
-        await process_successful_payment(bot, metadata)
-        bot_logger.payment(user_id, "TELEGRAM_STARS", payment.total_amount, "SUCCESS")
+        if payment.invoice_payload.startswith("{"):
+            # Счета, выставленные до перехода на pending_orders: сокращённые ключи в JSON
+            payload_data = json_codec.loads(payment.invoice_payload)
+            metadata = {
+                "user_id": payload_data.get("u"),
+                "months": payload_data.get("m"),
+                "price": payload_data.get("p"),
+                "action": payload_data.get("a"),
+                "key_id": payload_data.get("k"),
+                "plan_id": payload_data.get("pl"),
+                "promo_code": payload_data.get("pr"),
+                "chat_id": payload_data.get("c"),
+                "message_id": payload_data.get("mid")
+            }
+        else:
+            metadata = {"order_id": payment.invoice_payload}
+        # Запись в очередь синхронная (SQLite, блокировка потоков вебхука) — не в цикле событий
+        await asyncio.to_thread(fulfilment.enqueue, "stars", payment.telegram_payment_charge_id, metadata)
+        bot_logger.payment(user_id, "TELEGRAM_STARS", payment.total_amount, "QUEUED")
     except Exception as e:
         bot_logger.payment(message.from_user.id, "TELEGRAM_STARS", payment.total_amount, "FAILED")
         logger.error(f"Error processing stars payment: {e}", exc_info=True)
         await message.answer("❌ Ошибка при обработке платежа. Обратитесь в поддержку.")
 
-async def process_successful_payment(bot: Bot, metadata: dict):
-    user_id, months, price, action, key_id = map(metadata.get, ['user_id', 'months', 'price', 'action', 'key_id'])
-    user_id, months, price, key_id = int(user_id), int(months or 0), float(price), int(key_id)
-    promo_code = metadata.get('promo_code')
-    plan_id_meta = metadata.get('plan_id')
-    chat_id_to_delete = metadata.get('chat_id')
-    message_id_to_delete = metadata.get('message_id')
-    
-    bot_logger.user_action(user_id, "PAYMENT_PROCESSING", f"{action} {months}m {price}₽")
-    
-    if chat_id_to_delete and message_id_to_delete:
+async def _set_payment_status(bot: Bot, user_id: int, job: fulfilment.PaymentJob, text: str):
+    # Сообщение о статусе правится только здесь, по id из шага 'status_message'
+    message_id = job.step('status_message')
+    if not message_id:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=user_id, message_id=int(message_id))
+    except TelegramAPIError as e:
+        logger.warning(f"Could not update payment status message: {e}")
+
+async def _payment_failed(bot: Bot, user_id: int, job: fulfilment.PaymentJob, text: str, permanent: bool = False) -> str:
+    """Неудачная попытка. Ошибку пользователь видит, только когда повторов больше не будет."""
+    if permanent or job.last_attempt:
+        await _set_payment_status(bot, user_id, job, text)
+    return fulfilment.FAILED if permanent else fulfilment.RETRY
+
+async def _send_payment_result(bot: Bot, user_id: int, job: fulfilment.PaymentJob, text: str, reply_markup=None):
+    message_id = job.step('status_message')
+    if message_id:
         try:
-            await bot.delete_message(chat_id=chat_id_to_delete, message_id=message_id_to_delete)
-        except TelegramBadRequest as e:
-            logger.warning(f"Could not delete payment message: {e}")
+            await bot.delete_message(chat_id=user_id, message_id=int(message_id))
+        except TelegramAPIError as e:
+            logger.warning(f"Could not delete payment status message: {e}")
+    try:
+        await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Заказ уже выдан, повтор попытки сообщение не доставит
+        logger.warning(f"Could not send payment result to {user_id}: {e}")
+    await job.done('notified')
+
+async def process_successful_payment(bot: Bot, metadata: dict, job: fulfilment.PaymentJob) -> str:
+    """Выдаёт оплаченный заказ. Вызывается воркерами очереди fulfilment.
+
+    Каждый шаг отмечается в job, и повторная попытка продолжает с места сбоя:
+    сообщение «Оплата получена» отправляется один раз, номер нового ключа и
+    расчёт дней (промокод, реферальный бонус) фиксируются до обращения к панели,
+    а промокод и бонусы учитываются только после того, как ключ выдан и записан.
+    """
+    try:
+        user_id = int(metadata['user_id'])
+        months = int(metadata.get('months') or 0)
+        price = float(metadata.get('price') or 0)
+        key_id = int(metadata.get('key_id') or 0)
+    except (KeyError, TypeError, ValueError):
+        logger.error(f"Payment {job.provider}:{job.payment_id} has unusable metadata: {metadata}")
+        return fulfilment.FAILED
+    action = metadata.get('action')
+
+    if job.step('status_message') is None:
+        bot_logger.user_action(user_id, "PAYMENT_PROCESSING", f"{action} {months}m {price}₽")
+        forget_user_invoices(user_id)
+        chat_id_to_delete = metadata.get('chat_id')
+        message_id_to_delete = metadata.get('message_id')
+        if chat_id_to_delete and message_id_to_delete:
+            try:
+                await bot.delete_message(chat_id=chat_id_to_delete, message_id=message_id_to_delete)
+            except TelegramBadRequest as e:
+                logger.warning(f"Could not delete payment message: {e}")
+        try:
+            processing_message = await bot.send_message(chat_id=user_id, text="✅ Оплата получена! Обрабатываю ваш запрос...")
+            status_message_id = str(processing_message.message_id)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            logger.warning(f"Could not send payment status to {user_id}: {e}")
+            status_message_id = ""
+        await job.done('status_message', status_message_id)
 
-    processing_message = await bot.send_message(chat_id=user_id, text="✅ Оплата получена! Обрабатываю ваш запрос...")
     try:
         if action == 'pack':
-            # find GB amount from TRAFFIC_PACKS
-            pack = TRAFFIC_PACKS.get(metadata.get('plan_id') or metadata.get('pack_id') or metadata.get('action_id') or '')
-            if not pack:
-                # fallback parse plan id from metadata (YooKassa doesn't add plan id separately, so months misused). We encoded pack id as plan_id
-                pack_id = metadata.get('plan_id') or metadata.get('pack_id') or metadata.get('action')
-                pack = TRAFFIC_PACKS.get(pack_id, None)
-            if not pack:
-                await processing_message.edit_text("❌ Пакет трафика не найден.")
-                return
-            title, price_label, gb = pack
-            key_data = get_key_by_id(key_id)
-            if not key_data or key_data['user_id'] != user_id:
-                await processing_message.edit_text("❌ Ключ для добавления трафика не найден.")
-                return
-            email = key_data['key_email']
-            server_ok = await add_extra_traffic(email, gb)
-            if server_ok:
-                add_traffic_extra(key_id, gb)
-                log_action(user_id, 'traffic_pack', f"{key_id}:{gb}")
-                await processing_message.delete()
-                await bot.send_message(user_id, f"✅ Доп. трафик {gb} ГБ добавлен к ключу #{key_id}.")
-            else:
-                await processing_message.edit_text("❌ Не удалось обновить лимит на сервере.")
-            return
-        days_to_add = months * 30
-        email = ""
-        key_number = 0
-        if action == "new":
+            return await _fulfil_traffic_pack(bot, metadata, job, user_id, key_id)
+        if action in ('new', 'extend'):
+            return await _fulfil_subscription(bot, metadata, job, user_id, months, price, action, key_id)
+        logger.error(f"Payment {job.provider}:{job.payment_id} has unknown action {action!r}")
+        return await _payment_failed(bot, user_id, job, "❌ Неизвестный тип заказа. Обратитесь в поддержку.", permanent=True)
+    except Exception as e:
+        logger.error(f"Error processing payment for user {user_id}: {e}", exc_info=True)
+        return await _payment_failed(bot, user_id, job, "❌ Ошибка при выдаче ключа.")
+
+async def _fulfil_traffic_pack(bot: Bot, metadata: dict, job: fulfilment.PaymentJob, user_id: int, key_id: int) -> str:
+    pack = TRAFFIC_PACKS.get(metadata.get('plan_id') or metadata.get('pack_id') or metadata.get('action_id') or '')
+    if not pack:
+        return await _payment_failed(bot, user_id, job, "❌ Пакет трафика не найден.", permanent=True)
+    title, price_label, gb = pack
+    key_data = get_key_by_id(key_id)
+    if not key_data or key_data['user_id'] != user_id:
+        return await _payment_failed(bot, user_id, job, "❌ Ключ для добавления трафика не найден.", permanent=True)
+
+    if job.step('provisioned') is None:
+        target = job.step('panel_target')
+        server_ok = await add_extra_traffic(
+            key_data['key_email'], gb, telegram_id=str(user_id),
+            target_limit=int(target) if target else None,
+            on_target=lambda limit: job.done('panel_target', str(limit)),
+        )
+        if not server_ok:
+            return await _payment_failed(bot, user_id, job, "❌ Не удалось обновить лимит на сервере.")
+        await job.done('provisioned')
+    if job.step('recorded') is None:
+        add_traffic_extra(key_id, gb)
+        log_action(user_id, 'traffic_pack', f"{key_id}:{gb}")
+        await job.done('recorded')
+    if job.step('notified') is None:
+        await _send_payment_result(bot, user_id, job, f"✅ Доп. трафик {gb} ГБ добавлен к ключу #{key_id}.")
+    return fulfilment.FULFILLED
+
+async def _fulfil_subscription(bot: Bot, metadata: dict, job: fulfilment.PaymentJob, user_id: int, months: int,
+                               price: float, action: str, key_id: int) -> str:
+    promo_code = metadata.get('promo_code')
+    plan_id_meta = metadata.get('plan_id')
+    if action == "extend":
+        key_data = get_key_by_id(key_id)
+        if not key_data or key_data['user_id'] != user_id:
+            return await _payment_failed(bot, user_id, job, "❌ Ошибка: ключ для продления не найден.", permanent=True)
+        email = key_data['key_email']
+    else:
+        # Номер нового ключа выбирается один раз: повтор не заведёт второй ключ
+        email = job.step('email')
+        if email is None:
             key_number = get_next_key_number(user_id)
+            while get_key_by_email(f"user{user_id}-key{key_number}@kitsura.fun"):
+                key_number += 1
             email = f"user{user_id}-key{key_number}@kitsura.fun"
-        elif action == "extend":
-            key_data = get_key_by_id(key_id)
-            if not key_data or key_data['user_id'] != user_id:
-                await processing_message.edit_text("❌ Ошибка: ключ для продления не найден.")
-                return
-            all_user_keys = get_user_keys(user_id)
-            key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), 0)
-            email = key_data['key_email']
-        # Promo / referral adjustments
-        if promo_code:
-            promo = get_promo(promo_code)
-            if promo:
-                free_days = promo.get('free_days', 0)
-                discount_percent = promo.get('discount_percent', 0)
-                if free_days:
-                    days_to_add += free_days
-                if discount_percent and discount_percent > 0 and discount_percent < 100:
-                    discounted = round(price * (100 - discount_percent) / 100, 2)
-                    log_action(user_id, 'price_discount_applied', f"{price}->{discounted}({discount_percent}%)")
-                    price = discounted
-                apply_promo_usage(promo_code)
-                log_action(user_id, 'promo_used', promo_code)
+            await job.done('email', email)
+
+    # Дни и цена считаются один раз: на повторе has_action('first_purchase') уже не тот
+    plan = job.step('plan')
+    if plan is None:
+        plan = {'days': months * 30, 'price': price, 'promo': False, 'discount': None, 'first_purchase': False, 'referrer': None}
+        promo = get_promo(promo_code) if promo_code else None
+        if promo:
+            plan['promo'] = True
+            plan['days'] += promo.get('free_days', 0) or 0
+            discount_percent = promo.get('discount_percent', 0)
+            if discount_percent and 0 < discount_percent < 100:
+                discounted = round(price * (100 - discount_percent) / 100, 2)
+                plan['discount'] = f"{price}->{discounted}({discount_percent}%)"
+                plan['price'] = discounted
         if not has_action(user_id, 'first_purchase'):
-            log_action(user_id, 'first_purchase')
+            plan['first_purchase'] = True
             u = get_user(user_id)
-            referrer_code = u.get('referred_by') if u else None
-            if referrer_code:
-                days_to_add += 3
-                log_action(user_id, 'ref_bonus_received', referrer_code)
+            plan['referrer'] = u.get('referred_by') if u else None
+            if plan['referrer']:
+                plan['days'] += 3
+        await job.done('plan', json_codec.dumps(plan))
+    else:
+        plan = json_codec.loads(plan)
+
+    provisioned = job.step('provisioned')
+    if provisioned is None:
         uri, expire_iso, vless_uuid = await remnawave_api.provision_key(
-            email, 
-            days=days_to_add, 
-            telegram_id=str(user_id)
+            email,
+            days=plan['days'],
+            telegram_id=str(user_id),
+            target_expiry=job.step('panel_target'),
+            on_target=lambda iso: job.done('panel_target', iso),
         )
         if not uri or not expire_iso or not vless_uuid:
-            await processing_message.edit_text("❌ Не удалось создать/обновить ключ.")
-            return
-        expiry_dt = datetime.fromisoformat(expire_iso.replace('Z', '+00:00'))
-        expiry_ms = int(expiry_dt.timestamp() * 1000)
+            return await _payment_failed(bot, user_id, job, "❌ Не удалось создать/обновить ключ.")
+        await job.done('provisioned', json_codec.dumps({'uri': uri, 'expire_at': expire_iso, 'vless_uuid': vless_uuid}))
+    else:
+        provisioned = json_codec.loads(provisioned)
+        uri, expire_iso, vless_uuid = provisioned['uri'], provisioned['expire_at'], provisioned['vless_uuid']
+    expiry_dt = datetime.fromisoformat(expire_iso.replace('Z', '+00:00'))
+    expiry_ms = int(expiry_dt.timestamp() * 1000)
+
+    saved_key_id = job.step('key_saved')
+    if saved_key_id is None:
         if action == "new":
-            key_id = add_new_key(user_id, vless_uuid, email, expiry_ms)
-            if plan_id_meta:
-                from shop_bot.data_manager.database import set_key_plan
-                set_key_plan(key_id, plan_id_meta)
-        elif action == "extend":
+            # Ключ мог быть записан попыткой, упавшей до отметки шага
+            existing = get_key_by_email(email)
+            key_id = existing['key_id'] if existing else add_new_key(user_id, vless_uuid, email, expiry_ms)
+            if not key_id:
+                return await _payment_failed(bot, user_id, job, "❌ Ошибка при сохранении ключа.")
+        else:
             update_key_info(key_id, vless_uuid, expiry_ms)
-            if plan_id_meta:
-                from shop_bot.data_manager.database import set_key_plan
-                set_key_plan(key_id, plan_id_meta)
-        update_user_stats(user_id, price, months)
+        if plan_id_meta:
+            set_key_plan(key_id, plan_id_meta)
+        await job.done('key_saved', str(key_id))
+    else:
+        key_id = int(saved_key_id)
+
+    if job.step('recorded') is None:
+        if plan['promo']:
+            if plan['discount']:
+                log_action(user_id, 'price_discount_applied', plan['discount'])
+            apply_promo_usage(promo_code)
+            log_action(user_id, 'promo_used', promo_code)
+        if plan['first_purchase']:
+            log_action(user_id, 'first_purchase')
+            if plan['referrer']:
+                log_action(user_id, 'ref_bonus_received', plan['referrer'])
+        update_user_stats(user_id, plan['price'], months)
         if promo_code:
-            log_action(user_id, 'purchase_with_promo', f"{promo_code}:{price}:{months}")
+            log_action(user_id, 'purchase_with_promo', f"{promo_code}:{plan['price']}:{months}")
         else:
-            log_action(user_id, 'purchase', f"{price}:{months}")
-        await processing_message.delete()
+            log_action(user_id, 'purchase', f"{plan['price']}:{months}")
+        await job.done('recorded')
+
+    if job.step('notified') is None:
+        key_number = next((i + 1 for i, key in enumerate(get_user_keys(user_id)) if key['key_id'] == key_id), 0)
         final_text = get_purchase_success_text(action=action, key_number=key_number, expiry_date=expiry_dt, connection_string=uri)
-        await bot.send_message(chat_id=user_id, text=final_text, reply_markup=keyboards.create_key_info_keyboard(key_id))
-    # FSM промокода очищается после применения при вводе; отдельное хранение не требуется.
-    except Exception as e:
-        logger.error(f"Error processing payment for user {user_id}: {e}", exc_info=True)
-        await processing_message.edit_text("❌ Ошибка при выдаче ключа.")
+        await _send_payment_result(bot, user_id, job, final_text, keyboards.create_key_info_keyboard(key_id))
+    return fulfilment.FULFILLED
 
 @user_router.message(F.text)
 async def unknown_message_handler(message: types.Message):
@@ -1,17 +1,62 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from datetime import datetime
+import functools
+from shop_bot.bot.callbacks import (
+    BuyPack, ChoosePlan, EditSetting, ExtendKey, KeyInstruction, KeyQR, KeysPage, Pay, PromosPage, PromoToggle,
+    ShowKey, TrafficPacks
+)
+from shop_bot.utils.cache import LRUCache
 import os
 import dotenv
 
 dotenv.load_dotenv()
 
+# Клавиатуры и экраны, зависящие только от конфигурации и пары параметров,
+# строятся один раз на версию конфигурации; смена настроек в админке
+# повышает версию (invalidate_cache), и всё строится заново.
+_config_version = 0
+_render_cache = LRUCache(maxsize=2048)
+
+def invalidate_cache():
+    global _config_version
+    _config_version += 1
+    _render_cache.clear()
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def cached_render(func):
+    """Мемоизирует результат по аргументам и версии конфигурации.
+
+    Возвращается один и тот же объект, поэтому его нельзя изменять.
+    Исходная функция без кеша доступна как func.__wrapped__.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, _config_version, _freeze(args), _freeze(kwargs))
+        result = _render_cache.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            _render_cache.set(key, result)
+        return result
+    return wrapper
+
 main_reply_keyboard = ReplyKeyboardMarkup(
     keyboard=[[KeyboardButton(text="🏠 Главное меню")]],
     resize_keyboard=True
 )
 
 def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin: bool, auto_renew: bool = False) -> InlineKeyboardMarkup:
+    # От списка ключей в меню нужно только их число
+    return _main_menu_keyboard(len(user_keys), trial_available, is_admin, auto_renew)
+
+@cached_render
+def _main_menu_keyboard(keys_count: int, trial_available: bool, is_admin: bool, auto_renew: bool) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     
     if trial_available:
@@ -22,7 +67,7 @@ def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin:
     builder.button(text="🎟 Промокод", callback_data="enter_promo")
     builder.button(text="👥 Рефералы", callback_data="show_referrals")
     builder.button(text=f"🔁 Автопродление: {'ON' if auto_renew else 'OFF'}", callback_data="toggle_autorenew")
-    builder.button(text=f"🔑 Мои ключи ({len(user_keys)})", callback_data="manage_keys")
+    builder.button(text=f"🔑 Мои ключи ({keys_count})", callback_data="manage_keys")
 
     builder.button(text="🆘 Поддержка", callback_data="show_help")
 
@@ -37,13 +82,14 @@ def create_main_menu_keyboard(user_keys: list, trial_available: bool, is_admin:
     
     return builder.as_markup()
 
+@cached_render
 def create_admin_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    builder.button(text="📝 Изменить 'О проекте'", callback_data="admin_edit_about")
-    builder.button(text="📄 Изменить ссылку 'Условия'", callback_data="admin_edit_terms")
-    builder.button(text="🔒 Изменить ссылку 'Политика'", callback_data="admin_edit_privacy")
-    builder.button(text="🆘 Изменить ссылку 'Поддержка'", callback_data="admin_edit_support_user")
-    builder.button(text="🆘 Изменить текст 'Поддержка'", callback_data="admin_edit_support_text")
+    builder.button(text="📝 Изменить 'О проекте'", callback_data=EditSetting(field="about"))
+    builder.button(text="📄 Изменить ссылку 'Условия'", callback_data=EditSetting(field="terms"))
+    builder.button(text="🔒 Изменить ссылку 'Политика'", callback_data=EditSetting(field="privacy"))
+    builder.button(text="🆘 Изменить ссылку 'Поддержка'", callback_data=EditSetting(field="support_user"))
+    builder.button(text="🆘 Изменить текст 'Поддержка'", callback_data=EditSetting(field="support_text"))
     builder.button(text="🎟 Промокоды", callback_data="admin_promos")
     builder.button(text="📈 Статистика", callback_data="admin_stats")
     builder.button(text="💾 Создать бэкап", callback_data="admin_backup")
@@ -51,11 +97,13 @@ def create_admin_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_admin_cancel_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="❌ Отмена", callback_data="admin_cancel_edit")
     return builder.as_markup()
 
+@cached_render
 def create_about_keyboard(terms_url: str, privacy_url: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="📄 Условия использования", url=terms_url)
@@ -64,6 +112,7 @@ def create_about_keyboard(terms_url: str, privacy_url: str) -> InlineKeyboardMar
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_about_keyboard_terms(terms_url: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="📄 Условия использования", url=terms_url)
@@ -71,6 +120,7 @@ def create_about_keyboard_terms(terms_url: str) -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_about_keyboard_privacy(privacy_url: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="🔒 Политика конфиденциальности", url=privacy_url)
@@ -78,6 +128,7 @@ def create_about_keyboard_privacy(privacy_url: str) -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_support_keyboard(support_user: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="🆘 Написать в поддержку", url=support_user)
@@ -85,34 +136,32 @@ def create_support_keyboard(support_user: str) -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_plans_keyboard(plans: dict, action: str, key_id: int = 0) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for plan_id, (name, price_rub, _) in plans.items():
-        callback_data = f"{plan_id}_{action}_{key_id}"
-        builder.button(text=f"{name} - {float(price_rub):.0f} RUB", callback_data=callback_data)
+        builder.button(text=f"{name} - {float(price_rub):.0f} RUB", callback_data=ChoosePlan(plan_id=plan_id, action=action, key_id=key_id))
     builder.button(text="⬅️ Назад к списку ключей", callback_data="manage_keys")
     builder.adjust(1) 
     return builder.as_markup()
 
+@cached_render
 def create_payment_method_keyboard(payment_methods: dict, plan_id: str, action: str, key_id: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     if payment_methods.get("stars"):
-        callback_data = f"pay_stars_{plan_id}_{action}_{key_id}"
-        builder.button(text="⭐ Telegram Stars", callback_data=callback_data)
+        builder.button(text="⭐ Telegram Stars", callback_data=Pay(method="stars", plan_id=plan_id, action=action, key_id=key_id))
     if payment_methods.get("yookassa"):
+        callback_data = Pay(method="yookassa", plan_id=plan_id, action=action, key_id=key_id)
         if os.getenv("SBP_ENABLED") == "true".lower():
-            callback_data = f"pay_yookassa_{plan_id}_{action}_{key_id}"
             builder.button(text="🏦 СБП / Банковская карта", callback_data=callback_data)
         else:
-            callback_data = f"pay_yookassa_{plan_id}_{action}_{key_id}"
             builder.button(text="💳 Банковская карта", callback_data=callback_data)
     if payment_methods.get("crypto"):
-        callback_data = f"pay_crypto_{plan_id}_{action}_{key_id}"
-        builder.button(text="💎 Криптовалюта", callback_data=callback_data)
+        builder.button(text="💎 Криптовалюта", callback_data=Pay(method="crypto", plan_id=plan_id, action=action, key_id=key_id))
     if action == "new":
         builder.button(text="⬅️ Назад к тарифам", callback_data="buy_new_key")
     else:
-        builder.button(text="⬅️ Назад к тарифам", callback_data=f"extend_key_{key_id}")
+        builder.button(text="⬅️ Назад к тарифам", callback_data=ExtendKey(key_id=key_id))
     builder.adjust(1)
     return builder.as_markup()
 
@@ -121,41 +170,60 @@ def create_payment_keyboard(payment_url: str) -> InlineKeyboardMarkup:
     builder.button(text="Перейти к оплате", url=payment_url)
     return builder.as_markup()
 
-def create_keys_management_keyboard(keys: list) -> InlineKeyboardMarkup:
+def create_keys_management_keyboard(keys: list, start_number: int = 1, has_prev: bool = False, has_next: bool = False) -> InlineKeyboardMarkup:
+    """Одна страница ключей; start_number — номер первого ключа страницы."""
     builder = InlineKeyboardBuilder()
     if keys:
         for i, key in enumerate(keys):
             expiry_date = datetime.fromisoformat(key['expiry_date'])
             status_icon = "✅" if expiry_date > datetime.now() else "❌"
             builder.button(
-                text=f"{status_icon} Ключ #{i+1} (до {expiry_date.strftime('%d.%m.%Y')})",
-                callback_data=f"show_key_{key['key_id']}"
+                text=f"{status_icon} Ключ #{start_number + i} (до {expiry_date.strftime('%d.%m.%Y')})",
+                callback_data=ShowKey(key_id=key['key_id'])
             )
+    nav = _page_nav_buttons(
+        KeysPage(cursor=keys[0]['key_id'], back=True, number=start_number) if keys and has_prev else None,
+        KeysPage(cursor=keys[-1]['key_id'], back=False, number=start_number + len(keys)) if keys and has_next else None,
+    )
+    for text, callback_data in nav:
+        builder.button(text=text, callback_data=callback_data)
     builder.button(text="➕ Купить новый ключ", callback_data="buy_new_key")
     builder.button(text="⬅️ Назад в меню", callback_data="back_to_main_menu")
-    builder.adjust(1)
+    builder.adjust(*([1] * len(keys)), *([len(nav)] if nav else []), 1)
     return builder.as_markup()
 
+def _page_nav_buttons(prev_page, next_page) -> list:
+    buttons = []
+    if prev_page is not None:
+        buttons.append(("◀️ Назад", prev_page))
+    if next_page is not None:
+        buttons.append(("Далее ▶️", next_page))
+    return buttons
+
+@cached_render
 def create_key_info_keyboard(key_id: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    builder.button(text="➕ Продлить этот ключ", callback_data=f"extend_key_{key_id}")
-    builder.button(text="📱 Показать QR-код", callback_data=f"show_qr_{key_id}")
-    builder.button(text="📖 Инструкция", callback_data=f"show_instruction_{key_id}")
-    builder.button(text="➕ Доп. трафик", callback_data=f"traffic_packs_{key_id}")
+    builder.button(text="➕ Продлить этот ключ", callback_data=ExtendKey(key_id=key_id))
+    builder.button(text="📱 Показать QR-код", callback_data=KeyQR(key_id=key_id))
+    builder.button(text="📖 Инструкция", callback_data=KeyInstruction(key_id=key_id))
+    builder.button(text="➕ Доп. трафик", callback_data=TrafficPacks(key_id=key_id))
     builder.button(text="⬅️ Назад к списку ключей", callback_data="manage_keys")
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_back_to_key_keyboard(key_id: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    builder.button(text="⬅️ Назад к ключу", callback_data=f"show_key_{key_id}")
+    builder.button(text="⬅️ Назад к ключу", callback_data=ShowKey(key_id=key_id))
     return builder.as_markup()
 
+@cached_render
 def create_back_to_menu_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="⬅️ Назад в меню", callback_data="back_to_main_menu")
     return builder.as_markup()
 
+@cached_render
 def create_traffic_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="🔄 Обновить", callback_data="refresh_traffic")
@@ -163,19 +231,22 @@ def create_traffic_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_agreement_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Принимаю", callback_data="agree_to_terms")
     return builder.as_markup()
 
+@cached_render
 def create_traffic_packs_keyboard(packs: dict, key_id: int) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for pack_id, (title, price, gb) in packs.items():
-        builder.button(text=f"{title} - {price} RUB", callback_data=f"buy_pack_{pack_id}_{key_id}")
-    builder.button(text="⬅️ Назад к ключу", callback_data=f"show_key_{key_id}")
+        builder.button(text=f"{title} - {price} RUB", callback_data=BuyPack(pack_id=pack_id, key_id=key_id))
+    builder.button(text="⬅️ Назад к ключу", callback_data=ShowKey(key_id=key_id))
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_promo_enter_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="✍️ Ввести промокод", callback_data="enter_promo_start")
@@ -183,6 +254,7 @@ def create_promo_enter_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_autorenew_toggle_keyboard(enabled: bool) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text=f"🔁 Автопродление: {'ON' if enabled else 'OFF'}", callback_data="toggle_autorenew_confirm")
@@ -190,6 +262,7 @@ def create_autorenew_toggle_keyboard(enabled: bool) -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_render
 def create_admin_promos_keyboard() -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     builder.button(text="➕ Создать промокод", callback_data="admin_promo_create")
@@ -198,9 +271,24 @@ def create_admin_promos_keyboard() -> InlineKeyboardMarkup:
     builder.adjust(1)
     return builder.as_markup()
 
-def create_admin_promo_toggle_keyboard(code: str, active: bool) -> InlineKeyboardMarkup:
+@cached_render
+def create_admin_promo_list_keyboard(first_id: int, last_id: int, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    nav = _page_nav_buttons(
+        PromosPage(cursor=first_id, back=True) if has_prev else None,
+        PromosPage(cursor=last_id, back=False) if has_next else None,
+    )
+    for text, callback_data in nav:
+        builder.button(text=text, callback_data=callback_data)
+    builder.button(text="➕ Создать промокод", callback_data="admin_promo_create")
+    builder.button(text="⬅️ Назад", callback_data="admin_promos")
+    builder.adjust(*([len(nav)] if nav else []), 1)
+    return builder.as_markup()
+
+@cached_render
+def create_admin_promo_toggle_keyboard(promo_id: int, active: bool) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    builder.button(text=("🔴 Выключить" if active else "🟢 Включить"), callback_data=f"admin_promo_toggle_{code}")
+    builder.button(text=("🔴 Выключить" if active else "🟢 Включить"), callback_data=PromoToggle(promo_id=promo_id))
     builder.button(text="⬅️ Назад", callback_data="admin_promos")
     builder.adjust(1)
     return builder.as_markup()
\ No newline at end of file
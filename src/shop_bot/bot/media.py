@@ -0,0 +1,65 @@
+"""
+Повторное использование file_id загруженных в Telegram файлов.
+
+После первой загрузки Telegram возвращает file_id; он сохраняется в таблице
+media_cache (с небольшим LRU в памяти), и последующие отправки того же
+содержимого передают только file_id вместо повторной загрузки байтов.
+"""
+import hashlib
+import logging
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputFile
+
+from shop_bot.data_manager.database import get_media_file_id, set_media_file_id, delete_media_file_id
+from shop_bot.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+_file_ids = LRUCache(maxsize=2048)
+
+def cache_key(kind: str, *parts: str) -> str:
+    """Ключ кеша: тип + хеш содержимого/строки подключения."""
+    digest = hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+    return f"{kind}:{digest}"
+
+def _lookup(key: str) -> Optional[str]:
+    file_id = _file_ids.get(key)
+    if file_id is None:
+        file_id = get_media_file_id(key)
+        if file_id:
+            _file_ids.set(key, file_id)
+    return file_id
+
+def _forget(key: str):
+    _file_ids.pop(key)
+    delete_media_file_id(key)
+
+def _extract_file_id(message: types.Message, kind: str) -> Optional[str]:
+    if kind == "photo" and message.photo:
+        return message.photo[-1].file_id
+    if kind == "document" and message.document:
+        return message.document.file_id
+    return None
+
+async def send_cached(bot: Bot, chat_id: int | str, kind: str, key: str,
+                      load: Callable[[], Awaitable[InputFile]], **kwargs) -> types.Message:
+    """Отправляет фото/документ по сохранённому file_id, а при его отсутствии
+    загружает содержимое через load() и запоминает полученный file_id."""
+    send = bot.send_photo if kind == "photo" else bot.send_document
+    file_id = _lookup(key)
+    if file_id:
+        try:
+            return await send(chat_id, file_id, **kwargs)
+        except TelegramBadRequest as e:
+            logger.warning(f"Cached file_id for {key} rejected, re-uploading: {e}")
+            _forget(key)
+
+    message = await send(chat_id, await load(), **kwargs)
+    new_file_id = _extract_file_id(message, kind)
+    if new_file_id:
+        _file_ids.set(key, new_file_id)
+        set_media_file_id(key, new_file_id, kind)
+    return message
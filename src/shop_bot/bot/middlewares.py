@@ -0,0 +1,93 @@
+"""
+Middleware диспетчера.
+
+CallbackDebounceMiddleware гасит серии нажатий одной и той же кнопки: первое
+нажатие выполняется, а повторные в течение окна (и пока первое ещё
+выполняется) сразу получают callback.answer() без запросов к базе, панели
+и Telegram-редактирования. Окна задаются по префиксу callback_data
+(часть до ":"), ключ — пользователь и callback_data целиком, так что разные
+кнопки одного префикса (QR разных ключей) не мешают друг другу.
+
+Окна можно переопределить переменной окружения:
+    CALLBACK_DEBOUNCE_WINDOWS="refresh_traffic=5,qr=3,pay=3"
+"""
+import logging
+import os
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import CallbackQuery, TelegramObject
+
+from shop_bot.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Префикс callback_data -> окно в секундах
+DEFAULT_DEBOUNCE_WINDOWS = {
+    "refresh_traffic": 5.0,
+    "show_traffic": 2.0,
+    "qr": 3.0,
+    "pay": 3.0,
+    "key": 1.0,
+}
+
+def parse_windows(raw: Optional[str]) -> Dict[str, float]:
+    windows: Dict[str, float] = {}
+    for item in (raw or "").split(","):
+        prefix, _, seconds = item.partition("=")
+        if prefix.strip() and seconds.strip():
+            try:
+                windows[prefix.strip()] = float(seconds)
+            except ValueError:
+                logger.warning(f"Ignoring bad debounce window '{item}'")
+    return windows
+
+class CallbackDebounceMiddleware(BaseMiddleware):
+    def __init__(self, windows: Optional[Mapping[str, float]] = None, maxsize: int = 10000):
+        self.windows = dict(DEFAULT_DEBOUNCE_WINDOWS if windows is None else windows)
+        # (user_id, callback_data) -> время, до которого повторы гасятся
+        self._deadlines = LRUCache(maxsize=maxsize)
+        self._in_flight: set = set()
+        self.executed: Counter = Counter()
+        self.suppressed: Counter = Counter()
+
+    def stats(self) -> dict:
+        return {prefix: {"executed": self.executed[prefix], "suppressed": self.suppressed[prefix]} for prefix in self.windows}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not isinstance(event, CallbackQuery) or not event.data:
+            return await handler(event, data)
+        prefix = event.data.partition(":")[0]
+        window = self.windows.get(prefix)
+        if not window:
+            return await handler(event, data)
+
+        key = (event.from_user.id, event.data)
+        now = time.monotonic()
+        if key in self._in_flight or self._deadlines.get(key, 0.0) > now:
+            self.suppressed[prefix] += 1
+            try:
+                await event.answer("⏳ Уже выполняется...")
+            except TelegramAPIError as e:
+                logger.debug(f"Could not answer debounced callback: {e}")
+            return None
+
+        self.executed[prefix] += 1
+        self._in_flight.add(key)
+        self._deadlines.set(key, now + window)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(key)
+
+callback_debounce = CallbackDebounceMiddleware(
+    {**DEFAULT_DEBOUNCE_WINDOWS, **parse_windows(os.getenv("CALLBACK_DEBOUNCE_WINDOWS"))}
+)
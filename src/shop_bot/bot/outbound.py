@@ -0,0 +1,136 @@
+"""
+Исходящие редактирования сообщений через один слой.
+
+Для каждого сообщения (chat_id, message_id) запоминается хеш последнего
+показанного текста и клавиатуры:
+  - правка, которая ничего не меняет, не отправляется вовсе;
+  - ответ Telegram "message is not modified" считается успехом (без повторов
+    с невидимым символом и без отправки нового сообщения);
+  - пока правка сообщения выполняется, новые правки того же сообщения
+    не встают в очередь, а заменяют друг друга — уходит только последняя;
+  - при flood wait (RetryAfter) ждём и отправляем самую свежую версию.
+
+Хеш верен, только если все правки сообщения идут через edit_text, поэтому
+обработчики не вызывают message.edit_text напрямую.
+"""
+import asyncio
+import hashlib
+import logging
+from collections import Counter
+from typing import Any, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup, Message
+
+from shop_bot.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_AFTER_SECONDS = 30
+
+def _digest(text: str, reply_markup: Optional[InlineKeyboardMarkup], kwargs: dict) -> bytes:
+    h = hashlib.blake2b(text.encode("utf-8"), digest_size=16)
+    if reply_markup is not None:
+        h.update(reply_markup.model_dump_json(exclude_none=True).encode("utf-8"))
+    if kwargs:
+        h.update(repr(sorted(kwargs.items())).encode("utf-8"))
+    return h.digest()
+
+class _Edit:
+    __slots__ = ("message", "text", "reply_markup", "kwargs", "digest", "waiters")
+
+    def __init__(self, message: Message, text: str, reply_markup, kwargs: dict, digest: bytes):
+        self.message, self.text, self.reply_markup, self.kwargs, self.digest = message, text, reply_markup, kwargs, digest
+        self.waiters: list[asyncio.Future] = []
+
+class EditCoalescer:
+    def __init__(self, maxsize: int = 20000):
+        # (chat_id, message_id) -> хеш того, что сейчас показано в сообщении
+        self._rendered = LRUCache(maxsize=maxsize)
+        # Сообщения с выполняющейся правкой -> следующая (последняя) правка
+        self._pending: dict[tuple, Optional[_Edit]] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.counters: Counter = Counter()
+
+    async def edit_text(self, message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, **kwargs: Any) -> bool:
+        """Редактирует сообщение; True — сообщение показывает этот (или более новый) текст.
+
+        Ошибки Telegram, кроме "message is not modified", пробрасываются вызывающему.
+        """
+        key = (message.chat.id, message.message_id)
+        edit = _Edit(message, text, reply_markup, kwargs, _digest(text, reply_markup, kwargs))
+        future = asyncio.get_running_loop().create_future()
+        edit.waiters.append(future)
+
+        if key in self._pending:
+            queued = self._pending[key]
+            if queued is not None:
+                # Более старая правка так и не уйдёт: её ждущие получат результат этой
+                self.counters["coalesced"] += 1
+                edit.waiters.extend(queued.waiters)
+            self._pending[key] = edit
+        elif self._rendered.get(key) == edit.digest:
+            self.counters["skipped"] += 1
+            return True
+        else:
+            self._pending[key] = None
+            task = asyncio.create_task(self._drain(key, edit))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return await future
+
+    @staticmethod
+    def _resolve(edit: _Edit, result: bool = True, error: Optional[BaseException] = None):
+        for waiter in edit.waiters:
+            if waiter.done():
+                continue
+            if error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(result)
+
+    async def _drain(self, key: tuple, edit: _Edit):
+        try:
+            while edit is not None:
+                if self._rendered.get(key) == edit.digest:
+                    self.counters["skipped"] += 1
+                    self._resolve(edit)
+                else:
+                    try:
+                        self._resolve(edit, await self._send(key, edit))
+                    except Exception as e:
+                        self._resolve(edit, error=e)
+                edit = self._pending.get(key)
+                self._pending[key] = None
+        finally:
+            self._pending.pop(key, None)
+
+    async def _send(self, key: tuple, edit: _Edit) -> bool:
+        while True:
+            try:
+                await edit.message.edit_text(edit.text, reply_markup=edit.reply_markup, **edit.kwargs)
+                self.counters["sent"] += 1
+                self._rendered.set(key, edit.digest)
+                return True
+            except TelegramRetryAfter as e:
+                self.counters["retry_after"] += 1
+                await asyncio.sleep(min(e.retry_after, MAX_RETRY_AFTER_SECONDS))
+                newer = self._pending.get(key)
+                if newer is not None:
+                    # За время ожидания пришла более новая версия — отправится она
+                    self.counters["coalesced"] += 1
+                    newer.waiters.extend(edit.waiters)
+                    edit.waiters.clear()
+                    return True
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    self.counters["not_modified"] += 1
+                    self._rendered.set(key, edit.digest)
+                    return True
+                self._rendered.pop(key)
+                raise
+
+coalescer = EditCoalescer()
+
+async def edit_text(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None, **kwargs: Any) -> bool:
+    return await coalescer.edit_text(message, text, reply_markup, **kwargs)
@@ -0,0 +1,65 @@
+"""
+Микробенчмарк построения экранов: клавиатуры и экраны из настроек
+без кеша (func.__wrapped__) и через cached_render.
+
+    python -m shop_bot.bot.render_bench --iterations 20000
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from shop_bot.config import PLANS, TRAFFIC_PACKS
+from shop_bot.data_manager import database
+from shop_bot.bot import handlers, keyboards
+
+PAYMENT_METHODS = {"stars": True, "yookassa": True, "crypto": True}
+
+def _scenarios() -> dict:
+    keys = [{"key_id": i} for i in range(3)]
+    return {
+        "main_menu": (keyboards._main_menu_keyboard, (len(keys), False, True, True)),
+        "admin": (keyboards.create_admin_keyboard, ()),
+        "plans": (keyboards.create_plans_keyboard, (PLANS, "extend", 42)),
+        "payment_methods": (keyboards.create_payment_method_keyboard, (PAYMENT_METHODS, "buy_3_months", "extend", 42)),
+        "key_info": (keyboards.create_key_info_keyboard, (42,)),
+        "traffic_packs": (keyboards.create_traffic_packs_keyboard, (TRAFFIC_PACKS, 42)),
+        # Экраны читают настройки из базы (3 и 2 SELECT без кеша)
+        "about_screen": (handlers._about_screen, ()),
+        "help_screen": (handlers._help_screen, ()),
+    }
+
+def _per_call_us(func, args: tuple, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func(*args)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def run(iterations: int) -> dict:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="render_bench_") as tmp:
+        saved = database.DB_FILE
+        database.DB_FILE = Path(tmp) / "bench.db"
+        database.initialize_db()
+        try:
+            for name, (func, args) in _scenarios().items():
+                # Экранам с базой хватает меньшего числа итераций
+                count = iterations // 20 if name.endswith("_screen") else iterations
+                keyboards.invalidate_cache()
+                uncached = _per_call_us(func.__wrapped__, args, count)
+                cached = _per_call_us(func, args, count)
+                results[name] = (uncached, cached)
+        finally:
+            database.DB_FILE = saved
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Keyboard/screen render microbenchmark")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    print(f"{'screen':<18}{'uncached, us':>14}{'cached, us':>12}{'speedup':>10}")
+    for name, (uncached, cached) in run(args.iterations).items():
+        print(f"{name:<18}{uncached:>14.2f}{cached:>12.2f}{uncached / cached:>9.0f}x")
+
+if __name__ == "__main__":
+    main()
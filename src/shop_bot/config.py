@@ -65,6 +65,17 @@ def get_purchase_success_text(action: str, key_number: int, expiry_date, connect
         f"<code>{connection_string}</code>"
     )
 
+def get_data_age_text(age_seconds: float) -> str:
+    if age_seconds < 60:
+        age = "только что"
+    elif age_seconds < 3600:
+        age = f"{int(age_seconds // 60)} мин. назад"
+    elif age_seconds < 86400:
+        age = f"{int(age_seconds // 3600)} ч. назад"
+    else:
+        age = f"{int(age_seconds // 86400)} дн. назад"
+    return f"🕓 Данные сервера обновлены {age}"
+
 def build_progress_bar(percent: float, width: int = 20) -> str:
     filled = int(width * percent / 100)
     return '▰' * filled + '▱' * (width - filled)
\ No newline at end of file
@@ -0,0 +1,145 @@
+"""
+Массовое продление подписок (компенсации после аварий и т.п.).
+
+Прогресс кампании хранится в SQLite, поэтому прерванную кампанию можно
+продолжить. Каждый пользователь продлевается под remnawave_api.user_locks,
+как и оплаты: свежее состояние читается из панели под замком, новая дата
+считается от него, поэтому оплата или автопродление между чтением и PATCH
+не затираются. Перед PATCH сохраняются исходный expireAt и целевая дата
+(статус 'sent'): при повторном запуске панель, показывающая целевую дату,
+означает «уже продлён», исходную — «PATCH не дошёл».
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Optional, Tuple
+
+import aiohttp
+
+from shop_bot.data_manager import database
+from shop_bot.modules import remnawave_api
+from shop_bot.utils.http import get_session
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+RESUMABLE_STATUSES = ('pending', 'sent', 'failed')
+
+ProgressCallback = Callable[[dict], Awaitable[None]]
+
+_RUNNING: set[int] = set()
+
+def _parse_iso(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+
+def _same_instant(a: Optional[str], b: Optional[str]) -> bool:
+    # Панель возвращает даты с миллисекундами, у нас они без — сравниваем моменты
+    return _parse_iso(a) == _parse_iso(b)
+
+def _already_applied(user: dict, target_iso: Optional[str]) -> bool:
+    target = _parse_iso(target_iso) if target_iso else None
+    current = _parse_iso(user.get('expireAt'))
+    return bool(target and current and current >= target)
+
+def is_running(campaign_id: int) -> bool:
+    return campaign_id in _RUNNING
+
+def start_extension_campaign(telegram_ids: list[int], days: int) -> Optional[int]:
+    return database.create_extension_campaign(sorted(set(telegram_ids)), days)
+
+async def _extend_user(session: aiohttp.ClientSession, campaign_id: int, days: int, telegram_id: int,
+                       status: str, base_iso: Optional[str], target_iso: Optional[str]) -> Tuple[str, Optional[dict]]:
+    """Продлевает одного пользователя. Возвращает (итоговый статус, пользователь панели после продления)."""
+    async with remnawave_api.user_locks(telegram_id):
+        user = await remnawave_api.get_user_by_telegram_id(session, str(telegram_id))
+        if not user:
+            return 'not_found', None
+        current = user.get('expireAt')
+        if status != 'pending':
+            if base_iso is not None:
+                if _same_instant(current, target_iso):
+                    # PATCH прошлого запуска дошёл до панели, но результат не успели записать
+                    return 'done', user
+                if not _same_instant(current, base_iso):
+                    # Дату после прошлого запуска двигали оплаты — продлеваем от текущей
+                    logger.warning(f"Campaign {campaign_id}: expiry of {telegram_id} changed since last run ({base_iso} -> {current})")
+            elif _already_applied(user, target_iso):
+                # Строки, записанные до появления base_expiry
+                return 'done', user
+
+        new_iso = remnawave_api.extend_expiry_iso(current, days)
+        marked = await asyncio.to_thread(database.mark_campaign_item_sent, campaign_id, telegram_id, current or "", new_iso)
+        if not marked:
+            return 'failed', None
+        updated = await remnawave_api.set_user_expiry(session, user.get('uuid'), new_iso)
+        if updated and _parse_iso(updated.get('expireAt')):
+            return 'done', updated
+        # Ответа нет (ошибка или таймаут): под тем же замком проверяем, применился ли PATCH
+        check = await remnawave_api.get_user_by_telegram_id(session, str(telegram_id))
+        if check and _same_instant(check.get('expireAt'), new_iso):
+            return 'done', check
+        return 'failed', None
+
+async def run_extension_campaign(campaign_id: int, on_progress: Optional[ProgressCallback] = None, concurrency: int = remnawave_api.BULK_CONCURRENCY) -> Optional[dict]:
+    """Выполняет (или продолжает) кампанию. Возвращает итоговые счётчики."""
+    campaign = database.get_extension_campaign(campaign_id)
+    if not campaign or campaign_id in _RUNNING:
+        return None
+    _RUNNING.add(campaign_id)
+    try:
+        days = campaign['days']
+        counts = campaign['counts']
+        progress = {
+            'campaign_id': campaign_id,
+            'total': campaign['total'],
+            'done': counts.get('done', 0),
+            'not_found': counts.get('not_found', 0),
+            'failed': 0,
+        }
+        items = database.get_campaign_items(campaign_id, RESUMABLE_STATUSES)
+        if not items:
+            database.finish_extension_campaign(campaign_id)
+            return progress
+
+        session = get_session()
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def extend(item: tuple) -> Tuple[int, str, Optional[dict]]:
+            telegram_id = item[0]
+            async with semaphore:
+                try:
+                    status, user = await _extend_user(session, campaign_id, days, *item)
+                except Exception as e:
+                    logger.error(f"Campaign {campaign_id}: extension of {telegram_id} failed: {e}")
+                    status, user = 'failed', None
+            return telegram_id, status, user
+
+        for offset in range(0, len(items), CHUNK_SIZE):
+            results = await asyncio.gather(*(extend(item) for item in items[offset:offset + CHUNK_SIZE]))
+            checkpoint = []
+            key_rows = []
+            mirror_rows = []
+            for telegram_id, status, user in results:
+                checkpoint.append((status, None, telegram_id))
+                progress[status] += 1
+                if status == 'done':
+                    mirror_rows.append((telegram_id, user))
+                    key_rows.append((telegram_id, int(_parse_iso(user.get('expireAt')).timestamp() * 1000)))
+
+            database.set_campaign_items_status(campaign_id, checkpoint)
+            database.set_users_keys_expiry(key_rows)
+            database.upsert_panel_users(mirror_rows)
+            if on_progress:
+                try:
+                    await on_progress(dict(progress))
+                except Exception as e:
+                    logger.warning(f"Campaign {campaign_id} progress callback failed: {e}")
+
+        database.finish_extension_campaign(campaign_id)
+        logger.info(f"Extension campaign {campaign_id} finished: {progress}")
+        return progress
+    finally:
+        _RUNNING.discard(campaign_id)
@@ -2,8 +2,10 @@ import sqlite3
 from datetime import datetime
 import logging
 import os
+import time
 from pathlib import Path
 from shop_bot.config import ABOUT_TEXT, TERMS_URL, PRIVACY_URL, SUPPORT_USER, SUPPORT_TEXT, CHANNEL_URL
+from shop_bot.utils.cache import LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -66,7 +68,106 @@ def initialize_db():
                     key TEXT PRIMARY KEY,
                     value TEXT
                 );
+                CREATE TABLE IF NOT EXISTS extension_campaigns (
+                    campaign_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    days INTEGER NOT NULL,
+                    status TEXT DEFAULT 'running',
+                    total INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS extension_campaign_items (
+                    campaign_id INTEGER NOT NULL,
+                    telegram_id INTEGER NOT NULL,
+                    status TEXT DEFAULT 'pending',
+                    target_expiry TEXT,
+                    PRIMARY KEY (campaign_id, telegram_id)
+                );
+                CREATE TABLE IF NOT EXISTS panel_users (
+                    telegram_id INTEGER PRIMARY KEY,
+                    panel_uuid TEXT,
+                    vless_uuid TEXT,
+                    expire_at TEXT,
+                    used_bytes INTEGER DEFAULT 0,
+                    limit_bytes INTEGER DEFAULT 0,
+                    synced_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS media_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    kind TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS panel_events (
+                    event_key TEXT PRIMARY KEY,
+                    event TEXT,
+                    telegram_id INTEGER,
+                    received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS payments (
+                    provider TEXT NOT NULL,
+                    provider_payment_id TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'received',
+                    user_id INTEGER,
+                    amount REAL,
+                    error TEXT,
+                    metadata TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (provider, provider_payment_id)
+                );
+                CREATE TABLE IF NOT EXISTS payment_steps (
+                    provider TEXT NOT NULL,
+                    provider_payment_id TEXT NOT NULL,
+                    step TEXT NOT NULL,
+                    value TEXT,
+                    done_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (provider, provider_payment_id, step)
+                );
+                CREATE TABLE IF NOT EXISTS pending_orders (
+                    order_id TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    provider TEXT,
+                    plan_id TEXT,
+                    action TEXT,
+                    key_id INTEGER DEFAULT 0,
+                    months INTEGER DEFAULT 0,
+                    price REAL,
+                    promo_code TEXT,
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    status TEXT DEFAULT 'pending',
+                    provider_payment_id TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS fsm_storage (
+                    storage_key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    expires_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage(expires_at);
             ''')
+            # Колонки, добавленные к таблицам после их появления
+            added_columns = (
+                ("payments", "metadata", "TEXT"),
+                ("payments", "attempts", "INTEGER DEFAULT 0"),
+                ("payments", "next_attempt_at", "REAL DEFAULT 0"),
+                ("pending_orders", "provider_payment_id", "TEXT"),
+                ("promo_codes", "batch", "TEXT"),
+                ("extension_campaign_items", "base_expiry", "TEXT"),
+            )
+            for table, column, ddl in added_columns:
+                if column not in {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}:
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_queue ON payments(status, next_attempt_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_pending_orders_status ON pending_orders(status, created_at)")
+            # (user_id, key_id) обслуживает и поиск по user_id: одиночный индекс только замедлял записи
+            cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_user_id")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user ON vpn_keys(user_id, key_id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_batch ON promo_codes(batch)")
             default_settings = {
                 "about_text": ABOUT_TEXT,
                 "terms_url": TERMS_URL,
@@ -104,16 +205,27 @@ def update_setting(key: str, value: str):
     except sqlite3.Error as e:
         logging.error(f"Failed to update setting '{key}': {e}")
 
+# (файл базы, telegram_id) -> username, записанный в users последним.
+# Повторный /start известного пользователя с тем же username не обращается к базе.
+_known_users = LRUCache(maxsize=int(os.getenv("KNOWN_USERS_CACHE_SIZE", "20000")))
+_UNKNOWN = object()
+
 def register_user_if_not_exists(telegram_id: int, username: str):
+    cache_key = (str(DB_FILE), telegram_id)
+    if _known_users.get(cache_key, _UNKNOWN) == username:
+        return
     try:
         with sqlite3.connect(DB_FILE) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
-            if not cursor.fetchone():
+            cursor.execute("SELECT username FROM users WHERE telegram_id = ?", (telegram_id,))
+            row = cursor.fetchone()
+            if not row:
                 cursor.execute("INSERT INTO users (telegram_id, username) VALUES (?, ?)", (telegram_id, username))
-            else:
+                conn.commit()
+            elif row[0] != username:
                 cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
-            conn.commit()
+                conn.commit()
+        _known_users.set(cache_key, username)
     except sqlite3.Error as e:
         logging.error(f"Failed to register user {telegram_id}: {e}")
 
@@ -199,6 +311,30 @@ def get_user_keys(user_id: int):
         logging.error(f"Failed to get keys for user {user_id}: {e}")
         return []
 
+def get_user_keys_page(user_id: int, cursor: int = 0, limit: int = 10, backward: bool = False) -> tuple[list[dict], bool]:
+    """Страница ключей по key_id (keyset): после cursor, а при backward — перед ним.
+
+    Возвращает ключи по возрастанию key_id и признак, что в этом направлении есть ещё.
+    """
+    op, order = ("<", "DESC") if backward else (">", "ASC")
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor()
+            c.execute(
+                f"SELECT * FROM vpn_keys WHERE user_id = ? AND key_id {op} ? ORDER BY key_id {order} LIMIT ?",
+                (user_id, cursor, limit + 1)
+            )
+            rows = [dict(row) for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get keys page for user {user_id}: {e}")
+        return [], False
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
 def get_key_by_id(key_id: int):
     try:
         with sqlite3.connect(DB_FILE) as conn:
@@ -211,6 +347,15 @@ def get_key_by_id(key_id: int):
         logging.error(f"Failed to get key by ID {key_id}: {e}")
         return None
 
+def get_key_by_email(key_email: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor(); c.execute("SELECT * FROM vpn_keys WHERE key_email = ?", (key_email,))
+            row = c.fetchone(); return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get key by email {key_email}: {e}"); return None
+
 def update_key_info(key_id: int, new_vless_uuid: str, new_expiry_ms: int):
     try:
         with sqlite3.connect(DB_FILE) as conn:
@@ -227,12 +372,15 @@ def get_next_key_number(user_id: int) -> int:
     keys = get_user_keys(user_id)
     return len(keys) + 1
 
-def get_all_vpn_users():
+def get_all_vpn_users(auto_renew_only: bool = False):
     try:
         with sqlite3.connect(DB_FILE) as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
-            cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
+            if auto_renew_only:
+                cursor.execute("SELECT DISTINCT k.user_id FROM vpn_keys k JOIN users u ON u.telegram_id = k.user_id WHERE u.auto_renew = 1")
+            else:
+                cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
             users = cursor.fetchall()
             return [dict(user) for user in users]
     except sqlite3.Error as e:
@@ -293,6 +441,16 @@ def get_promo(code: str):
     except sqlite3.Error as e:
         logging.error(f"Failed to get promo {code}: {e}"); return None
 
+def get_promo_by_id(promo_id: int):
+    """Промокод по rowid, в том числе выключенный."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row; c = conn.cursor()
+            c.execute("SELECT rowid AS id, * FROM promo_codes WHERE rowid = ?", (promo_id,))
+            r = c.fetchone(); return dict(r) if r else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get promo #{promo_id}: {e}"); return None
+
 def apply_promo_usage(code: str):
     try:
         with sqlite3.connect(DB_FILE) as conn:
@@ -312,6 +470,50 @@ def get_all_promos():
     except sqlite3.Error as e:
         logging.error(f"Failed to list promos: {e}"); return []
 
+def insert_promo_batch(batch: str, codes: list[str], discount_percent: int, free_days: int, uses_limit: int, chunk_size: int = 5000) -> int | None:
+    """Вставляет коды пакета одной транзакцией, порциями через executemany.
+
+    Уже существующие коды пропускаются (OR IGNORE) и в пакет не попадают.
+    Возвращает число вставленных строк; None — ошибка БД (пакет откатывается).
+    """
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            c = conn.cursor()
+            before = conn.total_changes
+            for start in range(0, len(codes), chunk_size):
+                c.executemany(
+                    "INSERT OR IGNORE INTO promo_codes (code, discount_percent, free_days, uses_limit, uses_count, active, batch) VALUES (?, ?, ?, ?, 0, 1, ?)",
+                    [(code, discount_percent, free_days, uses_limit, batch) for code in codes[start:start + chunk_size]]
+                )
+            conn.commit()
+            return conn.total_changes - before
+    except sqlite3.Error as e:
+        logging.error(f"Failed to insert promo batch {batch}: {e}"); return None
+
+def get_promo_batch_codes(batch: str) -> list[str]:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("SELECT code FROM promo_codes WHERE batch = ? ORDER BY code", (batch,))
+            return [row[0] for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get promo batch {batch}: {e}"); return []
+
+def get_promos_page(cursor: int = 0, limit: int = 20, backward: bool = False) -> tuple[list[dict], bool]:
+    """Страница промокодов по rowid (keyset): после cursor, а при backward — перед ним. В строках есть id (rowid)."""
+    op, order = ("<", "DESC") if backward else (">", "ASC")
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor(); c.execute(f"SELECT rowid AS id, * FROM promo_codes WHERE rowid {op} ? ORDER BY rowid {order} LIMIT ?", (cursor, limit + 1))
+            rows = [dict(r) for r in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to list promos page: {e}"); return [], False
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
 def set_promo_active(code: str, active: bool) -> bool:
     try:
         with sqlite3.connect(DB_FILE) as conn:
@@ -468,4 +670,419 @@ def get_last_backup_timestamp() -> str | None:
             c = conn.cursor(); c.execute("SELECT value FROM bot_settings WHERE key = 'last_backup_iso'")
             row = c.fetchone(); return row[0] if row else None
     except sqlite3.Error as e:
-        logging.error(f"Failed to get last backup timestamp: {e}"); return None
\ No newline at end of file
+        logging.error(f"Failed to get last backup timestamp: {e}"); return None
+
+# -------------------- Bulk extension campaigns --------------------
+def get_active_vpn_user_ids() -> list[int]:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("SELECT DISTINCT user_id FROM vpn_keys WHERE expiry_date > CURRENT_TIMESTAMP")
+            return [row[0] for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get active vpn users: {e}"); return []
+
+def create_extension_campaign(telegram_ids: list[int], days: int) -> int | None:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO extension_campaigns (days, total) VALUES (?, ?)", (days, len(telegram_ids)))
+            campaign_id = c.lastrowid
+            c.executemany(
+                "INSERT OR IGNORE INTO extension_campaign_items (campaign_id, telegram_id) VALUES (?, ?)",
+                ((campaign_id, tid) for tid in telegram_ids)
+            )
+            conn.commit()
+            return campaign_id
+    except sqlite3.Error as e:
+        logging.error(f"Failed to create extension campaign: {e}"); return None
+
+def get_extension_campaign(campaign_id: int):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor(); c.execute("SELECT * FROM extension_campaigns WHERE campaign_id = ?", (campaign_id,))
+            row = c.fetchone()
+            if not row:
+                return None
+            campaign = dict(row)
+            c.execute("SELECT status, COUNT(*) FROM extension_campaign_items WHERE campaign_id = ? GROUP BY status", (campaign_id,))
+            campaign['counts'] = {status: count for status, count in c.fetchall()}
+            return campaign
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get extension campaign {campaign_id}: {e}"); return None
+
+def get_unfinished_extension_campaigns():
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor(); c.execute("SELECT * FROM extension_campaigns WHERE status = 'running' ORDER BY campaign_id")
+            return [dict(r) for r in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to list extension campaigns: {e}"); return []
+
+def get_campaign_items(campaign_id: int, statuses: tuple[str, ...]):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            placeholders = ",".join("?" for _ in statuses)
+            c.execute(
+                f"SELECT telegram_id, status, base_expiry, target_expiry FROM extension_campaign_items WHERE campaign_id = ? AND status IN ({placeholders}) ORDER BY telegram_id",
+                (campaign_id, *statuses)
+            )
+            return c.fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get items of campaign {campaign_id}: {e}"); return []
+
+def set_campaign_items_status(campaign_id: int, rows: list[tuple[str, str | None, int]]):
+    """rows: (status, target_expiry, telegram_id) — одним executemany в одной транзакции."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.executemany(
+                "UPDATE extension_campaign_items SET status = ?, target_expiry = COALESCE(?, target_expiry) WHERE campaign_id = ? AND telegram_id = ?",
+                ((status, target, campaign_id, tid) for status, target, tid in rows)
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to checkpoint campaign {campaign_id}: {e}")
+
+def mark_campaign_item_sent(campaign_id: int, telegram_id: int, base_expiry: str, target_expiry: str) -> bool:
+    """Перед PATCH: запоминает expireAt до продления и целевую дату. False — PATCH отправлять нельзя."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE extension_campaign_items SET status = 'sent', base_expiry = ?, target_expiry = ? WHERE campaign_id = ? AND telegram_id = ?",
+                (base_expiry, target_expiry, campaign_id, telegram_id)
+            )
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Failed to checkpoint item {telegram_id} of campaign {campaign_id}: {e}"); return False
+
+def set_users_keys_expiry(rows: list[tuple[int, int]]):
+    """rows: (telegram_id, expiry_timestamp_ms) — обновляет все ключи пользователей пачкой."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            from datetime import timezone
+            c = conn.cursor()
+            c.executemany(
+                "UPDATE vpn_keys SET expiry_date = ? WHERE user_id = ?",
+                ((datetime.fromtimestamp(ms / 1000, tz=timezone.utc).replace(tzinfo=None), tid) for tid, ms in rows)
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to batch update key expiry: {e}")
+
+def finish_extension_campaign(campaign_id: int, status: str = 'finished'):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("UPDATE extension_campaigns SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE campaign_id = ?", (status, campaign_id)); conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to finish campaign {campaign_id}: {e}")
+
+# -------------------- Panel users mirror --------------------
+_PANEL_USER_UPSERT = """
+    INSERT INTO panel_users (telegram_id, panel_uuid, vless_uuid, expire_at, used_bytes, limit_bytes, synced_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        panel_uuid = excluded.panel_uuid,
+        vless_uuid = COALESCE(excluded.vless_uuid, panel_users.vless_uuid),
+        expire_at = COALESCE(excluded.expire_at, panel_users.expire_at),
+        used_bytes = COALESCE(excluded.used_bytes, panel_users.used_bytes),
+        limit_bytes = COALESCE(excluded.limit_bytes, panel_users.limit_bytes),
+        synced_at = excluded.synced_at
+"""
+
+def _panel_user_row(telegram_id: int, remote: dict, synced_at: float) -> tuple:
+    return (
+        int(telegram_id), remote.get('uuid'), remote.get('vlessUuid'), remote.get('expireAt'),
+        remote.get('usedTrafficBytes'), remote.get('trafficLimitBytes'), synced_at,
+    )
+
+def upsert_panel_user(telegram_id: int, remote: dict):
+    """Записывает состояние пользователя из ответа панели в локальное зеркало."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute(_PANEL_USER_UPSERT, _panel_user_row(telegram_id, remote, time.time())); conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to upsert panel user {telegram_id}: {e}")
+
+def upsert_panel_users(remotes: list[tuple[int, dict]]):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            now = time.time()
+            c = conn.cursor(); c.executemany(_PANEL_USER_UPSERT, (_panel_user_row(tid, remote, now) for tid, remote in remotes)); conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to batch upsert panel users: {e}")
+
+def get_panel_user(telegram_id: int):
+    """Строка зеркала с дополнительным полем age_seconds (давность синхронизации)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor(); c.execute("SELECT * FROM panel_users WHERE telegram_id = ?", (telegram_id,))
+            row = c.fetchone()
+            if not row:
+                return None
+            data = dict(row)
+            data['age_seconds'] = max(0.0, time.time() - (data.get('synced_at') or 0))
+            return data
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get panel user {telegram_id}: {e}"); return None
+
+# -------------------- Panel webhook events --------------------
+def record_panel_event(event_key: str, event: str, telegram_id: int | None) -> bool:
+    """True, если событие новое; False для повторной доставки того же события."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute("INSERT OR IGNORE INTO panel_events (event_key, event, telegram_id) VALUES (?, ?, ?)", (event_key, event, telegram_id))
+            conn.commit()
+            return c.rowcount == 1
+    except sqlite3.Error as e:
+        logging.error(f"Failed to record panel event {event}: {e}"); return False
+
+# -------------------- Telegram media cache --------------------
+def get_media_file_id(cache_key: str) -> str | None:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("SELECT file_id FROM media_cache WHERE cache_key = ?", (cache_key,))
+            row = c.fetchone(); return row[0] if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get media cache {cache_key}: {e}"); return None
+
+def set_media_file_id(cache_key: str, file_id: str, kind: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("INSERT OR REPLACE INTO media_cache (cache_key, file_id, kind) VALUES (?, ?, ?)", (cache_key, file_id, kind)); conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to set media cache {cache_key}: {e}")
+
+def delete_media_file_id(cache_key: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("DELETE FROM media_cache WHERE cache_key = ?", (cache_key,)); conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to delete media cache {cache_key}: {e}")
+
+# -------------------- Payments ledger / fulfilment queue --------------------
+# Состояния: received (в очереди) -> processing -> fulfilled | failed
+def enqueue_payment(provider: str, provider_payment_id: str, metadata: str, user_id: int | None = None, amount: float | None = None) -> bool | None:
+    """Ставит оплаченный заказ в очередь выдачи.
+
+    True — платёж новый (или ранее окончательно не удался и поставлен заново);
+    False — повторная доставка уже известного платежа; None — ошибка БД.
+    """
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT OR IGNORE INTO payments (provider, provider_payment_id, user_id, amount, metadata, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (provider, provider_payment_id, user_id, amount, metadata, time.time())
+            )
+            if c.rowcount == 1:
+                conn.commit(); return True
+            c.execute(
+                "UPDATE payments SET status = 'received', attempts = 0, next_attempt_at = ?, error = NULL, updated_at = CURRENT_TIMESTAMP "
+                "WHERE provider = ? AND provider_payment_id = ? AND status = 'failed'",
+                (time.time(), provider, provider_payment_id)
+            )
+            conn.commit()
+            return c.rowcount == 1
+    except sqlite3.Error as e:
+        logging.error(f"Failed to enqueue payment {provider}:{provider_payment_id}: {e}"); return None
+
+def claim_next_payment(now: float | None = None):
+    """Забирает из очереди один платёж, у которого подошло время попытки, и переводит его в 'processing'."""
+    now = time.time() if now is None else now
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor()
+            while True:
+                c.execute(
+                    "SELECT provider, provider_payment_id FROM payments WHERE status = 'received' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT 1",
+                    (now,)
+                )
+                row = c.fetchone()
+                if not row:
+                    return None
+                c.execute(
+                    "UPDATE payments SET status = 'processing', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP "
+                    "WHERE provider = ? AND provider_payment_id = ? AND status = 'received'",
+                    (row['provider'], row['provider_payment_id'])
+                )
+                conn.commit()
+                if c.rowcount == 1:
+                    c.execute("SELECT * FROM payments WHERE provider = ? AND provider_payment_id = ?", (row['provider'], row['provider_payment_id']))
+                    return dict(c.fetchone())
+    except sqlite3.Error as e:
+        logging.error(f"Failed to claim queued payment: {e}"); return None
+
+def retry_payment(provider: str, provider_payment_id: str, next_attempt_at: float, error: str | None = None):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE payments SET status = 'received', next_attempt_at = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE provider = ? AND provider_payment_id = ?",
+                (next_attempt_at, error, provider, provider_payment_id)
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to reschedule payment {provider}:{provider_payment_id}: {e}")
+
+def reset_processing_payments() -> int:
+    """После перезапуска возвращает в очередь платежи, выдача которых была прервана."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute("UPDATE payments SET status = 'received', next_attempt_at = ?, updated_at = CURRENT_TIMESTAMP WHERE status = 'processing'", (time.time(),))
+            conn.commit()
+            return c.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Failed to reset processing payments: {e}"); return 0
+
+def finish_payment(provider: str, provider_payment_id: str, status: str, error: str | None = None):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE payments SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP WHERE provider = ? AND provider_payment_id = ?",
+                (status, error, provider, provider_payment_id)
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to finish payment {provider}:{provider_payment_id}: {e}")
+
+def get_payment(provider: str, provider_payment_id: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor(); c.execute("SELECT * FROM payments WHERE provider = ? AND provider_payment_id = ?", (provider, provider_payment_id))
+            row = c.fetchone(); return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get payment {provider}:{provider_payment_id}: {e}"); return None
+
+def get_payment_steps(provider: str, provider_payment_id: str) -> dict[str, str] | None:
+    """Шаги выдачи, завершённые прошлыми попытками: {step: value}. None — ошибка БД."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute("SELECT step, value FROM payment_steps WHERE provider = ? AND provider_payment_id = ?", (provider, provider_payment_id))
+            return {step: value for step, value in c.fetchall()}
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get steps of payment {provider}:{provider_payment_id}: {e}"); return None
+
+def set_payment_step(provider: str, provider_payment_id: str, step: str, value: str = "") -> bool:
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            c = conn.cursor()
+            c.execute(
+                "INSERT OR REPLACE INTO payment_steps (provider, provider_payment_id, step, value) VALUES (?, ?, ?, ?)",
+                (provider, provider_payment_id, step, value)
+            )
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Failed to record step {step} of payment {provider}:{provider_payment_id}: {e}"); return False
+
+# -------------------- Pending orders --------------------
+_ORDER_FIELDS = ('user_id', 'provider', 'plan_id', 'action', 'key_id', 'months', 'price', 'promo_code', 'chat_id', 'message_id')
+
+def create_pending_order(order_id: str, order: dict) -> bool:
+    """Сохраняет параметры заказа; в счёт провайдера передаётся только order_id."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute(
+                f"INSERT INTO pending_orders (order_id, {', '.join(_ORDER_FIELDS)}) VALUES (?{', ?' * len(_ORDER_FIELDS)})",
+                (order_id, *(order.get(field) for field in _ORDER_FIELDS))
+            )
+            conn.commit()
+            return True
+    except sqlite3.Error as e:
+        logging.error(f"Failed to create pending order {order_id}: {e}"); return False
+
+def get_pending_order(order_id: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor(); c.execute("SELECT * FROM pending_orders WHERE order_id = ?", (order_id,))
+            row = c.fetchone(); return dict(row) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get pending order {order_id}: {e}"); return None
+
+def set_pending_order_status(order_id: str, status: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("UPDATE pending_orders SET status = ? WHERE order_id = ?", (status, order_id)); conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to update pending order {order_id}: {e}")
+
+def set_pending_order_payment_id(order_id: str, provider_payment_id: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("UPDATE pending_orders SET provider_payment_id = ? WHERE order_id = ?", (provider_payment_id, order_id)); conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to set payment id for order {order_id}: {e}")
+
+def get_stale_pending_orders(providers: tuple, older_than_seconds: int, max_age_seconds: int, limit: int = 500) -> list[dict]:
+    """Неоплаченные заказы, по которым вебхук так и не пришёл (старше older_than_seconds, но не старше max_age_seconds)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            c = conn.cursor()
+            c.execute(
+                f"SELECT * FROM pending_orders WHERE status = 'pending' AND provider IN ({', '.join('?' * len(providers))}) "
+                "AND created_at <= datetime('now', ?) AND created_at > datetime('now', ?) ORDER BY created_at LIMIT ?",
+                (*providers, f"-{int(older_than_seconds)} seconds", f"-{int(max_age_seconds)} seconds", limit)
+            )
+            return [dict(row) for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get stale pending orders: {e}"); return []
+
+def expire_pending_orders(max_age_seconds: int) -> int:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor()
+            c.execute("UPDATE pending_orders SET status = 'expired' WHERE status = 'pending' AND created_at <= datetime('now', ?)", (f"-{int(max_age_seconds)} seconds",))
+            conn.commit()
+            return c.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Failed to expire pending orders: {e}"); return 0
+
+# -------------------- FSM storage --------------------
+def get_fsm_record(storage_key: str):
+    """(state, data_json, expires_at) или None."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            c = conn.cursor(); c.execute("SELECT state, data, expires_at FROM fsm_storage WHERE storage_key = ?", (storage_key,))
+            return c.fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get FSM record {storage_key}: {e}"); return None
+
+def set_fsm_record(storage_key: str, state: str | None, data: str | None, expires_at: float):
+    """Сохраняет состояние и данные; пустая запись (нет ни состояния, ни данных) удаляется."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            c = conn.cursor()
+            if state is None and not data:
+                c.execute("DELETE FROM fsm_storage WHERE storage_key = ?", (storage_key,))
+            else:
+                c.execute(
+                    "INSERT INTO fsm_storage (storage_key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(storage_key) DO UPDATE SET state = excluded.state, data = excluded.data, expires_at = excluded.expires_at",
+                    (storage_key, state, data, expires_at)
+                )
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to set FSM record {storage_key}: {e}")
+
+def delete_expired_fsm_records(now: float | None = None) -> int:
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            c = conn.cursor(); c.execute("DELETE FROM fsm_storage WHERE expires_at <= ?", (time.time() if now is None else now,)); conn.commit()
+            return c.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Failed to delete expired FSM records: {e}"); return 0
@@ -0,0 +1,123 @@
+"""
+Хранилище FSM aiogram в SQLite (таблица fsm_storage).
+
+Незавершённые диалоги (ввод промокода, редактирование настроек в админке,
+создание промокода) переживают перезапуск бота, а брошенные не копятся:
+каждая запись живёт TTL секунд с последней записи (свой TTL можно задать
+для отдельных состояний), просроченные не читаются и удаляются фоновой
+очисткой. Перед таблицей стоит небольшой LRU: middleware FSM читает
+состояние на каждом апдейте, и для активных пользователей (а также для
+пользователей без состояния) это не доходит до SQLite. Память ограничена
+размером LRU при любом числе пользователей.
+
+Обращения к SQLite идут в пуле потоков (asyncio.to_thread), чтобы не
+блокировать цикл событий. Запись и чтение при промахе LRU по одному ключу
+выполняются под замком этого ключа: записи доходят до таблицы в порядке
+вызовов, а чтение не видит строку, которую ещё пишут.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from shop_bot.data_manager import database
+from shop_bot.utils import json_codec
+from shop_bot.utils.cache import LRUCache
+from shop_bot.utils.locks import KeyedLock
+
+logger = logging.getLogger(__name__)
+
+FSM_TTL_SECONDS = float(os.getenv("FSM_TTL_SECONDS", str(24 * 3600)))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "2048"))
+FSM_SWEEP_INTERVAL_SECONDS = 600
+
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self,
+        ttl: float = FSM_TTL_SECONDS,
+        state_ttls: Optional[Mapping[StateType, float]] = None,
+        cache_size: int = FSM_CACHE_SIZE,
+        key_builder: Optional[KeyBuilder] = None,
+    ):
+        self.ttl = ttl
+        self.state_ttls = {self._state_name(state): seconds for state, seconds in (state_ttls or {}).items()}
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # storage_key -> (state, data, expires_at); пустые записи кешируются тоже
+        self._cache = LRUCache(maxsize=cache_size)
+        self._locks = KeyedLock()
+        self._sweeper: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _state_name(state: StateType) -> Optional[str]:
+        return state.state if isinstance(state, State) else state
+
+    async def _load(self, key: StorageKey) -> tuple[str, Optional[str], Dict[str, Any]]:
+        storage_key = self.key_builder.build(key)
+        entry = self._cache.get(storage_key)
+        if entry is None:
+            async with self._locks(storage_key):
+                # Пока ждали замок, запись могла положить свежее значение в LRU
+                entry = self._cache.get(storage_key)
+                if entry is None:
+                    row = await asyncio.to_thread(database.get_fsm_record, storage_key)
+                    if row:
+                        entry = (row[0], json_codec.loads(row[1]) if row[1] else {}, row[2])
+                    else:
+                        entry = (None, {}, float("inf"))
+                    self._cache.set(storage_key, entry)
+        state, data, expires_at = entry
+        if expires_at <= time.time():
+            return storage_key, None, {}
+        return storage_key, state, data
+
+    async def _store(self, storage_key: str, state: Optional[str], data: Dict[str, Any]):
+        if state is None and not data:
+            expires_at = float("inf")
+        else:
+            expires_at = time.time() + self.state_ttls.get(state, self.ttl)
+        self._cache.set(storage_key, (state, data, expires_at))
+        # Замок берётся сразу после обновления LRU и отдаётся по очереди (FIFO)
+        async with self._locks(storage_key):
+            await asyncio.to_thread(database.set_fsm_record, storage_key, state, json_codec.dumps(data) if data else None, expires_at)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, _, data = await self._load(key)
+        await self._store(storage_key, self._state_name(state), data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(key))[1]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key, state, _ = await self._load(key)
+        await self._store(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(key))[2])
+
+    def sweep(self) -> int:
+        """Удаляет просроченные записи из таблицы; из LRU они уходят сами."""
+        return database.delete_expired_fsm_records()
+
+    def start_sweeper(self, interval: float = FSM_SWEEP_INTERVAL_SECONDS):
+        async def run():
+            while True:
+                try:
+                    removed = await asyncio.to_thread(self.sweep)
+                    if removed:
+                        logger.info(f"FSM storage: removed {removed} expired records")
+                except Exception as e:
+                    logger.error(f"FSM storage sweep failed: {e}")
+                await asyncio.sleep(interval)
+
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(run())
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        self._cache.clear()
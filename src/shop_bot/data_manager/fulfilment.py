@@ -0,0 +1,220 @@
+"""
+Очередь выдачи оплаченных заказов.
+
+Вебхуки и successful_payment только записывают платёж в таблицу payments
+(enqueue) и сразу отвечают. Пул воркеров в цикле бота забирает платежи из
+очереди, выдаёт их и при ошибке повторяет попытку с экспоненциальной
+задержкой. Платежи, прерванные перезапуском процесса, при старте
+возвращаются в очередь.
+
+Выдача может выполниться для одного платежа несколько раз, поэтому
+обработчик отмечает каждый завершённый шаг в payment_steps (PaymentJob.done)
+и на повторной попытке пропускает уже сделанное. Заказ, который выдать
+нельзя в принципе, обработчик завершает исходом FAILED — без повторов.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot
+
+from shop_bot.data_manager import database
+from shop_bot.utils import json_codec
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("PAYMENT_WORKERS", "4"))
+MAX_ATTEMPTS = int(os.getenv("PAYMENT_MAX_ATTEMPTS", "5"))
+RETRY_BASE_SECONDS = float(os.getenv("PAYMENT_RETRY_BASE_SECONDS", "15"))
+RETRY_MAX_SECONDS = 1800.0
+POLL_INTERVAL_SECONDS = 5.0
+
+# Счета, выставленные до перехода на pending_orders, несут заказ целиком в metadata.
+# Вебхуки провайдеров не подписаны, поэтому такая metadata принимается только
+# до даты PAYMENT_LEGACY_METADATA_UNTIL (ISO, UTC); не задана — не принимается.
+LEGACY_METADATA_UNTIL = os.getenv("PAYMENT_LEGACY_METADATA_UNTIL", "")
+# payload Stars приходит от Telegram в successful_payment, подделать его нельзя
+TRUSTED_METADATA_PROVIDERS = ("stars",)
+ORDER_FIELDS = ('user_id', 'months', 'price', 'action', 'key_id', 'plan_id', 'promo_code', 'chat_id', 'message_id')
+
+# Итог одной попытки выдачи
+FULFILLED = "fulfilled"
+RETRY = "retry"    # временная ошибка: повторить позже
+FAILED = "failed"  # заказ невыполним (нет пакета, чужой ключ, битые данные): без повторов
+
+class PaymentJob:
+    """Попытка выдачи одного платежа и шаги, завершённые прошлыми попытками."""
+
+    def __init__(self, provider: str, payment_id: str, attempts: int, steps: dict[str, str]):
+        self.provider, self.payment_id, self.attempts = provider, payment_id, attempts
+        self.steps = steps
+
+    @property
+    def last_attempt(self) -> bool:
+        return self.attempts >= MAX_ATTEMPTS
+
+    def step(self, name: str) -> Optional[str]:
+        """Значение завершённого шага или None, если шаг ещё не выполнялся."""
+        return self.steps.get(name)
+
+    async def done(self, name: str, value: str = ""):
+        """Отмечает шаг выполненным. Если записать не удалось, бросает RuntimeError — попытка повторится."""
+        if not await asyncio.to_thread(database.set_payment_step, self.provider, self.payment_id, name, value):
+            raise RuntimeError(f"Could not record step '{name}' of payment {self.provider}:{self.payment_id}")
+        self.steps[name] = value
+
+Processor = Callable[[Bot, dict, PaymentJob], Awaitable[str]]
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_wakeup: Optional[asyncio.Event] = None
+_workers: list[asyncio.Task] = []
+# Потоки вебхук-сервера пишут по очереди, а не соревнуются за блокировку SQLite
+_enqueue_lock = threading.Lock()
+
+def payment_key(metadata: dict) -> str:
+    """Идентификатор для провайдеров, не передающих id платежа: одинаковые доставки дают одинаковый ключ."""
+    canonical = "\x1f".join(f"{k}={metadata[k]}" for k in sorted(metadata))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def retry_delay(attempts: int) -> float:
+    return min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(0, attempts - 1))
+
+def _legacy_cutoff() -> Optional[datetime]:
+    try:
+        cutoff = datetime.fromisoformat(LEGACY_METADATA_UNTIL.strip())
+    except ValueError:
+        return None
+    return cutoff if cutoff.tzinfo else cutoff.replace(tzinfo=timezone.utc)
+
+def legacy_metadata_allowed(provider: str) -> bool:
+    if provider in TRUSTED_METADATA_PROVIDERS:
+        return True
+    cutoff = _legacy_cutoff()
+    return cutoff is not None and datetime.now(timezone.utc) < cutoff
+
+def resolve_order(provider: str, metadata: dict) -> Optional[dict]:
+    """Разворачивает {'order_id': ...} в параметры заказа из pending_orders.
+
+    Параметры берутся только из заказа, присланная metadata их не дополняет.
+    Metadata старых счетов (с полным набором полей) принимается, только если
+    это разрешено для провайдера (legacy_metadata_allowed). Неизвестный
+    order_id и прочая metadata отклоняются — возвращается None.
+    """
+    order_id = metadata.get('order_id')
+    if order_id:
+        order = database.get_pending_order(str(order_id))
+        if order and order.get('provider') in (None, provider):
+            resolved = {field: order[field] for field in ORDER_FIELDS}
+            resolved['order_id'] = str(order_id)
+            return resolved
+        if order:
+            logger.warning(f"Pending order {order_id} belongs to {order.get('provider')}, not {provider}; rejected")
+            return None
+    if metadata.get('user_id') and legacy_metadata_allowed(provider):
+        return metadata
+    if order_id:
+        logger.warning(f"Pending order {order_id} not found, {provider} payment rejected")
+    else:
+        logger.warning(f"{provider} payment without a known order rejected")
+    return None
+
+def _notify():
+    if _loop is None or _wakeup is None or _loop.is_closed():
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is _loop:
+        _wakeup.set()
+    else:
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+def enqueue(provider: str, payment_id: Optional[str], metadata: dict) -> bool:
+    """Записывает платёж в очередь. Потокобезопасно (вызывается из потока вебхуков).
+
+    Возвращает False для повторной доставки уже известного платежа и для
+    платежа, не прошедшего resolve_order. Если записать платёж не удалось,
+    бросает RuntimeError — вебхук должен ответить ошибкой, чтобы провайдер
+    повторил доставку.
+    """
+    metadata = resolve_order(provider, metadata)
+    if metadata is None:
+        return False
+    payment_id = str(payment_id) if payment_id else payment_key(metadata)
+    try:
+        user_id = int(metadata.get('user_id'))
+        amount = float(metadata.get('price') or 0)
+    except (TypeError, ValueError):
+        user_id, amount = None, None
+    with _enqueue_lock:
+        is_new = database.enqueue_payment(provider, payment_id, json_codec.dumps(metadata), user_id, amount)
+    if is_new is None:
+        raise RuntimeError(f"Payment queue unavailable, {provider}:{payment_id} not recorded")
+    if is_new:
+        if metadata.get('order_id'):
+            database.set_pending_order_status(str(metadata['order_id']), 'paid')
+        _notify()
+    else:
+        logger.info(f"Payment {provider}:{payment_id} already known, skipping")
+    return is_new
+
+async def _run_one(bot: Bot, processor: Processor, job: dict):
+    provider, payment_id, attempts = job['provider'], job['provider_payment_id'], job['attempts']
+    error = None
+    steps = await asyncio.to_thread(database.get_payment_steps, provider, payment_id)
+    if steps is None:
+        outcome, error = RETRY, "payment steps unavailable"
+    else:
+        try:
+            outcome = await processor(bot, json_codec.loads(job['metadata'] or '{}'), PaymentJob(provider, payment_id, attempts, steps))
+            if outcome != FULFILLED:
+                error = "order cannot be fulfilled" if outcome == FAILED else "fulfilment returned failure"
+        except Exception as e:
+            logger.error(f"Error fulfilling payment {provider}:{payment_id}: {e}", exc_info=True)
+            outcome, error = RETRY, str(e)
+
+    if outcome == FULFILLED:
+        await asyncio.to_thread(database.finish_payment, provider, payment_id, 'fulfilled')
+    elif outcome == FAILED or attempts >= MAX_ATTEMPTS:
+        logger.error(f"Payment {provider}:{payment_id} failed after {attempts} attempt(s): {error}")
+        await asyncio.to_thread(database.finish_payment, provider, payment_id, 'failed', error)
+    else:
+        delay = retry_delay(attempts)
+        logger.warning(f"Payment {provider}:{payment_id} attempt {attempts} failed, retry in {delay:.0f}s: {error}")
+        await asyncio.to_thread(database.retry_payment, provider, payment_id, time.time() + delay, error)
+
+async def _worker(bot: Bot, processor: Processor):
+    while True:
+        # Сброс до выборки: enqueue, пришедший во время выборки, не теряется
+        _wakeup.clear()
+        job = await asyncio.to_thread(database.claim_next_payment)
+        if job:
+            await _run_one(bot, processor, job)
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+def start(bot: Bot, processor: Processor, workers: int = WORKERS):
+    """Запускает пул воркеров в текущем цикле; прерванные платежи возвращаются в очередь."""
+    global _loop, _wakeup
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    recovered = database.reset_processing_payments()
+    if recovered:
+        logger.warning(f"Re-queued {recovered} payment(s) interrupted by restart")
+    for _ in range(max(1, workers)):
+        _workers.append(asyncio.create_task(_worker(bot, processor)))
+
+async def stop():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
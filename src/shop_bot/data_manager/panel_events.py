@@ -0,0 +1,97 @@
+"""
+Приём событий-вебхуков панели Remnawave.
+
+Панель подписывает тело запроса HMAC-SHA256 (заголовок X-Remnawave-Signature,
+секрет WEBHOOK_SECRET_HEADER панели = REMNA_WEBHOOK_SECRET бота). Повторные
+доставки отсекаются по хешу тела в таблице panel_events. Событие обновляет
+зеркало panel_users и даты ключей и сразу отправляет пользователю уведомление;
+периодический опрос в scheduler остаётся редкой сверкой.
+"""
+import hashlib
+import hmac
+import logging
+import os
+from datetime import datetime
+from typing import Optional
+
+from aiogram import Bot
+
+from shop_bot.data_manager import database, scheduler
+from shop_bot.utils.logger import bot_logger
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_SECRET = os.getenv("REMNA_WEBHOOK_SECRET")
+SIGNATURE_HEADER = "X-Remnawave-Signature"
+
+# Событие о скором истечении -> сколько дней осталось (для отметок EXPIRY_NOTIFY_DAYS)
+EXPIRY_EVENTS = {
+    "user.expires_in_72_hours": 3,
+    "user.expires_in_48_hours": 2,
+    "user.expires_in_24_hours": 1,
+    "user.expired": 0,
+}
+
+def verify_signature(raw_body: bytes, signature: Optional[str], secret: Optional[str] = None) -> bool:
+    secret = secret or WEBHOOK_SECRET
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), raw_body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())
+
+def event_key(raw_body: bytes) -> str:
+    return hashlib.sha256(raw_body).hexdigest()
+
+def event_telegram_id(payload: dict) -> Optional[int]:
+    data = payload.get("data") or {}
+    telegram_id = data.get("telegramId")
+    try:
+        return int(telegram_id) if telegram_id is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def accept_event(raw_body: bytes, payload: dict) -> bool:
+    """Регистрирует событие; False — если это повтор уже принятого."""
+    return database.record_panel_event(event_key(raw_body), payload.get("event", ""), event_telegram_id(payload))
+
+async def handle_event(bot: Bot, payload: dict):
+    event = payload.get("event", "")
+    data = payload.get("data") or {}
+    telegram_id = event_telegram_id(payload)
+    if not event.startswith("user.") or telegram_id is None:
+        return
+    logger.info(f"Panel event {event} for {telegram_id}")
+
+    database.upsert_panel_user(telegram_id, data)
+    user_keys = database.get_user_keys(telegram_id)
+    if not user_keys:
+        return
+
+    expire_iso = data.get("expireAt")
+    if expire_iso:
+        try:
+            expire_dt = datetime.fromisoformat(expire_iso.replace('Z', '+00:00'))
+            database.set_users_keys_expiry([(telegram_id, int(expire_dt.timestamp() * 1000))])
+        except ValueError:
+            logger.warning(f"Bad expireAt in panel event {event}: {expire_iso}")
+
+    first_key_email = user_keys[0]['key_email']
+    try:
+        if event in EXPIRY_EVENTS:
+            await scheduler.notify_expiry(bot, telegram_id, EXPIRY_EVENTS[event])
+        elif event == "user.limited":
+            limit = data.get("trafficLimitBytes") or 0
+            if limit > 0:
+                used = max(data.get("usedTrafficBytes") or 0, limit)
+                await scheduler.notify_traffic(bot, telegram_id, first_key_email, used, limit)
+        elif event == "user.traffic_reset":
+            database.update_key_last_notified_percent(first_key_email, 0)
+        elif event == "user.disabled":
+            await bot.send_message(telegram_id, "⛔️ Ваша подписка отключена. Обратитесь в поддержку.")
+            bot_logger.notification(telegram_id, "DISABLED", True)
+        elif event == "user.enabled":
+            await bot.send_message(telegram_id, "✅ Ваша подписка снова активна.")
+            bot_logger.notification(telegram_id, "ENABLED", True)
+    except Exception as e:
+        bot_logger.notification(telegram_id, event, False)
+        logger.error(f"Failed to notify {telegram_id} about {event}: {e}")
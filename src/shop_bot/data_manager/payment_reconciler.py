@@ -0,0 +1,114 @@
+"""
+Сверка неоплаченных заказов с провайдерами на случай потери вебхука.
+
+Раз в RECONCILE_INTERVAL_SECONDS заказы YooKassa и Heleket, ожидающие оплаты
+дольше RECONCILE_AFTER_SECONDS, проверяются запросом статуса к провайдеру
+(пачками, с ограниченной параллельностью, через общую HTTP-сессию).
+Подтверждённые платежи ставятся в обычную очередь выдачи с тем же id
+платежа, что и у вебхука, поэтому поздний вебхук не приведёт к повторной
+выдаче. Заказы старше RECONCILE_MAX_AGE_SECONDS считаются брошенными.
+"""
+import asyncio
+import logging
+import os
+from typing import Optional, Tuple
+
+from shop_bot.data_manager import database, fulfilment
+from shop_bot.modules import heleket_api, yookassa_api
+from shop_bot.utils.logger import bot_logger
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("PAYMENT_RECONCILE_INTERVAL_SECONDS", "300"))
+RECONCILE_AFTER_SECONDS = int(os.getenv("PAYMENT_RECONCILE_AFTER_SECONDS", "300"))
+RECONCILE_MAX_AGE_SECONDS = int(os.getenv("PAYMENT_RECONCILE_MAX_AGE_SECONDS", str(48 * 3600)))
+RECONCILE_BATCH_SIZE = 200
+RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "8"))
+
+PROVIDERS = ("yookassa", "heleket")
+
+async def _check_yookassa(order: dict) -> Tuple[Optional[str], Optional[str]]:
+    """(итоговый статус заказа или None, id платежа у провайдера)."""
+    payment_id = order.get("provider_payment_id")
+    if not payment_id:
+        return None, None
+    payment = await yookassa_api.get_payment(payment_id)
+    if not payment:
+        return None, payment_id
+    if payment.get("status") == "succeeded" and payment.get("paid"):
+        return "paid", payment_id
+    if payment.get("status") == "canceled":
+        return "canceled", payment_id
+    return None, payment_id
+
+async def _check_heleket(order: dict) -> Tuple[Optional[str], Optional[str]]:
+    info = await heleket_api.get_payment_info(order["order_id"])
+    if not info:
+        return None, order.get("provider_payment_id")
+    payment_id = info.get("uuid") or order.get("provider_payment_id") or order["order_id"]
+    status = info.get("payment_status") or info.get("status")
+    if status in heleket_api.PAID_STATUSES:
+        return "paid", payment_id
+    if status in heleket_api.FINAL_UNPAID_STATUSES:
+        return "canceled", payment_id
+    return None, payment_id
+
+_CHECKS = {
+    "yookassa": _check_yookassa,
+    "heleket": _check_heleket,
+}
+
+async def reconcile_order(order: dict) -> Optional[str]:
+    order_id, provider = order["order_id"], order["provider"]
+    try:
+        status, payment_id = await _CHECKS[provider](order)
+    except Exception as e:
+        logger.error(f"Reconcile of order {order_id} ({provider}) failed: {e}")
+        return None
+    if status == "paid":
+        # Тот же ключ (provider, payment_id), что и у вебхука: дубль отсечёт ledger
+        if await asyncio.to_thread(fulfilment.enqueue, provider, payment_id, {"order_id": order_id}):
+            bot_logger.payment(order.get("user_id"), provider.upper(), order.get("price"), "RECONCILED")
+    elif status == "canceled":
+        await asyncio.to_thread(database.set_pending_order_status, order_id, "canceled")
+    return status
+
+async def run_reconcile_cycle(concurrency: int = RECONCILE_CONCURRENCY) -> dict:
+    """Один проход сверки. Возвращает счётчики по итоговым статусам."""
+    counts = {"checked": 0, "paid": 0, "canceled": 0}
+    counts["expired"] = await asyncio.to_thread(database.expire_pending_orders, RECONCILE_MAX_AGE_SECONDS)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def check(order: dict):
+        async with semaphore:
+            return await reconcile_order(order)
+
+    # Пачки идут по возрастанию created_at; обработанные заказы уходят из статуса
+    # 'pending', а для не решённых смещаемся по списку вперёд
+    seen: set[str] = set()
+    while True:
+        orders = [
+            order for order in await asyncio.to_thread(
+                database.get_stale_pending_orders, PROVIDERS, RECONCILE_AFTER_SECONDS, RECONCILE_MAX_AGE_SECONDS, len(seen) + RECONCILE_BATCH_SIZE
+            )
+            if order["order_id"] not in seen
+        ]
+        if not orders:
+            break
+        seen.update(order["order_id"] for order in orders)
+        for status in await asyncio.gather(*(check(order) for order in orders)):
+            counts["checked"] += 1
+            if status in counts:
+                counts[status] += 1
+    return counts
+
+async def start_payment_reconciler():
+    bot_logger.system("PAYMENTS", "Payment reconciler started", "OK")
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+        try:
+            counts = await run_reconcile_cycle()
+            if counts["checked"] or counts["expired"]:
+                bot_logger.system("PAYMENTS", f"Reconcile: {counts}", "OK")
+        except Exception as e:
+            bot_logger.error(f"Payment reconciler error: {e}", exc_info=True)
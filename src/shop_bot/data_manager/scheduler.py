@@ -1,15 +1,21 @@
 import asyncio
 import logging
+import os
 from datetime import datetime, timezone
 import shutil
+import time
 from pathlib import Path
+from typing import Tuple
 from aiogram import Bot
-from shop_bot.data_manager import database
+from shop_bot.data_manager import database, panel_events
 from shop_bot.modules import remnawave_api
 from shop_bot.utils.logger import bot_logger
-import aiohttp
+from shop_bot.utils.http import get_session
 
 CHECK_INTERVAL_SECONDS = 300
+# При включённых вебхуках панели полный опрос остаётся только редкой сверкой,
+# а между сверками проход проверяет лишь пользователей с автопродлением
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("REMNA_RECONCILE_INTERVAL_SECONDS", "3600"))
 EXPIRY_NOTIFY_DAYS = [7, 3, 1, 0]
 logger = logging.getLogger(__name__)
 
@@ -17,145 +23,173 @@ THRESHOLDS = [50, 80, 90, 100]
 
 BACKUP_INTERVAL_HOURS = 6  # Продакшн значение - бэкап каждые 6 часов
 
+async def notify_expiry(bot: Bot, user_id: int, days_left: int) -> int:
+    """Уведомление об истечении подписки, не чаще одного раза на каждую отметку EXPIRY_NOTIFY_DAYS."""
+    last_days_notified = database.get_last_expiry_notified_days(user_id)
+    # Ближайшая отметка: при days_left=1 пишем «через 1 дн.», а не «через 7 дн.»
+    for mark in sorted(EXPIRY_NOTIFY_DAYS):
+        if days_left <= mark and last_days_notified > mark:
+            sent = 0
+            try:
+                if mark > 0:
+                    await bot.send_message(user_id, f"⏳ Ваша подписка истекает через {mark} дн.")
+                    bot_logger.notification(user_id, f"EXPIRY_{mark}D", True)
+                else:
+                    await bot.send_message(user_id, f"❗️ Ваша подписка истекла.")
+                    bot_logger.notification(user_id, "EXPIRED", True)
+                sent = 1
+            except Exception as e:
+                bot_logger.notification(user_id, f"EXPIRY_{mark}D", False)
+            database.update_last_expiry_notified_days(user_id, mark)
+            return sent
+    return 0
+
+async def notify_traffic(bot: Bot, user_id: int, key_email: str, used: int, limit: int) -> int:
+    """Уведомления о достижении порогов THRESHOLDS по трафику."""
+    sent = 0
+    percent = int((used / limit) * 100)
+    last_notified = database.get_key_last_notified_percent(key_email)
+    for th in THRESHOLDS:
+        if percent >= th and last_notified < th:
+            try:
+                human_used = used/1024/1024/1024
+                human_limit = limit/1024/1024/1024
+                await bot.send_message(
+                    chat_id=user_id,
+                    text=(f"⚠️ Трафик ключа {key_email} достиг {th}%\n"
+                          f"Использовано: {human_used:.1f} ГБ из {human_limit:.0f} ГБ.")
+                )
+                bot_logger.notification(user_id, f"TRAFFIC_{th}%", True)
+                sent += 1
+            except Exception as e:
+                bot_logger.notification(user_id, f"TRAFFIC_{th}%", False)
+            database.update_key_last_notified_percent(key_email, th)
+    if percent < 5 and used < 1_000_000 and last_notified >= 50:
+        database.update_key_last_notified_percent(key_email, 0)
+    return sent
+
+async def check_user(bot: Bot, session, user_id: int) -> Tuple[int, bool]:
+    """Сверяет одного пользователя с панелью: даты ключей, уведомления, автопродление, трафик.
+    Возвращает (отправлено уведомлений, без ошибок)."""
+    notifications_sent = 0
+    user_profile = database.get_user(user_id)
+    auto_renew = user_profile.get('auto_renew') if user_profile else 0
+    user_keys = database.get_user_keys(user_id)
+    
+    if not user_keys:
+        return notifications_sent, True
+        
+    # Получаем общую информацию о пользователе (теперь все ключи в одном профиле)
+    remote = await remnawave_api.get_user_by_telegram_id(session, str(user_id))
+    if not remote:
+        return notifications_sent, True
+    database.upsert_panel_user(user_id, remote)
+        
+    expire_iso = remote.get('expireAt')
+    if not expire_iso:
+        return notifications_sent, True
+        
+    try:
+        remote_dt = datetime.fromisoformat(expire_iso.replace('Z', '+00:00'))
+        remote_ms = int(remote_dt.timestamp() * 1000)
+        
+        # Обновляем дату истечения для всех ключей пользователя
+        for key in user_keys:
+            key_email = key['key_email']
+            local_dt = datetime.fromisoformat(key['expiry_date'])
+            local_ms = int(local_dt.timestamp() * 1000)
+            
+            if abs(remote_ms - local_ms) > 1000:
+                class _Obj: pass
+                o = _Obj()
+                o.expiry_time = remote_ms
+                o.id = remote.get('vlessUuid')
+                database.update_key_status_from_server(key_email, o)
+        
+        # Уведомления об истечении (отправляем только один раз для пользователя)
+        # Конвертируем remote_dt в локальное время для корректного сравнения
+        now_local = datetime.now()
+        remote_local = remote_dt.replace(tzinfo=None)  # убираем timezone info
+        days_left = (remote_local - now_local).days
+        notifications_sent += await notify_expiry(bot, user_id, days_left)
+        
+        # Auto renew placeholder (применяем к первому ключу)
+        if auto_renew and days_left == 0 and user_keys:
+            key = user_keys[0]  # Берем первый ключ для автопродления
+            try:
+                plan = key.get('subscription_plan') or 'buy_1_month'
+                from shop_bot.config import PLANS
+                name, price_rub, months = PLANS.get(plan, (None, None, 1))
+                extend_days = months * 30
+                key_email = key['key_email']
+                uri, new_expire_iso, new_uuid = await remnawave_api.provision_key(key_email, days=extend_days, telegram_id=str(user_id))
+                if uri and new_expire_iso and new_uuid:
+                    new_dt = datetime.fromisoformat(new_expire_iso.replace('Z', '+00:00'))
+                    # обновим локально для всех ключей пользователя
+                    from shop_bot.data_manager.database import update_key_info, log_action, update_user_stats
+                    for user_key in user_keys:
+                        update_key_info(user_key['key_id'], new_uuid, int(new_dt.timestamp()*1000))
+                    update_user_stats(user_id, float(price_rub) if price_rub else 0.0, months)
+                    log_action(user_id, 'auto_renew_success', f"{key['key_id']}:{months}")
+                    try:
+                        await bot.send_message(user_id, f"🔁 Подписка автоматически продлена на {months} мес. до {new_dt.strftime('%d.%m.%Y %H:%M')}")
+                        bot_logger.vpn_action(user_id, "AUTO_RENEW", f"{months} months")
+                    except Exception:
+                        pass
+                else:
+                    from shop_bot.data_manager.database import log_action
+                    log_action(user_id, 'auto_renew_fail', str(key['key_id']))
+                    try:
+                        await bot.send_message(user_id, f"⚠️ Автопродление не удалось. Продлите вручную.")
+                        bot_logger.vpn_action(user_id, "AUTO_RENEW_FAILED", "Payment failed")
+                    except Exception:
+                        pass
+            except Exception as e:
+                bot_logger.error(f"💥 Auto renew error for user {user_id}: {e}", exc_info=True)
+    
+    except Exception as e:
+        bot_logger.error(f"Error processing user {user_id}: {e}", exc_info=True)
+        return notifications_sent, False
+        
+    # Проверка лимитов трафика
+    if remote and user_keys:  # Добавляем проверку user_keys
+        # Используем первый ключ для уведомлений о трафике
+        first_key_email = user_keys[0]['key_email']
+        limit = remote.get('trafficLimitBytes', 0)
+        used = remote.get('usedTrafficBytes', 0)
+        if not limit or limit <= 0:
+            return notifications_sent, True
+        notifications_sent += await notify_traffic(bot, user_id, first_key_email, used, limit)
+    return notifications_sent, True
+
+async def run_monitor_cycle(bot: Bot, session, auto_renew_only: bool = False) -> Tuple[int, int, int]:
+    """Один проход монитора по всем пользователям с ключами (auto_renew_only — только с автопродлением).
+    Возвращает (обработано пользователей, отправлено уведомлений, ошибок)."""
+    users_processed = 0
+    notifications_sent = 0
+    errors_count = 0
+    for user_entry in database.get_all_vpn_users(auto_renew_only):
+        users_processed += 1
+        sent, ok = await check_user(bot, session, user_entry['user_id'])
+        notifications_sent += sent
+        if not ok:
+            errors_count += 1
+    return users_processed, notifications_sent, errors_count
+
 async def start_subscription_monitor(bot: Bot):
     bot_logger.system("MONITOR", "Subscription monitor started", "OK")
+    last_full_poll = None
     while True:
         try:
-            vpn_users = database.get_all_vpn_users()
-            if not vpn_users:
-                await asyncio.sleep(CHECK_INTERVAL_SECONDS)
-                continue
-            async with aiohttp.ClientSession() as session:
-                users_processed = 0
-                notifications_sent = 0
-                errors_count = 0
-                
-                for user_entry in vpn_users:
-                    users_processed += 1
-                    user_id = user_entry['user_id']
-                    user_profile = database.get_user(user_id)
-                    auto_renew = user_profile.get('auto_renew') if user_profile else 0
-                    user_keys = database.get_user_keys(user_id)
-                    
-                    if not user_keys:
-                        continue
-                        
-                    # Получаем общую информацию о пользователе (теперь все ключи в одном профиле)
-                    remote = await remnawave_api.get_user_by_telegram_id(session, str(user_id))
-                    if not remote:
-                        continue
-                        
-                    expire_iso = remote.get('expireAt')
-                    if not expire_iso:
-                        continue
-                        
-                    try:
-                        remote_dt = datetime.fromisoformat(expire_iso.replace('Z', '+00:00'))
-                        remote_ms = int(remote_dt.timestamp() * 1000)
-                        
-                        # Обновляем дату истечения для всех ключей пользователя
-                        for key in user_keys:
-                            key_email = key['key_email']
-                            local_dt = datetime.fromisoformat(key['expiry_date'])
-                            local_ms = int(local_dt.timestamp() * 1000)
-                            
-                            if abs(remote_ms - local_ms) > 1000:
-                                class _Obj: pass
-                                o = _Obj()
-                                o.expiry_time = remote_ms
-                                o.id = remote.get('vlessUuid')
-                                database.update_key_status_from_server(key_email, o)
-                        
-                        # Уведомления об истечении (отправляем только один раз для пользователя)
-                        # Конвертируем remote_dt в локальное время для корректного сравнения
-                        now_local = datetime.now()
-                        remote_local = remote_dt.replace(tzinfo=None)  # убираем timezone info
-                        days_left = (remote_local - now_local).days
-                        last_days_notified = database.get_last_expiry_notified_days(user_id)
-                        for mark in EXPIRY_NOTIFY_DAYS:
-                            if days_left <= mark and last_days_notified > mark:
-                                try:
-                                    if mark > 0:
-                                        await bot.send_message(user_id, f"⏳ Ваша подписка истекает через {mark} дн.")
-                                        bot_logger.notification(user_id, f"EXPIRY_{mark}D", True)
-                                    else:
-                                        await bot.send_message(user_id, f"❗️ Ваша подписка истекла.")
-                                        bot_logger.notification(user_id, "EXPIRED", True)
-                                    notifications_sent += 1
-                                except Exception as e:
-                                    bot_logger.notification(user_id, f"EXPIRY_{mark}D", False)
-                                database.update_last_expiry_notified_days(user_id, mark)
-                                break
-                        
-                        # Auto renew placeholder (применяем к первому ключу)
-                        if auto_renew and days_left == 0 and user_keys:
-                            key = user_keys[0]  # Берем первый ключ для автопродления
-                            try:
-                                plan = key.get('subscription_plan') or 'buy_1_month'
-                                from shop_bot.config import PLANS
-                                name, price_rub, months = PLANS.get(plan, (None, None, 1))
-                                extend_days = months * 30
-                                key_email = key['key_email']
-                                uri, new_expire_iso, new_uuid = await remnawave_api.provision_key(key_email, days=extend_days, telegram_id=str(user_id))
-                                if uri and new_expire_iso and new_uuid:
-                                    new_dt = datetime.fromisoformat(new_expire_iso.replace('Z', '+00:00'))
-                                    # обновим локально для всех ключей пользователя
-                                    from shop_bot.data_manager.database import update_key_info, log_action, update_user_stats
-                                    for user_key in user_keys:
-                                        update_key_info(user_key['key_id'], new_uuid, int(new_dt.timestamp()*1000))
-                                    update_user_stats(user_id, float(price_rub) if price_rub else 0.0, months)
-                                    log_action(user_id, 'auto_renew_success', f"{key['key_id']}:{months}")
-                                    try:
-                                        await bot.send_message(user_id, f"🔁 Подписка автоматически продлена на {months} мес. до {new_dt.strftime('%d.%m.%Y %H:%M')}")
-                                        bot_logger.vpn_action(user_id, "AUTO_RENEW", f"{months} months")
-                                    except Exception:
-                                        pass
-                                else:
-                                    from shop_bot.data_manager.database import log_action
-                                    log_action(user_id, 'auto_renew_fail', str(key['key_id']))
-                                    try:
-                                        await bot.send_message(user_id, f"⚠️ Автопродление не удалось. Продлите вручную.")
-                                        bot_logger.vpn_action(user_id, "AUTO_RENEW_FAILED", "Payment failed")
-                                    except Exception:
-                                        pass
-                            except Exception as e:
-                                bot_logger.error(f"💥 Auto renew error for user {user_id}: {e}", exc_info=True)
-                    
-                    except Exception as e:
-                        bot_logger.error(f"Error processing user {user_id}: {e}", exc_info=True)
-                        errors_count += 1
-                        continue
-                        
-                    # Проверка лимитов трафика
-                    if remote and user_keys:  # Добавляем проверку user_keys
-                        # Используем первый ключ для уведомлений о трафике
-                        first_key_email = user_keys[0]['key_email']
-                        limit = remote.get('trafficLimitBytes', 0)
-                        used = remote.get('usedTrafficBytes', 0)
-                        if not limit or limit <= 0:
-                            continue
-                        percent = int((used / limit) * 100)
-                        last_notified = database.get_key_last_notified_percent(first_key_email)
-                        for th in THRESHOLDS:
-                            if percent >= th and last_notified < th:
-                                try:
-                                    human_used = used/1024/1024/1024
-                                    human_limit = limit/1024/1024/1024
-                                    await bot.send_message(
-                                        chat_id=user_id,
-                                        text=(f"⚠️ Трафик ключа {first_key_email} достиг {th}%\n"
-                                              f"Использовано: {human_used:.1f} ГБ из {human_limit:.0f} ГБ.")
-                                    )
-                                    bot_logger.notification(user_id, f"TRAFFIC_{th}%", True)
-                                except Exception as e:
-                                    bot_logger.notification(user_id, f"TRAFFIC_{th}%", False)
-                                database.update_key_last_notified_percent(first_key_email, th)
-                        if percent < 5 and used < 1_000_000 and last_notified >= 50:
-                            database.update_key_last_notified_percent(first_key_email, 0)
-                
-                # Итоговая статистика цикла мониторинга
-                if users_processed > 0:
-                    bot_logger.system("MONITOR", f"Cycle: {users_processed} users, {notifications_sent} notifications, {errors_count} errors", "OK" if errors_count == 0 else "WARNING")
+            full_poll = (not panel_events.WEBHOOK_SECRET or last_full_poll is None
+                         or time.monotonic() - last_full_poll >= RECONCILE_INTERVAL_SECONDS)
+            if full_poll:
+                last_full_poll = time.monotonic()
+            users_processed, notifications_sent, errors_count = await run_monitor_cycle(bot, get_session(), auto_renew_only=not full_poll)
+            
+            # Итоговая статистика цикла мониторинга
+            if users_processed > 0:
+                bot_logger.system("MONITOR", f"Cycle: {users_processed} users, {notifications_sent} notifications, {errors_count} errors", "OK" if errors_count == 0 else "WARNING")
                 
         except Exception as e:
             bot_logger.error(f"Monitor loop critical error: {e}", exc_info=True)
@@ -0,0 +1,59 @@
+"""
+Heleket payment status lookup on the shared aiohttp session.
+
+Used by the payment reconciler when a crypto webhook did not arrive:
+  POST /v1/payment/info  {"order_id": ...} -> payment with its status
+
+Requests are signed as Heleket expects: `merchant` header plus
+`sign` = md5(base64(body) + API key).
+"""
+import base64
+import hashlib
+import logging
+import os
+from typing import Optional
+
+import aiohttp
+
+from shop_bot.utils import json_codec
+from shop_bot.utils.http import get_session
+
+logger = logging.getLogger(__name__)
+
+API_URL = os.getenv("HELEKET_API_URL", "https://api.heleket.com/v1").rstrip("/")
+MERCHANT_ID = os.getenv("CRYPTO_MERCHANT_ID")
+API_KEY = os.getenv("CRYPTO_API_KEY")
+
+PAID_STATUSES = ("paid", "paid_over")
+FINAL_UNPAID_STATUSES = ("cancel", "fail", "system_fail", "refund_paid")
+
+def configure(merchant_id: str, api_key: str):
+    global MERCHANT_ID, API_KEY
+    MERCHANT_ID = merchant_id
+    API_KEY = api_key
+
+def sign_body(body: bytes, api_key: str) -> str:
+    return hashlib.md5(base64.b64encode(body) + api_key.encode('utf-8')).hexdigest()
+
+async def get_payment_info(order_id: str, session: Optional[aiohttp.ClientSession] = None) -> Optional[dict]:
+    """Returns the payment object ("result") for our order_id, or None on error."""
+    if not MERCHANT_ID or not API_KEY:
+        logger.error("Heleket config incomplete: CRYPTO_MERCHANT_ID or CRYPTO_API_KEY missing")
+        return None
+    body = json_codec.dumps_bytes({"order_id": order_id})
+    headers = {
+        "merchant": MERCHANT_ID,
+        "sign": sign_body(body, API_KEY),
+        "Content-Type": "application/json",
+    }
+    session = session or get_session()
+    try:
+        async with session.post(f"{API_URL}/payment/info", data=body, headers=headers) as resp:
+            raw, data = await json_codec.read_json(resp)
+            if resp.status >= 400 or not isinstance(data, dict):
+                logger.error(f"Heleket payment/info {order_id} failed {resp.status}: {json_codec.preview(raw, 500)}")
+                return None
+            return data.get("result") or None
+    except Exception as e:
+        logger.error(f"Heleket HTTP error for order {order_id}: {e}")
+        return None
@@ -0,0 +1,219 @@
+"""
+Throughput benchmark for the panel client against the in-process PanelStub.
+
+Scenarios:
+  provision  — provision_key for new and existing users
+  traffic    — add_extra_traffic for existing users
+  monitor    — one subscription monitor pass (check_user per user)
+  contention — concurrent 1-day extensions of ONE user; reports how many
+               extensions were lost (must be 0 with per-user locks)
+
+Usage:
+    python -m shop_bot.modules.panel_bench --scenario all --requests 2000 --concurrency 50 --latency 0.02
+
+The bench uses its own temporary SQLite file and never touches data/shop_bot.db.
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, List
+
+from shop_bot.data_manager import database
+from shop_bot.modules import remnawave_api
+from shop_bot.modules.panel_stub import PanelStub, STUB_TOKEN
+from shop_bot.utils.http import get_session, close_session
+
+class _NullBot:
+    """Заглушка aiogram.Bot: монитору нужен только send_message."""
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, *args, **kwargs):
+        self.sent += 1
+
+def _point_client_at(stub: PanelStub):
+    remnawave_api.BASE_URL = stub.base_url
+    remnawave_api.API_TOKEN = STUB_TOKEN
+    remnawave_api.HEADERS = {"Authorization": f"Bearer {STUB_TOKEN}"}
+    remnawave_api.INBOUND_TAG = stub.inbound_tag
+    remnawave_api.INBOUND_UUID = None
+    remnawave_api._INBOUND_CACHE = None
+
+def _percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+async def _drive(ops: List[Callable[[], Awaitable[object]]], concurrency: int) -> dict:
+    latencies: List[float] = []
+    failures = 0
+    queue: asyncio.Queue = asyncio.Queue()
+    for op in ops:
+        queue.put_nowait(op)
+
+    async def worker():
+        nonlocal failures
+        while True:
+            try:
+                op = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started = time.perf_counter()
+            try:
+                ok = await op()
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            if not ok:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(ops))))))
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": len(ops),
+        "failures": failures,
+        "elapsed": elapsed,
+        "throughput": len(ops) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "mean_ms": (statistics.fmean(latencies) * 1000) if latencies else 0.0,
+    }
+
+async def bench_provision(stub: PanelStub, requests: int, concurrency: int) -> dict:
+    existing = stub.seed_users(requests // 2, first_telegram_id=500000)
+    ops = []
+    for i in range(requests):
+        if i < len(existing):
+            telegram_id = existing[i]["telegramId"]
+        else:
+            telegram_id = 600000 + i
+        email = f"user{telegram_id}-key1@kitsura.fun"
+
+        async def op(email=email, telegram_id=telegram_id):
+            uri, expire_iso, vless_uuid = await remnawave_api.provision_key(email, days=30, telegram_id=str(telegram_id))
+            return bool(uri and expire_iso and vless_uuid)
+        ops.append(op)
+    return await _drive(ops, concurrency)
+
+async def bench_traffic(stub: PanelStub, requests: int, concurrency: int) -> dict:
+    users = stub.seed_users(requests, first_telegram_id=700000)
+    ops = []
+    for user in users:
+        async def op(user=user):
+            return await remnawave_api.add_extra_traffic(user["email"], 10, telegram_id=str(user["telegramId"]))
+        ops.append(op)
+    return await _drive(ops, concurrency)
+
+async def bench_monitor(stub: PanelStub, requests: int, concurrency: int) -> dict:
+    from shop_bot.data_manager import scheduler
+
+    users = stub.seed_users(requests, first_telegram_id=800000)
+    for user in users:
+        database.register_user_if_not_exists(user["telegramId"], user["username"])
+        database.add_new_key(user["telegramId"], user["vlessUuid"], user["email"], int(time.time() * 1000) + 86400000)
+    bot = _NullBot()
+    session = get_session()
+    ops = []
+    for user in users:
+        async def op(user_id=user["telegramId"]):
+            _, ok = await scheduler.check_user(bot, session, user_id)
+            return ok
+        ops.append(op)
+    result = await _drive(ops, concurrency)
+    result["notifications"] = bot.sent
+    return result
+
+async def bench_contention(stub: PanelStub, requests: int, concurrency: int) -> dict:
+    from datetime import datetime
+
+    user = stub.seed_users(1, first_telegram_id=900000)[0]
+    telegram_id = str(user["telegramId"])
+    start_expiry = datetime.fromisoformat(user["expireAt"].replace('Z', '+00:00'))
+    ops = []
+    for _ in range(requests):
+        async def op():
+            uri, expire_iso, _ = await remnawave_api.provision_key(user["email"], days=1, telegram_id=telegram_id)
+            return bool(uri and expire_iso)
+        ops.append(op)
+    result = await _drive(ops, concurrency)
+    final_expiry = datetime.fromisoformat(stub.users[user["uuid"]]["expireAt"].replace('Z', '+00:00'))
+    added_days = round((final_expiry - start_expiry).total_seconds() / 86400)
+    result["lost"] = requests - result["failures"] - added_days
+    return result
+
+class _TempDatabase:
+    """Временно перенаправляет database.DB_FILE во временный файл."""
+    def __init__(self, database_module):
+        self._db = database_module
+        self._tmp = tempfile.TemporaryDirectory(prefix="panel_bench_")
+
+    def __enter__(self):
+        self._saved = self._db.DB_FILE
+        self._db.DB_FILE = Path(self._tmp.name) / "bench.db"
+        return self._db.DB_FILE
+
+    def __exit__(self, *exc):
+        self._db.DB_FILE = self._saved
+        self._tmp.cleanup()
+
+SCENARIOS = {
+    "provision": bench_provision,
+    "traffic": bench_traffic,
+    "monitor": bench_monitor,
+    "contention": bench_contention,
+}
+
+def _report(name: str, result: dict):
+    extra = f", notifications={result['notifications']}" if "notifications" in result else ""
+    if "lost" in result:
+        extra += f", lost_updates={result['lost']}"
+    print(
+        f"{name:<10} ops={result['ops']:<6} failures={result['failures']:<5} "
+        f"{result['throughput']:8.1f} ops/s  p50={result['p50_ms']:7.2f} ms  "
+        f"p99={result['p99_ms']:7.2f} ms  mean={result['mean_ms']:7.2f} ms{extra}"
+    )
+
+async def run(scenarios: List[str], requests: int, concurrency: int, latency: float, jitter: float, error_rate: float) -> dict:
+    results = {}
+    for name in scenarios:
+        stub = PanelStub(latency=latency, jitter=jitter, error_rate=error_rate, seed=42)
+        await stub.start()
+        try:
+            _point_client_at(stub)
+            # Клиент пишет в зеркало panel_users — только во временную базу
+            with _TempDatabase(database):
+                database.initialize_db()
+                results[name] = await SCENARIOS[name](stub, requests, concurrency)
+            _report(name, results[name])
+        finally:
+            await close_session()
+            await stub.stop()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Remnawave client benchmark against the in-process panel stub")
+    parser.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.0, help="stub base latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="stub random extra latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of stub requests failing with 500")
+    args = parser.parse_args()
+
+    # Уведомления монитора иначе заливают вывод
+    logging.getLogger("ShopBot").setLevel(logging.WARNING)
+    logging.getLogger("shop_bot").setLevel(logging.CRITICAL)
+    scenarios = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    print(f"requests={args.requests} concurrency={args.concurrency} latency={args.latency}s "
+          f"jitter={args.jitter}s error_rate={args.error_rate}")
+    asyncio.run(run(scenarios, args.requests, args.concurrency, args.latency, args.jitter, args.error_rate))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+In-process stand-in for the Remnawave panel API (aiohttp.web).
+
+Implements only the endpoints the bot uses:
+  GET   /api/config-profiles/inbounds
+  GET   /api/users/by-telegram-id/{telegram_id}
+  GET   /api/users?start=&size=      (paged listing)
+  POST  /api/users
+  PATCH /api/users
+
+Latency and error injection are configured per stub instance. Used by
+panel_bench and for local runs without a live panel:
+    python -m shop_bot.modules.panel_stub --port 3010 --users 1000
+"""
+import asyncio
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from aiohttp import web
+
+from shop_bot.utils import json_codec
+
+STUB_TOKEN = "stub-token"
+STUB_INBOUND_TAG = "VLESS_STUB"
+
+def _iso(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def _json(data, status: int = 200) -> web.Response:
+    return web.Response(body=json_codec.dumps_bytes(data), status=status, content_type='application/json')
+
+class PanelStub:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 inbound_tag: str = STUB_INBOUND_TAG, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.inbound_tag = inbound_tag
+        self.users: Dict[str, dict] = {}
+        self.by_telegram_id: Dict[int, str] = {}
+        self.request_counts: Dict[str, int] = {}
+        self.injected_errors = 0
+        self.base_url: Optional[str] = None
+        self._random = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.inbound = {
+            "uuid": str(uuid.uuid4()),
+            "tag": inbound_tag,
+            "type": "vless",
+            "port": 443,
+            "network": "tcp",
+            "security": "reality",
+            "rawInbound": {
+                "streamSettings": {
+                    "realitySettings": {
+                        "serverNames": ["stub.example.com"],
+                        "shortIds": ["0123abcd"],
+                        "privateKey": "",
+                    }
+                }
+            },
+        }
+
+    # -------------------- state --------------------
+    def add_user(self, telegram_id: Optional[int], username: str, expire_at: str,
+                 traffic_limit_bytes: int = 0, used_traffic_bytes: int = 0, email: Optional[str] = None) -> dict:
+        now = _iso(datetime.now(timezone.utc))
+        user = {
+            "uuid": str(uuid.uuid4()),
+            "shortUuid": uuid.uuid4().hex[:16],
+            "username": username,
+            "email": email,
+            "status": "ACTIVE",
+            "telegramId": telegram_id,
+            "expireAt": expire_at,
+            "trafficLimitBytes": traffic_limit_bytes,
+            "trafficLimitStrategy": "MONTH",
+            "usedTrafficBytes": used_traffic_bytes,
+            "vlessUuid": str(uuid.uuid4()),
+            "subscriptionUrl": f"{self.base_url or 'http://stub'}/api/sub/{uuid.uuid4().hex[:16]}",
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        self.users[user["uuid"]] = user
+        if telegram_id is not None:
+            self.by_telegram_id.setdefault(int(telegram_id), user["uuid"])
+        return user
+
+    def seed_users(self, count: int, first_telegram_id: int = 100000, days: int = 30,
+                   traffic_limit_bytes: int = 500 * 1024 ** 3) -> list[dict]:
+        expire_at = _iso(datetime.now(timezone.utc) + timedelta(days=days))
+        return [
+            self.add_user(
+                first_telegram_id + i, f"user{first_telegram_id + i}-key1", expire_at,
+                traffic_limit_bytes, self._random.randint(0, traffic_limit_bytes),
+                email=f"user{first_telegram_id + i}-key1@kitsura.fun",
+            )
+            for i in range(count)
+        ]
+
+    # -------------------- middleware --------------------
+    @web.middleware
+    async def _inject(self, request: web.Request, handler):
+        route = f"{request.method} {request.match_info.route.resource.canonical if request.match_info.route.resource else request.path}"
+        self.request_counts[route] = self.request_counts.get(route, 0) + 1
+        if request.headers.get("Authorization") != f"Bearer {STUB_TOKEN}":
+            return _json({"message": "Unauthorized"}, status=401)
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.injected_errors += 1
+            return _json({"message": "Injected error"}, status=500)
+        return await handler(request)
+
+    # -------------------- handlers --------------------
+    async def _inbounds(self, request: web.Request) -> web.Response:
+        return _json({"response": {"total": 1, "inbounds": [self.inbound]}})
+
+    async def _by_telegram_id(self, request: web.Request) -> web.Response:
+        user_uuid = self.by_telegram_id.get(int(request.match_info["telegram_id"]))
+        if not user_uuid:
+            return _json({"message": "User not found"}, status=404)
+        return _json({"response": [self.users[user_uuid]]})
+
+    async def _list_users(self, request: web.Request) -> web.Response:
+        start = int(request.query.get("start", 0))
+        size = int(request.query.get("size", 25))
+        users = list(self.users.values())
+        return _json({"response": {"users": users[start:start + size], "total": len(users)}})
+
+    async def _create_user(self, request: web.Request) -> web.Response:
+        body = json_codec.loads(await request.read())
+        telegram_id = body.get("telegramId")
+        if telegram_id is not None and int(telegram_id) in self.by_telegram_id:
+            return _json({"message": "User already exists"}, status=400)
+        user = self.add_user(
+            telegram_id, body.get("username") or uuid.uuid4().hex[:12], body["expireAt"],
+            body.get("trafficLimitBytes") or 0, email=body.get("email"),
+        )
+        return _json({"response": user}, status=201)
+
+    async def _update_user(self, request: web.Request) -> web.Response:
+        body = json_codec.loads(await request.read())
+        user = self.users.get(body.get("uuid"))
+        if not user:
+            return _json({"message": "User not found"}, status=404)
+        for field in ("email", "expireAt", "trafficLimitBytes", "trafficLimitStrategy", "telegramId", "status"):
+            if field in body:
+                user[field] = body[field]
+        user["updatedAt"] = _iso(datetime.now(timezone.utc))
+        return _json({"response": user})
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject])
+        app.router.add_get("/api/config-profiles/inbounds", self._inbounds)
+        app.router.add_get("/api/users/by-telegram-id/{telegram_id}", self._by_telegram_id)
+        app.router.add_get("/api/users", self._list_users)
+        app.router.add_post("/api/users", self._create_user)
+        app.router.add_patch("/api/users", self._update_user)
+        return app
+
+    # -------------------- lifecycle --------------------
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{bound_host}:{bound_port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "PanelStub":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local Remnawave panel stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3010)
+    parser.add_argument("--users", type=int, default=0, help="pre-seeded users")
+    parser.add_argument("--latency", type=float, default=0.0, help="base latency, seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    args = parser.parse_args()
+
+    async def _serve():
+        stub = PanelStub(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+        stub.seed_users(args.users)
+        url = await stub.start(args.host, args.port)
+        print(f"Panel stub on {url} (REMNA_API_TOKEN={STUB_TOKEN}, REMNA_INBOUND_TAG={stub.inbound_tag})")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await stub.stop()
+
+    try:
+        asyncio.run(_serve())
+    except KeyboardInterrupt:
+        pass
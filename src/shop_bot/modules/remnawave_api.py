@@ -1,10 +1,16 @@
 import os
 import logging
 import base64
+import hashlib
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Tuple
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
 import aiohttp
+
+from shop_bot.data_manager import database
+from shop_bot.utils import json_codec
+from shop_bot.utils.http import get_session
+from shop_bot.utils.locks import KeyedLock
 try:
     from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
     _HAS_CRYPTO = True
@@ -45,23 +51,43 @@ class RemnaInbound:
         self.network = network
         self.security = security
         self.raw = raw or {}
+        # Changes whenever the inbound settings (and so every VLESS URI) change
+        self.version = hashlib.sha1(json_codec.dumps_bytes([uuid, tag, port, network, security, self.raw])).hexdigest()[:12]
 
 def _iso_expiry(days: int) -> str:
     return (datetime.now(timezone.utc) + timedelta(days=days)).replace(microsecond=0).isoformat().replace('+00:00', 'Z')
 
+def extend_expiry_iso(expire_at_iso: Optional[str], days: int) -> str:
+    """New expireAt: days are added to the current expiry, or to now if it already passed."""
+    now = datetime.now(timezone.utc)
+    try:
+        current_exp = datetime.fromisoformat(expire_at_iso.replace('Z', '+00:00')) if expire_at_iso else now
+    except Exception:
+        current_exp = now
+    base_dt = current_exp if current_exp > now else now
+    new_exp = base_dt + timedelta(days=days)
+    return new_exp.replace(microsecond=0).isoformat().replace('+00:00', 'Z')
+
+def _reached(current_iso: Optional[str], target_iso: Optional[str]) -> bool:
+    """True if the panel expiry is already at or past target_iso."""
+    try:
+        current = datetime.fromisoformat(current_iso.replace('Z', '+00:00'))
+        target = datetime.fromisoformat(target_iso.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return False
+    return current >= target
+
 async def _fetch_json(session: aiohttp.ClientSession, method: str, path: str, **kwargs) -> Optional[dict]:
     url = f"{BASE_URL}{path}"
     try:
         async with session.request(method, url, headers=HEADERS, **kwargs) as resp:
-            txt = await resp.text()
+            raw, data = await json_codec.read_json(resp)
             if resp.status >= 400:
-                logger.error(f"Remna API {method} {path} failed {resp.status}: {txt}")
-                return None
-            try:
-                return await resp.json()
-            except Exception:
-                logger.error(f"Failed to parse JSON from {path}: {txt[:200]}")
+                logger.error(f"Remna API {method} {path} failed {resp.status}: {json_codec.preview(raw, 1000)}")
                 return None
+            if data is None:
+                logger.error(f"Failed to parse JSON from {path}: {json_codec.preview(raw)}")
+            return data
     except Exception as e:
         logger.error(f"HTTP error {method} {path}: {e}")
         return None
@@ -105,23 +131,37 @@ TRAFFIC_LIMIT_GB = int(os.getenv("REMNA_TRAFFIC_LIMIT_GB", "500"))  # 500 GB def
 TRAFFIC_LIMIT_BYTES = TRAFFIC_LIMIT_GB * 1024 * 1024 * 1024
 TRAFFIC_STRATEGY = os.getenv("REMNA_TRAFFIC_STRATEGY", "MONTH")  # MONTH resets monthly in panel
 
-async def create_or_extend_user(session: aiohttp.ClientSession, inbound: RemnaInbound, email: str, days_to_add: int, telegram_id: str = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+# expireAt and trafficLimitBytes are read-modify-write on the panel: operations
+# of one user run one at a time, different users stay fully parallel.
+user_locks = KeyedLock()
+
+# Retries of one paid order: `target` is what the previous attempt was about to
+# write (None on the first attempt). If the panel already shows it, the write got
+# through and is not repeated. Otherwise `on_target(new_value)` is awaited under
+# the user lock before the write, so the caller can store it for its next retry.
+OnTarget = Callable[..., Awaitable[None]]
+
+async def create_or_extend_user(session: aiohttp.ClientSession, inbound: RemnaInbound, email: str, days_to_add: int, telegram_id: str = None,
+                                target_expiry: Optional[str] = None, on_target: Optional[OnTarget] = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     """Returns (vless_uuid, subscription_url, expire_iso)"""
+    if telegram_id:
+        async with user_locks(int(telegram_id)):
+            return await _create_or_extend_user(session, inbound, email, days_to_add, telegram_id, target_expiry, on_target)
+    return await _create_or_extend_user(session, inbound, email, days_to_add, telegram_id, target_expiry, on_target)
+
+async def _create_or_extend_user(session: aiohttp.ClientSession, inbound: RemnaInbound, email: str, days_to_add: int, telegram_id: str = None,
+                                 target_expiry: Optional[str] = None, on_target: Optional[OnTarget] = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     existing = None
     if telegram_id:
         existing = await get_user_by_telegram_id(session, telegram_id)
     
-    now = datetime.now(timezone.utc)
     if existing:
+        if target_expiry and _reached(existing.get('expireAt'), target_expiry):
+            return existing.get('vlessUuid'), existing.get('subscriptionUrl'), existing.get('expireAt')
         # Update existing user
-        expire_at_iso = existing.get('expireAt')
-        try:
-            current_exp = datetime.fromisoformat(expire_at_iso.replace('Z', '+00:00')) if expire_at_iso else now
-        except Exception:
-            current_exp = now
-        base_dt = current_exp if current_exp > now else now
-        new_exp = base_dt + timedelta(days=days_to_add)
-        new_iso = new_exp.replace(microsecond=0).isoformat().replace('+00:00', 'Z')
+        new_iso = extend_expiry_iso(existing.get('expireAt'), days_to_add)
+        if on_target:
+            await on_target(new_iso)
         body = {
             "email": email,
             "uuid": existing.get('uuid'),
@@ -135,11 +175,14 @@ async def create_or_extend_user(session: aiohttp.ClientSession, inbound: RemnaIn
         updated = await _fetch_json(session, 'PATCH', '/api/users', json=body)
         if updated and 'response' in updated:
             u = updated['response']
+            database.upsert_panel_user(int(telegram_id), u)
             return u.get('vlessUuid'), u.get('subscriptionUrl'), u.get('expireAt')
         return None, None, None
     
     # Create new user
     new_iso = _iso_expiry(days_to_add)
+    if on_target:
+        await on_target(new_iso)
     username = (email.split('@')[0])[:32]
     body = {
         "email": email,
@@ -160,6 +203,8 @@ async def create_or_extend_user(session: aiohttp.ClientSession, inbound: RemnaIn
     created = await _fetch_json(session, 'POST', '/api/users', json=body)
     if created and 'response' in created:
         u = created['response']
+        if telegram_id:
+            database.upsert_panel_user(int(telegram_id), u)
         return u.get('vlessUuid'), u.get('subscriptionUrl'), u.get('expireAt')
     return None, None, None
 
@@ -204,42 +249,114 @@ def build_vless_uri(inbound: RemnaInbound, vless_uuid: str, email: str) -> Optio
         f"#{inbound.tag}-{email}"
     )
 
-async def provision_key(email: str, days: int | None = None, telegram_id: str = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+async def provision_key(email: str, days: int | None = None, telegram_id: str = None,
+                        target_expiry: Optional[str] = None, on_target: Optional[OnTarget] = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     days = days or DEFAULT_DAYS
-    async with aiohttp.ClientSession() as session:
-        inbound = await get_inbound(session)
-        if not inbound:
-            return None, None, None
-        vless_uuid, sub_url, expire_iso = await create_or_extend_user(session, inbound, email, days, telegram_id)
-        if not vless_uuid:
-            return None, None, None
-        uri = build_vless_uri(inbound, vless_uuid, email)
-        return uri, expire_iso, vless_uuid
-
-async def add_extra_traffic(email: str, extra_gb: int, telegram_id: str = None) -> bool:
+    session = get_session()
+    inbound = await get_inbound(session)
+    if not inbound:
+        return None, None, None
+    vless_uuid, sub_url, expire_iso = await create_or_extend_user(session, inbound, email, days, telegram_id, target_expiry, on_target)
+    if not vless_uuid:
+        return None, None, None
+    uri = build_vless_uri(inbound, vless_uuid, email)
+    return uri, expire_iso, vless_uuid
+
+async def add_extra_traffic(email: str, extra_gb: int, telegram_id: str = None,
+                            target_limit: Optional[int] = None, on_target: Optional[OnTarget] = None) -> bool:
     """Увеличивает лимит трафика пользователю на extra_gb (ГБ) на сервере.
-    Возвращает True при успехе."""
+    Возвращает True при успехе. target_limit/on_target — как у create_or_extend_user."""
+    if not telegram_id:
+        return False
+    async with user_locks(int(telegram_id)):
+        return await _add_extra_traffic(email, extra_gb, telegram_id, target_limit, on_target)
+
+async def _add_extra_traffic(email: str, extra_gb: int, telegram_id: str,
+                             target_limit: Optional[int] = None, on_target: Optional[OnTarget] = None) -> bool:
     bytes_add = extra_gb * 1024 * 1024 * 1024
-    async with aiohttp.ClientSession() as session:
-        user = None
-        if telegram_id:
-            user = await get_user_by_telegram_id(session, telegram_id)
-        
-        if not user:
-            return False
-        current_limit = user.get('trafficLimitBytes') or 0
-        expire_at = user.get('expireAt') or _iso_expiry(DEFAULT_DAYS)
-        body = {
-            "email": email,
-            "uuid": user.get('uuid'),
-            "expireAt": expire_at,
-            "trafficLimitBytes": current_limit + bytes_add,
-            "trafficLimitStrategy": TRAFFIC_STRATEGY,
-        }
-        if telegram_id:
-            body["telegramId"] = int(telegram_id)
-        updated = await _fetch_json(session, 'PATCH', '/api/users', json=body)
-        return bool(updated and 'response' in updated)
+    session = get_session()
+    user = await get_user_by_telegram_id(session, telegram_id)
+    if not user:
+        return False
+    current_limit = user.get('trafficLimitBytes') or 0
+    if target_limit is not None and current_limit >= target_limit:
+        return True
+    if on_target:
+        await on_target(current_limit + bytes_add)
+    expire_at = user.get('expireAt') or _iso_expiry(DEFAULT_DAYS)
+    body = {
+        "email": email,
+        "uuid": user.get('uuid'),
+        "expireAt": expire_at,
+        "trafficLimitBytes": current_limit + bytes_add,
+        "trafficLimitStrategy": TRAFFIC_STRATEGY,
+        "telegramId": int(telegram_id),
+    }
+    updated = await _fetch_json(session, 'PATCH', '/api/users', json=body)
+    if updated and 'response' in updated:
+        database.upsert_panel_user(int(telegram_id), updated['response'])
+        return True
+    return False
+
+# -------------------- Local mirror reads --------------------
+MIRROR_MAX_AGE_SECONDS = int(os.getenv("PANEL_MIRROR_MAX_AGE_SECONDS", "600"))
+
+async def get_cached_user(telegram_id: int, max_age: Optional[float] = None, force_refresh: bool = False) -> Optional[dict]:
+    """Panel user state from the local panel_users mirror.
+
+    The panel is queried only when the mirror row is missing, older than
+    `max_age` (PANEL_MIRROR_MAX_AGE_SECONDS by default) or force_refresh is set.
+    If the panel is unreachable, a stale row is returned as is; check its age_seconds."""
+    max_age = MIRROR_MAX_AGE_SECONDS if max_age is None else max_age
+    cached = database.get_panel_user(telegram_id)
+    if cached and not force_refresh and cached['age_seconds'] <= max_age:
+        return cached
+    remote = await get_user_by_telegram_id(get_session(), str(telegram_id))
+    if not remote:
+        return cached
+    database.upsert_panel_user(telegram_id, remote)
+    return database.get_panel_user(telegram_id)
+
+# -------------------- Bulk operations --------------------
+BULK_PAGE_SIZE = int(os.getenv("REMNA_BULK_PAGE_SIZE", "500"))
+BULK_CONCURRENCY = int(os.getenv("REMNA_BULK_CONCURRENCY", "16"))
+
+async def list_users(session: aiohttp.ClientSession, start: int = 0, size: int = BULK_PAGE_SIZE) -> Tuple[List[dict], int]:
+    """One page of panel users. Returns (users, total)."""
+    data = await _fetch_json(session, 'GET', '/api/users', params={"start": start, "size": size})
+    if not data or 'response' not in data:
+        return [], 0
+    resp = data['response']
+    return resp.get('users', []), int(resp.get('total') or 0)
+
+async def get_users_by_telegram_ids(session: aiohttp.ClientSession, telegram_ids: Iterable[int], page_size: int = BULK_PAGE_SIZE) -> Dict[int, dict]:
+    """Maps telegram ids to panel users by walking the paged user list once
+    instead of issuing one by-telegram-id lookup per user."""
+    wanted = {int(t) for t in telegram_ids}
+    found: Dict[int, dict] = {}
+    start = 0
+    while wanted - found.keys():
+        users, total = await list_users(session, start, page_size)
+        if not users:
+            break
+        for u in users:
+            tid = u.get('telegramId')
+            if tid is not None and int(tid) in wanted and int(tid) not in found:
+                found[int(tid)] = u
+        start += len(users)
+        if start >= total:
+            break
+    return found
+
+async def set_user_expiry(session: aiohttp.ClientSession, user_uuid: str, expire_iso: str) -> Optional[dict]:
+    """Patches only expireAt of an existing panel user. Returns the updated user.
+
+    expireAt is read-modify-write: callers hold user_locks(telegram_id) and compute
+    expire_iso from a fresh read taken under that lock."""
+    updated = await _fetch_json(session, 'PATCH', '/api/users', json={"uuid": user_uuid, "expireAt": expire_iso})
+    if updated and 'response' in updated:
+        return updated['response']
+    return None
 
 class RemnaWaveAPI:
     def __init__(self, base_url: str, token: str, cookie: str = None):
@@ -255,12 +372,13 @@ class RemnaWaveAPI:
         }
         if self.cookie:
             headers["Cookie"] = self.cookie
-        async with aiohttp.ClientSession() as session:
+        async with json_codec.client_session() as session:
             async with session.get(url, headers=headers) as response:
+                raw, data = await json_codec.read_json(response)
                 if response.status == 404:
-                    raise Exception(f"Remna API GET {endpoint} failed 404: {await response.text()}")
+                    raise Exception(f"Remna API GET {endpoint} failed 404: {json_codec.preview(raw, 1000)}")
                 response.raise_for_status()
-                return await response.json()
+                return data
 
     async def get_config_profiles_inbounds(self):
         data = await self._fetch_json("/api/config-profiles/inbounds")
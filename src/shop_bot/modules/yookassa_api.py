@@ -0,0 +1,72 @@
+"""
+Async YooKassa API client on the shared aiohttp session.
+
+Replaces the synchronous yookassa SDK, whose Payment.create blocked the event
+loop for the whole HTTPS round trip. Only the calls the bot needs:
+  POST /v3/payments              — create_payment
+  GET  /v3/payments/{payment_id} — get_payment
+"""
+import logging
+import os
+import uuid
+from typing import Optional
+
+import aiohttp
+
+from shop_bot.utils import json_codec
+from shop_bot.utils.http import get_session
+
+logger = logging.getLogger(__name__)
+
+# ENV variables expected:
+# YOOKASSA_SHOP_ID - shop id (Basic auth login)
+# YOOKASSA_SECRET_KEY - secret key (Basic auth password)
+# YOOKASSA_API_URL - optional override of the API base URL
+
+API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3").rstrip("/")
+SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
+SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
+
+def configure(shop_id: str, secret_key: str):
+    global SHOP_ID, SECRET_KEY
+    SHOP_ID = shop_id
+    SECRET_KEY = secret_key
+
+def _auth() -> Optional[aiohttp.BasicAuth]:
+    if not SHOP_ID or not SECRET_KEY:
+        logger.error("YooKassa config incomplete: YOOKASSA_SHOP_ID or YOOKASSA_SECRET_KEY missing")
+        return None
+    return aiohttp.BasicAuth(str(SHOP_ID), SECRET_KEY)
+
+async def _request(method: str, path: str, session: Optional[aiohttp.ClientSession] = None,
+                   headers: Optional[dict] = None, **kwargs) -> Optional[dict]:
+    auth = _auth()
+    if auth is None:
+        return None
+    session = session or get_session()
+    try:
+        async with session.request(method, f"{API_URL}{path}", auth=auth, headers=headers, **kwargs) as resp:
+            raw, data = await json_codec.read_json(resp)
+            if resp.status >= 400:
+                logger.error(f"YooKassa {method} {path} failed {resp.status}: {json_codec.preview(raw, 1000)}")
+                return None
+            if data is None:
+                logger.error(f"Failed to parse YooKassa JSON from {path}: {json_codec.preview(raw)}")
+            return data
+    except Exception as e:
+        logger.error(f"YooKassa HTTP error {method} {path}: {e}")
+        return None
+
+async def create_payment(payload: dict, idempotence_key: Optional[str] = None,
+                         session: Optional[aiohttp.ClientSession] = None) -> Optional[dict]:
+    """Creates a payment. Retrying with the same idempotence key returns the same payment."""
+    headers = {"Idempotence-Key": idempotence_key or str(uuid.uuid4())}
+    return await _request('POST', '/payments', session=session, headers=headers, json=payload)
+
+async def get_payment(payment_id: str, session: Optional[aiohttp.ClientSession] = None) -> Optional[dict]:
+    return await _request('GET', f'/payments/{payment_id}', session=session)
+
+def confirmation_url(payment: Optional[dict]) -> Optional[str]:
+    if not payment:
+        return None
+    return (payment.get("confirmation") or {}).get("confirmation_url")
@@ -0,0 +1,38 @@
+"""
+Общая HTTP-сессия процесса.
+
+Одна aiohttp.ClientSession на событийный цикл: пул соединений и TLS-сессии
+переиспользуются между запросами вместо открытия новой сессии на каждый вызов.
+"""
+import asyncio
+import os
+from typing import Optional
+
+import aiohttp
+
+from shop_bot.utils import json_codec
+
+POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "30"))
+
+_SESSION: Optional[aiohttp.ClientSession] = None
+_SESSION_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую сессию, создавая её при первом обращении в текущем цикле."""
+    global _SESSION, _SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if _SESSION is None or _SESSION.closed or _SESSION_LOOP is not loop:
+        _SESSION = json_codec.client_session(
+            connector=aiohttp.TCPConnector(limit=POOL_LIMIT),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS),
+        )
+        _SESSION_LOOP = loop
+    return _SESSION
+
+async def close_session():
+    global _SESSION, _SESSION_LOOP
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+    _SESSION_LOOP = None
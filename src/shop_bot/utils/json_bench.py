@@ -0,0 +1,75 @@
+"""
+Бенчмарк разбора списка пользователей панели кодеком json_codec.
+
+    python -m shop_bot.utils.json_bench --users 1000 --rounds 20
+"""
+import argparse
+import json
+import timeit
+import uuid
+
+from shop_bot.utils import json_codec
+
+def make_panel_users(count: int) -> dict:
+    """Ответ GET /api/users панели с count пользователями."""
+    users = []
+    for i in range(count):
+        users.append({
+            "uuid": str(uuid.uuid4()),
+            "shortUuid": uuid.uuid4().hex[:16],
+            "username": f"user{100000 + i}-key1",
+            "status": "ACTIVE",
+            "usedTrafficBytes": 1234567890 + i,
+            "lifetimeUsedTrafficBytes": 9876543210 + i,
+            "trafficLimitBytes": 536870912000,
+            "trafficLimitStrategy": "MONTH",
+            "subLastUserAgent": "v2rayTUN/1.4.2 (Android 14)",
+            "subLastOpenedAt": "2025-08-01T10:00:00.000Z",
+            "expireAt": "2025-12-01T00:00:00.000Z",
+            "onlineAt": "2025-08-01T10:00:00.000Z",
+            "subRevokedAt": None,
+            "lastTrafficResetAt": "2025-08-01T00:00:00.000Z",
+            "trojanPassword": uuid.uuid4().hex,
+            "vlessUuid": str(uuid.uuid4()),
+            "ssPassword": uuid.uuid4().hex,
+            "description": None,
+            "telegramId": 100000 + i,
+            "email": f"user{100000 + i}-key1@kitsura.fun",
+            "hwidDeviceLimit": None,
+            "createdAt": "2025-01-01T00:00:00.000Z",
+            "updatedAt": "2025-08-01T00:00:00.000Z",
+            "subscriptionUrl": f"https://panel.example.com/api/sub/{uuid.uuid4().hex[:16]}",
+            "activeInternalSquads": [{"uuid": str(uuid.uuid4()), "name": "Default-Squad"}],
+        })
+    return {"response": {"users": users, "total": count}}
+
+def run(users: int, rounds: int) -> dict:
+    """Среднее время одного разбора, в секундах, для каждого способа."""
+    raw = json_codec.dumps_bytes(make_panel_users(users))
+
+    def double_decode():
+        # Старый путь: resp.text() + resp.json() — декодирование и разбор дважды
+        text = raw.decode('utf-8')
+        json.loads(raw.decode('utf-8'))
+        return text
+
+    return {
+        "size_kb": len(raw) / 1024,
+        "double_stdlib": timeit.timeit(double_decode, number=rounds) / rounds,
+        "single_stdlib": timeit.timeit(lambda: json.loads(raw), number=rounds) / rounds,
+        "single_codec": timeit.timeit(lambda: json_codec.loads(raw), number=rounds) / rounds,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Panel users payload parsing benchmark")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    result = run(args.users, args.rounds)
+    print(f"Payload: {args.users} users, {result['size_kb']:.0f} KB, backend={json_codec.BACKEND}")
+    print(f"  text()+json() stdlib : {result['double_stdlib'] * 1000:8.2f} ms")
+    print(f"  single parse stdlib  : {result['single_stdlib'] * 1000:8.2f} ms")
+    print(f"  single parse {json_codec.BACKEND:<7}: {result['single_codec'] * 1000:8.2f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Общий JSON-кодек для HTTP-клиентов и вебхуков.
+
+Тело ответа читается один раз в байты и разбирается один раз.
+Если установлен orjson, используется он, иначе стандартный json.
+"""
+import json
+import logging
+from typing import Any, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson as _orjson
+    BACKEND = "orjson"
+except ImportError:  # pragma: no cover
+    _orjson = None
+    BACKEND = "json"
+
+def loads(data: bytes | bytearray | memoryview | str) -> Any:
+    if _orjson is not None:
+        return _orjson.loads(data)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode('utf-8')
+    return json.loads(data)
+
+def dumps_bytes(obj: Any) -> bytes:
+    if _orjson is not None:
+        return _orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def dumps(obj: Any) -> str:
+    """Компактная сериализация в строку (подходит как json_serialize для aiohttp)."""
+    if _orjson is not None:
+        return _orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+def client_session(**kwargs) -> aiohttp.ClientSession:
+    """aiohttp.ClientSession, сериализующая тела запросов через этот кодек."""
+    kwargs.setdefault('json_serialize', dumps)
+    return aiohttp.ClientSession(**kwargs)
+
+async def read_json(resp: aiohttp.ClientResponse) -> Tuple[bytes, Optional[Any]]:
+    """Читает тело ответа один раз. Возвращает (сырые байты, распарсенный JSON или None)."""
+    raw = await resp.read()
+    if not raw:
+        return raw, None
+    try:
+        return raw, loads(raw)
+    except ValueError:
+        return raw, None
+
+def preview(raw: bytes, limit: int = 200) -> str:
+    """Короткий текстовый фрагмент тела для логов."""
+    return raw[:limit].decode('utf-8', errors='replace')
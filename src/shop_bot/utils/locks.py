@@ -0,0 +1,29 @@
+"""
+Асинхронные блокировки по ключу (например, по telegram_id).
+
+Операции одного пользователя выполняются по очереди, разных — параллельно.
+Замки хранятся по слабым ссылкам: как только замок никто не держит и не ждёт,
+он удаляется из словаря, поэтому память не растёт с числом пользователей.
+"""
+import asyncio
+import weakref
+from typing import Hashable
+
+class KeyedLock:
+    def __init__(self):
+        self._locks: "weakref.WeakValueDictionary[Hashable, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    def __call__(self, key: Hashable) -> asyncio.Lock:
+        """Замок для key; использовать как `async with locks(key): ...`."""
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    def locked(self, key: Hashable) -> bool:
+        lock = self._locks.get(key)
+        return bool(lock and lock.locked())
+
+    def __len__(self) -> int:
+        return len(self._locks)
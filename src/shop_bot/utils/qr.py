@@ -0,0 +1,47 @@
+"""
+Рендеринг QR-кодов вне событийного цикла.
+
+PNG строится в отдельном пуле потоков, готовые байты хранятся в LRU-кеше
+по (строка подключения, версия inbound). Повторное нажатие «Показать QR-код»
+стоит одного поиска в словаре, а одновременные запросы одного и того же
+кода ждут один общий рендер.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, Tuple
+
+import qrcode
+
+from shop_bot.utils.cache import LRUCache
+
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "512"))
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "2"))
+
+_executor = ThreadPoolExecutor(max_workers=QR_RENDER_WORKERS, thread_name_prefix="qr-render")
+_cache = LRUCache(maxsize=QR_CACHE_SIZE)
+_inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+def _render_png(data: str) -> bytes:
+    bio = BytesIO()
+    qrcode.make(data).save(bio, "PNG")
+    return bio.getvalue()
+
+async def render_png(data: str, version: str = "") -> bytes:
+    key = (data, version)
+    cached = _cache.get(key)
+    if cached is not None:
+        return cached
+    pending = _inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_executor, _render_png, data)
+    _inflight[key] = future
+    try:
+        png = await asyncio.shield(future)
+    finally:
+        _inflight.pop(key, None)
+    _cache.set(key, png)
+    return png
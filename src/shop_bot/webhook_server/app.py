@@ -1,57 +1,99 @@
 import logging
 import asyncio
-from flask import Flask, request, current_app
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from shop_bot.utils import json_codec
+from shop_bot.data_manager import panel_events
 
 logger = logging.getLogger(__name__)
 
-def create_webhook_app(bot, payment_processor):
-    flask_app = Flask(__name__)
+def create_webhook_app(bot, enqueue_payment) -> web.Application:
+    """Вебхуки платёжных систем и панели; работает в том же цикле событий, что и бот.
+
+    enqueue_payment(provider, payment_id, metadata) — синхронная запись в очередь
+    выдачи (SQLite), вызывается в пуле потоков, чтобы не блокировать цикл.
+    """
+    app = web.Application()
+    background_tasks: set[asyncio.Task] = set()
 
-    @flask_app.route('/yookassa-webhook', methods=['POST'])
-    def yookassa_webhook_handler():
+    async def yookassa_webhook_handler(request: web.Request) -> web.Response:
         try:
-            event_json = request.json
+            event_json = json_codec.loads(await request.read())
             if event_json.get("event") == "payment.succeeded":
-                metadata = event_json.get("object", {}).get("metadata", {})
+                payment_object = event_json.get("object", {})
+                metadata = payment_object.get("metadata", {})
                 if metadata:
-                    loop = current_app.config['EVENT_LOOP']
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-            return 'OK', 200
+                    await asyncio.to_thread(enqueue_payment, "yookassa", payment_object.get("id"), metadata)
+            return web.Response(text='OK')
         except Exception as e:
             logger.error(f"Error in yookassa webhook handler: {e}")
-            return 'Error', 500
+            return web.Response(text='Error', status=500)
 
-    @flask_app.route('/crypto-webhook', methods=['POST'])
-    def crypto_webhook_handler():
+    async def crypto_webhook_handler(request: web.Request) -> web.Response:
         try:
-            data = request.json
+            data = json_codec.loads(await request.read())
             logger.info(f"Crypto webhook received: {data}")
 
             if data.get("status") == "paid":
-                metadata = data.get("metadata", {})
+                metadata = data.get("metadata") or ({"order_id": data["order_id"]} if data.get("order_id") else {})
                 if metadata:
-                    loop = current_app.config['EVENT_LOOP']
-                    asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-            
-            return 'OK', 200
+                    await asyncio.to_thread(enqueue_payment, "heleket", data.get("uuid") or data.get("order_id"), metadata)
+
+            return web.Response(text='OK')
         except Exception as e:
             logger.error(f"Error in crypto webhook handler: {e}")
-            return 'Error', 500
-        
-    @flask_app.route('/cryptobot-webhook', methods=['GET'])
-    def crypto_webhook_get_handler():
+            return web.Response(text='Error', status=500)
+
+    async def crypto_webhook_get_handler(request: web.Request) -> web.Response:
         try:
-            data = request.args
-            logger.info(f"Crypto bot webhook received: {data}")
+            data = request.query
+            logger.info(f"Crypto bot webhook received: {dict(data)}")
 
             if data.get("status") == "paid":
-                metadata = data.to_dict()
-                loop = current_app.config['EVENT_LOOP']
-                asyncio.run_coroutine_threadsafe(payment_processor(bot, metadata), loop)
-            
-            return 'OK', 200
+                metadata = dict(data)
+                await asyncio.to_thread(enqueue_payment, "cryptobot", data.get("invoice_id") or data.get("payment_id"), metadata)
+
+            return web.Response(text='OK')
         except Exception as e:
             logger.error(f"Error in crypto bot webhook handler: {e}")
-            return 'Error', 500
+            return web.Response(text='Error', status=500)
+
+    async def remnawave_webhook_handler(request: web.Request) -> web.Response:
+        try:
+            raw_body = await request.read()
+            if not panel_events.verify_signature(raw_body, request.headers.get(panel_events.SIGNATURE_HEADER)):
+                logger.warning("Remnawave webhook with invalid signature rejected")
+                return web.Response(text='Unauthorized', status=401)
+            payload = json_codec.loads(raw_body)
+            if await asyncio.to_thread(panel_events.accept_event, raw_body, payload):
+                # Панели отвечаем сразу, событие обрабатывается в фоне
+                task = asyncio.create_task(panel_events.handle_event(bot, payload))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+            return web.Response(text='OK')
+        except Exception as e:
+            logger.error(f"Error in remnawave webhook handler: {e}")
+            return web.Response(text='Error', status=500)
+
+    app.router.add_post('/yookassa-webhook', yookassa_webhook_handler)
+    app.router.add_post('/crypto-webhook', crypto_webhook_handler)
+    app.router.add_get('/cryptobot-webhook', crypto_webhook_get_handler)
+    app.router.add_post('/remnawave-webhook', remnawave_webhook_handler)
+    return app
+
+def register_telegram_webhook(app: web.Application, dispatcher, bot, path: str, secret_token: str):
+    """Приём обновлений Telegram на том же сервере, что и платёжные вебхуки.
+
+    Запросы без верного X-Telegram-Bot-Api-Secret-Token отклоняются; Telegram
+    получает ответ сразу, обновление обрабатывается диспетчером в фоне.
+    """
+    SimpleRequestHandler(dispatcher=dispatcher, bot=bot, secret_token=secret_token, handle_in_background=True).register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
 
-    return flask_app
\ No newline at end of file
+async def start_webhook_server(app: web.Application, host: str = '0.0.0.0', port: int = 1488) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
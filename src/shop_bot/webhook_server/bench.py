@@ -0,0 +1,98 @@
+"""
+Нагрузочный тест вебхук-сервера: поток уникальных payment.succeeded от YooKassa.
+
+По умолчанию поднимает сервер в этом же процессе на временной базе
+с заранее созданными заказами (очередь выдачи не запускается — измеряется
+только приём вебхука, разрешение заказа и запись в очередь):
+    python -m shop_bot.webhook_server.bench --requests 5000 --concurrency 64
+
+Запущенный отдельно сервер:
+    python -m shop_bot.webhook_server.bench --url http://127.0.0.1:1488
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+from shop_bot.data_manager import database, fulfilment
+from shop_bot.webhook_server.app import create_webhook_app
+
+def _percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))] if ordered else 0.0
+
+async def hammer(base_url: str, requests: int, concurrency: int) -> dict:
+    latencies: list = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                body = {
+                    "type": "notification", "event": "payment.succeeded",
+                    "object": {"id": str(uuid.uuid4()), "status": "succeeded", "paid": True,
+                               "metadata": {"order_id": f"bench{i}"}},
+                }
+                started = time.perf_counter()
+                try:
+                    async with session.post(f"{base_url}/yookassa-webhook", json=body) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {
+        "requests": requests, "errors": errors, "elapsed": elapsed,
+        "rps": requests / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+    }
+
+async def run(requests: int, concurrency: int, url: Optional[str] = None) -> dict:
+    if url:
+        return await hammer(url.rstrip("/"), requests, concurrency)
+    with tempfile.TemporaryDirectory(prefix="webhook_bench_") as tmp:
+        saved = database.DB_FILE
+        database.DB_FILE = Path(tmp) / "bench.db"
+        database.initialize_db()
+        for i in range(requests):
+            database.create_pending_order(f"bench{i}", {"user_id": 100000 + i, "provider": "yookassa", "plan_id": "1m",
+                                                        "action": "new", "months": 1, "price": 100.0})
+        runner = web.AppRunner(create_webhook_app(None, fulfilment.enqueue), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            return await hammer(f"http://{host}:{port}", requests, concurrency)
+        finally:
+            await runner.cleanup()
+            database.DB_FILE = saved
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook server load test")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--url", help="base URL of an already running webhook server")
+    args = parser.parse_args()
+    logging.getLogger("shop_bot").setLevel(logging.WARNING)
+    result = asyncio.run(run(args.requests, args.concurrency, args.url))
+    print(f"requests={result['requests']} errors={result['errors']} {result['rps']:.0f} req/s "
+          f"p50={result['p50_ms']:.2f} ms p99={result['p99_ms']:.2f} ms ({result['elapsed']:.2f}s)")
+
+if __name__ == "__main__":
+    main()
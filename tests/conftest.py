@@ -0,0 +1,52 @@
+from typing import Optional
+
+import pytest
+
+from shop_bot.data_manager import database
+from shop_bot.modules import panel_stub, remnawave_api
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    """Каждый тест работает со своей пустой базой."""
+    monkeypatch.setattr(database, "DB_FILE", tmp_path / "test.db")
+    database.initialize_db()
+    return database.DB_FILE
+
+@pytest.fixture
+def panel_config(monkeypatch):
+    """Клиент панели с учётными данными заглушки; BASE_URL выставляет тест после запуска заглушки."""
+    monkeypatch.setattr(remnawave_api, "API_TOKEN", panel_stub.STUB_TOKEN)
+    monkeypatch.setattr(remnawave_api, "HEADERS", {"Authorization": f"Bearer {panel_stub.STUB_TOKEN}"})
+    monkeypatch.setattr(remnawave_api, "INBOUND_TAG", panel_stub.STUB_INBOUND_TAG)
+    monkeypatch.setattr(remnawave_api, "_INBOUND_CACHE", None)
+    monkeypatch.setattr(remnawave_api, "BASE_URL", "")
+
+class SentMessage:
+    def __init__(self, chat_id: int, text: str, message_id: int):
+        self.chat_id, self.text, self.message_id = chat_id, text, message_id
+
+class FakeBot:
+    """Записывает исходящие сообщения вместо обращений к Bot API."""
+
+    def __init__(self):
+        self.sent: list[SentMessage] = []
+        self.edited: list[tuple[int, int, str]] = []
+        self.deleted: list[tuple[int, int]] = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> SentMessage:
+        message = SentMessage(chat_id, text, len(self.sent) + 1)
+        self.sent.append(message)
+        return message
+
+    async def edit_message_text(self, text: str, chat_id: Optional[int] = None, message_id: Optional[int] = None, **kwargs):
+        self.edited.append((chat_id, message_id, text))
+
+    async def delete_message(self, chat_id: int, message_id: int, **kwargs):
+        self.deleted.append((chat_id, message_id))
+
+    def texts(self, chat_id: Optional[int] = None) -> list[str]:
+        return [m.text for m in self.sent if chat_id is None or m.chat_id == chat_id]
+
+@pytest.fixture
+def bot() -> FakeBot:
+    return FakeBot()
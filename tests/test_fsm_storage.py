@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+from shop_bot.data_manager import database
+from shop_bot.data_manager.fsm_storage import SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=700501, user_id=700501)
+
+class PromoForm(StatesGroup):
+    code = State()
+
+def test_state_and_data_survive_restart():
+    async def scenario():
+        storage = SQLiteStorage()
+        await storage.set_state(KEY, PromoForm.code)
+        await storage.set_data(KEY, {"discount": 10})
+        await storage.close()
+
+        restarted = SQLiteStorage()
+        return await restarted.get_state(KEY), await restarted.get_data(KEY)
+
+    assert asyncio.run(scenario()) == (PromoForm.code.state, {"discount": 10})
+
+def test_expired_record_is_not_read():
+    async def scenario():
+        storage = SQLiteStorage(state_ttls={PromoForm.code: 0.05})
+        await storage.set_state(KEY, PromoForm.code)
+        await asyncio.sleep(0.1)
+        cached = await storage.get_state(KEY)
+        await storage.close()
+        return cached, await SQLiteStorage().get_state(KEY), SQLiteStorage().sweep()
+
+    assert asyncio.run(scenario()) == (None, None, 1)
+
+def test_database_calls_run_off_the_loop(monkeypatch):
+    loop_thread = threading.get_ident()
+    threads = []
+    original_get, original_set = database.get_fsm_record, database.set_fsm_record
+
+    def slow_get(*args):
+        threads.append(threading.get_ident())
+        time.sleep(0.05)
+        return original_get(*args)
+
+    def slow_set(*args):
+        threads.append(threading.get_ident())
+        time.sleep(0.05)
+        return original_set(*args)
+
+    monkeypatch.setattr(database, "get_fsm_record", slow_get)
+    monkeypatch.setattr(database, "set_fsm_record", slow_set)
+
+    async def scenario():
+        storage = SQLiteStorage()
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.005)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await storage.set_data(KEY, {"step": 1})
+        task.cancel()
+        return ticks
+
+    # чтение при промахе LRU и запись — 0.1 с в потоках, цикл всё это время работает
+    assert asyncio.run(scenario()) >= 5
+    assert threads and loop_thread not in threads
+
+def test_concurrent_writes_reach_the_table_in_order(monkeypatch):
+    original_set = database.set_fsm_record
+    delays = iter([0.05, 0.0, 0.02, 0.0, 0.01])
+
+    def jittery_set(*args):
+        # Без упорядочивания ранняя медленная запись затёрла бы более позднюю
+        time.sleep(next(delays, 0.0))
+        return original_set(*args)
+
+    monkeypatch.setattr(database, "set_fsm_record", jittery_set)
+
+    async def scenario():
+        storage = SQLiteStorage()
+        await storage.get_state(KEY)  # ключ в LRU: записи ниже не читают таблицу
+        await asyncio.gather(*(storage.set_data(KEY, {"step": i}) for i in range(5)))
+        in_memory = await storage.get_data(KEY)
+        await storage.close()
+        return in_memory, await SQLiteStorage().get_data(KEY)
+
+    assert asyncio.run(scenario()) == ({"step": 4}, {"step": 4})
+
+def test_cache_miss_waits_for_write_in_flight(monkeypatch):
+    original_set = database.set_fsm_record
+
+    def slow_set(*args):
+        time.sleep(0.05)
+        return original_set(*args)
+
+    monkeypatch.setattr(database, "set_fsm_record", slow_set)
+    other = StorageKey(bot_id=1, chat_id=700502, user_id=700502)
+
+    async def scenario():
+        storage = SQLiteStorage(cache_size=1)
+        await storage.set_data(KEY, {"step": 1})
+        writer = asyncio.create_task(storage.set_data(KEY, {"step": 2}))
+        await asyncio.sleep(0.01)
+        await storage.get_data(other)  # вытесняет KEY из LRU, пока запись ещё идёт
+        read = await storage.get_data(KEY)
+        await writer
+        return read
+
+    assert asyncio.run(scenario()) == {"step": 2}
@@ -0,0 +1,167 @@
+import asyncio
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from aiogram.exceptions import TelegramNetworkError
+from aiohttp import web
+
+from shop_bot.bot import handlers
+from shop_bot.data_manager import database, fulfilment
+from shop_bot.modules import panel_stub, remnawave_api
+from shop_bot.utils import json_codec
+from shop_bot.utils.http import close_session
+
+from conftest import FakeBot
+
+USER_ID = 700001
+REFERRER_ID = 700002
+EMAIL = f"user{USER_ID}-key1@kitsura.fun"
+
+pytestmark = pytest.mark.usefixtures("panel_config")
+
+def _with_panel(scenario, stub: panel_stub.PanelStub):
+    async def main():
+        await stub.start()
+        remnawave_api.BASE_URL = stub.base_url
+        try:
+            return await scenario()
+        finally:
+            await close_session()
+            await stub.stop()
+    return asyncio.run(main())
+
+def _lose_responses(stub: panel_stub.PanelStub, method: str, times: int = 1):
+    """Панель применяет запрос, но ответ до бота не доходит (504 после записи)."""
+    original = stub._update_user if method == "PATCH" else stub._create_user
+    lost = {"left": times}
+
+    async def handler(request: web.Request) -> web.Response:
+        response = await original(request)
+        if lost["left"]:
+            lost["left"] -= 1
+            return web.json_response({"message": "Gateway Timeout"}, status=504)
+        return response
+
+    setattr(stub, "_update_user" if method == "PATCH" else "_create_user", handler)
+
+def _enqueue(metadata: dict, payment_id: str = "pay-1") -> None:
+    assert database.enqueue_payment("yookassa", payment_id, json_codec.dumps(metadata), USER_ID, metadata.get("price"))
+
+async def _attempt(bot) -> str:
+    job = database.claim_next_payment(now=time.time() + 10 ** 6)
+    assert job is not None
+    await fulfilment._run_one(bot, handlers.process_successful_payment, job)
+    return database.get_payment(job["provider"], job["provider_payment_id"])["status"]
+
+def _actions(action: str) -> int:
+    with sqlite3.connect(database.DB_FILE) as conn:
+        return conn.execute("SELECT COUNT(*) FROM user_actions WHERE user_id = ? AND action = ?", (USER_ID, action)).fetchone()[0]
+
+def _days_between(a: str, b: str) -> float:
+    parse = lambda v: datetime.fromisoformat(v.replace('Z', '+00:00'))
+    return (parse(b) - parse(a)).total_seconds() / 86400
+
+@pytest.fixture
+def referred_user():
+    database.register_user_if_not_exists(REFERRER_ID, "referrer")
+    database.register_user_if_not_exists(USER_ID, "buyer")
+    database.link_referral(database.ensure_user_ref_code(REFERRER_ID), USER_ID)
+
+def _existing_key(stub: panel_stub.PanelStub, days: int = 10) -> tuple[int, str]:
+    expire = (datetime.now(timezone.utc) + timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    stub.add_user(USER_ID, f"user{USER_ID}-key1", expire, 500 * 1024 ** 3, email=EMAIL)
+    key_id = database.add_new_key(USER_ID, "vless", EMAIL, int(time.time() * 1000) + days * 86400000)
+    return key_id, expire
+
+def test_extend_retry_after_lost_panel_response_applies_once(bot, referred_user):
+    stub = panel_stub.PanelStub()
+    key_id, base = _existing_key(stub)
+    _lose_responses(stub, "PATCH")
+    _enqueue({"user_id": USER_ID, "months": 1, "price": 199.0, "action": "extend", "key_id": key_id, "plan_id": "buy_1_month"})
+
+    async def scenario():
+        return await _attempt(bot), await _attempt(bot)
+
+    assert _with_panel(scenario, stub) == ("received", "fulfilled")
+    panel_user = next(iter(stub.users.values()))
+    # 30 дней тарифа + 3 дня реферального бонуса первой покупки, один раз
+    assert round(_days_between(base, panel_user["expireAt"])) == 33
+    assert stub.request_counts["PATCH /api/users"] == 1
+    assert _actions("first_purchase") == 1 and _actions("ref_bonus_received") == 1
+    assert database.get_user(USER_ID)["total_months"] == 1
+    texts = bot.texts(USER_ID)
+    assert texts.count("✅ Оплата получена! Обрабатываю ваш запрос...") == 1
+    assert len(texts) == 2
+    assert bot.edited == []
+
+def test_new_key_retry_does_not_create_second_key(bot, referred_user):
+    stub = panel_stub.PanelStub()
+    _lose_responses(stub, "POST")
+    _enqueue({"user_id": USER_ID, "months": 1, "price": 199.0, "action": "new", "key_id": 0})
+
+    async def scenario():
+        return await _attempt(bot), await _attempt(bot)
+
+    assert _with_panel(scenario, stub) == ("received", "fulfilled")
+    assert len(stub.users) == 1
+    assert stub.request_counts.get("PATCH /api/users", 0) == 0
+    keys = database.get_user_keys(USER_ID)
+    assert [k["key_email"] for k in keys] == [EMAIL]
+
+def test_promo_is_consumed_once_when_result_message_fails(referred_user):
+    class FlakyBot(FakeBot):
+        calls = 0
+
+        async def send_message(self, chat_id, text, **kwargs):
+            self.calls += 1
+            if self.calls == 2:
+                raise TelegramNetworkError(method=None, message="Request timeout error")
+            return await super().send_message(chat_id, text, **kwargs)
+
+    bot = FlakyBot()
+    stub = panel_stub.PanelStub()
+    key_id, base = _existing_key(stub)
+    database.create_promo("SPRING", 0, 7, 10)
+    _enqueue({"user_id": USER_ID, "months": 1, "price": 199.0, "action": "extend", "key_id": key_id, "promo_code": "SPRING"})
+
+    async def scenario():
+        return await _attempt(bot), await _attempt(bot)
+
+    assert _with_panel(scenario, stub) == ("received", "fulfilled")
+    assert database.get_promo("SPRING")["uses_count"] == 1
+    assert _actions("promo_used") == 1
+    panel_user = next(iter(stub.users.values()))
+    assert round(_days_between(base, panel_user["expireAt"])) == 30 + 7 + 3
+    assert stub.request_counts["PATCH /api/users"] == 1
+
+def test_permanent_failure_goes_straight_to_failed(bot, referred_user):
+    stub = panel_stub.PanelStub()
+    key_id, _ = _existing_key(stub)
+    _enqueue({"user_id": USER_ID, "months": 0, "price": 99.0, "action": "pack", "key_id": key_id, "plan_id": "no-such-pack"})
+
+    assert _with_panel(lambda: _attempt(bot), stub) == "failed"
+    assert database.get_payment("yookassa", "pay-1")["attempts"] == 1
+    assert bot.edited == [(USER_ID, 1, "❌ Пакет трафика не найден.")]
+    assert stub.request_counts.get("PATCH /api/users", 0) == 0
+
+def test_metadata_without_user_fails_permanently(bot):
+    _enqueue({"months": 1, "price": 199.0, "action": "new"})
+    assert asyncio.run(_attempt(bot)) == "failed"
+    assert bot.sent == []
+
+def test_panel_outage_retries_quietly_until_last_attempt(bot, referred_user, monkeypatch):
+    monkeypatch.setattr(fulfilment, "MAX_ATTEMPTS", 3)
+    stub = panel_stub.PanelStub(error_rate=1.0)
+    key_id, _ = _existing_key(stub)
+    _enqueue({"user_id": USER_ID, "months": 1, "price": 199.0, "action": "extend", "key_id": key_id})
+
+    async def scenario():
+        return [await _attempt(bot) for _ in range(3)]
+
+    assert _with_panel(scenario, stub) == ["received", "received", "failed"]
+    assert bot.texts(USER_ID) == ["✅ Оплата получена! Обрабатываю ваш запрос..."]
+    assert bot.edited == [(USER_ID, 1, "❌ Не удалось создать/обновить ключ.")]
+    # Ни промокода, ни бонусов за невыданный заказ
+    assert _actions("first_purchase") == 0
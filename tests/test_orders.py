@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from shop_bot.data_manager import database, fulfilment
+from shop_bot.utils import json_codec
+
+USER_ID = 700101
+LEGACY = {"user_id": USER_ID, "months": 1, "price": 199.0, "action": "new", "key_id": 0}
+
+def _order(order_id: str = "ord-1", provider: str = "yookassa", **fields) -> str:
+    order = {"user_id": USER_ID, "provider": provider, "plan_id": "buy_1_month", "action": "new", "key_id": 0,
+             "months": 1, "price": 199.0, "promo_code": None, "chat_id": USER_ID, "message_id": 10}
+    order.update(fields)
+    assert database.create_pending_order(order_id, order)
+    return order_id
+
+def _queued(payment_id: str = "pay-1", provider: str = "yookassa"):
+    return database.get_payment(provider, payment_id)
+
+def _cutoff(days: int) -> str:
+    return (datetime.now(timezone.utc) + timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S')
+
+def test_order_is_resolved_from_pending_orders_only():
+    _order()
+    forged = {"order_id": "ord-1", "user_id": 1, "price": 1.0, "pack_id": "pack_100"}
+    assert fulfilment.enqueue("yookassa", "pay-1", forged)
+
+    metadata = json_codec.loads(_queued()["metadata"])
+    assert metadata["user_id"] == USER_ID and metadata["price"] == 199.0
+    assert "pack_id" not in metadata
+    assert database.get_pending_order("ord-1")["status"] == "paid"
+
+def test_unknown_order_is_rejected():
+    assert not fulfilment.enqueue("yookassa", "pay-1", {"order_id": "no-such-order"})
+    assert not fulfilment.enqueue("yookassa", "pay-2", {"order_id": "no-such-order", **LEGACY})
+    assert _queued("pay-1") is None and _queued("pay-2") is None
+
+def test_order_of_another_provider_is_rejected():
+    _order(provider="stars")
+    assert not fulfilment.enqueue("heleket", "pay-1", {"order_id": "ord-1"})
+    assert _queued("pay-1", "heleket") is None
+    assert database.get_pending_order("ord-1")["status"] != "paid"
+
+@pytest.mark.parametrize("provider", ["yookassa", "heleket", "cryptobot"])
+def test_legacy_metadata_rejected_without_cutoff(provider):
+    assert not fulfilment.enqueue(provider, "pay-1", LEGACY)
+    assert _queued("pay-1", provider) is None
+
+def test_legacy_metadata_accepted_before_cutoff(monkeypatch):
+    monkeypatch.setattr(fulfilment, "LEGACY_METADATA_UNTIL", _cutoff(1))
+    assert fulfilment.enqueue("yookassa", "pay-1", LEGACY)
+    assert json_codec.loads(_queued()["metadata"]) == LEGACY
+
+    monkeypatch.setattr(fulfilment, "LEGACY_METADATA_UNTIL", _cutoff(-1))
+    assert not fulfilment.enqueue("yookassa", "pay-2", LEGACY)
+
+def test_malformed_cutoff_disables_legacy_metadata(monkeypatch):
+    monkeypatch.setattr(fulfilment, "LEGACY_METADATA_UNTIL", "soon")
+    assert not fulfilment.legacy_metadata_allowed("yookassa")
+
+def test_stars_legacy_payload_is_trusted():
+    assert fulfilment.enqueue("stars", "charge-1", LEGACY)
+    assert _queued("charge-1", "stars") is not None
+
+def test_metadata_without_order_or_user_is_rejected():
+    assert fulfilment.resolve_order("stars", {"months": 1}) is None
+    assert fulfilment.resolve_order("yookassa", {}) is None
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import hmac
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from shop_bot.data_manager import database, panel_events
+from shop_bot.utils import json_codec
+from shop_bot.webhook_server.app import create_webhook_app
+
+SECRET = "panel-secret"
+TELEGRAM_ID = 555001
+GB = 1024 ** 3
+
+def _expire_in(days: int) -> str:
+    return (datetime.now(timezone.utc) + timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def _payload(event: str, **data) -> dict:
+    # Формат тела вебхука Remnawave: событие, время и пользователь панели целиком
+    user = {
+        "uuid": "5f1c6a52-0c8e-4e0c-9a62-3f0f6f0a0001",
+        "username": f"user{TELEGRAM_ID}-key1",
+        "status": "ACTIVE",
+        "telegramId": TELEGRAM_ID,
+        "expireAt": _expire_in(1),
+        "trafficLimitBytes": 500 * GB,
+        "usedTrafficBytes": 12 * GB,
+        "vlessUuid": "0b7a2f3e-7d41-4b7e-8f5a-2c9d1e0a0001",
+    }
+    user.update(data)
+    return {"event": event, "timestamp": "2026-10-19T06:00:00.000Z", "data": user}
+
+def _sign(raw_body: bytes, secret: str = SECRET) -> str:
+    return hmac.new(secret.encode(), raw_body, hashlib.sha256).hexdigest()
+
+@pytest.fixture
+def user_with_key():
+    database.register_user_if_not_exists(TELEGRAM_ID, "tester")
+    expiry_ms = int((datetime.now(timezone.utc) + timedelta(days=30)).timestamp() * 1000)
+    return database.add_new_key(TELEGRAM_ID, "old-uuid", f"user{TELEGRAM_ID}-key1@kitsura.fun", expiry_ms)
+
+def test_verify_signature():
+    raw = json_codec.dumps_bytes(_payload("user.expired"))
+    assert panel_events.verify_signature(raw, _sign(raw), SECRET)
+    assert panel_events.verify_signature(raw, _sign(raw).upper(), SECRET)
+    assert not panel_events.verify_signature(raw, _sign(raw, "other"), SECRET)
+    assert not panel_events.verify_signature(raw + b" ", _sign(raw), SECRET)
+    assert not panel_events.verify_signature(raw, None, SECRET)
+    assert not panel_events.verify_signature(raw, _sign(raw, ""), "")
+
+def test_accept_event_drops_redelivery():
+    payload = _payload("user.expires_in_24_hours")
+    raw = json_codec.dumps_bytes(payload)
+    assert panel_events.accept_event(raw, payload)
+    assert not panel_events.accept_event(raw, payload)
+    # Другое тело того же события — новое событие
+    other = _payload("user.expires_in_24_hours", expireAt=_expire_in(2))
+    assert panel_events.accept_event(json_codec.dumps_bytes(other), other)
+
+def test_expiry_event_updates_mirror_and_notifies_once(bot, user_with_key):
+    payload = _payload("user.expires_in_24_hours")
+    asyncio.run(panel_events.handle_event(bot, payload))
+
+    mirror = database.get_panel_user(TELEGRAM_ID)
+    assert mirror["expire_at"] == payload["data"]["expireAt"]
+    assert mirror["vless_uuid"] == payload["data"]["vlessUuid"]
+    key = database.get_key_by_id(user_with_key)
+    expected = datetime.fromisoformat(payload["data"]["expireAt"].replace('Z', '+00:00')).replace(tzinfo=None)
+    assert datetime.fromisoformat(str(key["expiry_date"])) == expected
+    assert bot.texts(TELEGRAM_ID) == ["⏳ Ваша подписка истекает через 1 дн."]
+
+    # Повтор события (или опрос планировщика) не дублирует уведомление
+    asyncio.run(panel_events.handle_event(bot, payload))
+    assert len(bot.sent) == 1
+
+def test_expired_event(bot, user_with_key):
+    asyncio.run(panel_events.handle_event(bot, _payload("user.expired", expireAt=_expire_in(-1))))
+    assert bot.texts(TELEGRAM_ID) == ["❗️ Ваша подписка истекла."]
+
+def test_limited_event_sends_traffic_warnings(bot, user_with_key):
+    asyncio.run(panel_events.handle_event(bot, _payload("user.limited", usedTrafficBytes=500 * GB)))
+    texts = bot.texts(TELEGRAM_ID)
+    assert texts and all("Трафик ключа" in text for text in texts)
+    assert "100%" in texts[-1]
+    assert database.get_key_last_notified_percent(f"user{TELEGRAM_ID}-key1@kitsura.fun") == 100
+
+def test_traffic_reset_clears_marker(bot, user_with_key):
+    email = f"user{TELEGRAM_ID}-key1@kitsura.fun"
+    database.update_key_last_notified_percent(email, 90)
+    asyncio.run(panel_events.handle_event(bot, _payload("user.traffic_reset", usedTrafficBytes=0)))
+    assert database.get_key_last_notified_percent(email) == 0
+    assert bot.sent == []
+
+def test_disabled_and_enabled_events(bot, user_with_key):
+    asyncio.run(panel_events.handle_event(bot, _payload("user.disabled", status="DISABLED")))
+    asyncio.run(panel_events.handle_event(bot, _payload("user.enabled")))
+    assert bot.texts(TELEGRAM_ID) == ["⛔️ Ваша подписка отключена. Обратитесь в поддержку.", "✅ Ваша подписка снова активна."]
+
+def test_events_without_bot_user_are_ignored(bot):
+    asyncio.run(panel_events.handle_event(bot, _payload("user.disabled")))
+    asyncio.run(panel_events.handle_event(bot, {"event": "node.connection_lost", "data": {"uuid": "n1"}}))
+    asyncio.run(panel_events.handle_event(bot, _payload("user.disabled", telegramId=None)))
+    assert bot.sent == []
+    # Зеркало панели обновляется и для пользователей без ключей
+    assert database.get_panel_user(TELEGRAM_ID) is not None
+
+def test_webhook_route_checks_signature_and_dedups(bot, user_with_key, monkeypatch):
+    monkeypatch.setattr(panel_events, "WEBHOOK_SECRET", SECRET)
+    handled = []
+
+    async def record(bot_arg, payload):
+        handled.append(payload["event"])
+
+    monkeypatch.setattr(panel_events, "handle_event", record)
+    raw = json_codec.dumps_bytes(_payload("user.disabled"))
+
+    async def scenario():
+        app = create_webhook_app(bot, lambda *args: True)
+        async with TestClient(TestServer(app)) as client:
+            unsigned = await client.post("/remnawave-webhook", data=raw)
+            forged = await client.post("/remnawave-webhook", data=raw, headers={panel_events.SIGNATURE_HEADER: _sign(raw, "wrong")})
+            first = await client.post("/remnawave-webhook", data=raw, headers={panel_events.SIGNATURE_HEADER: _sign(raw)})
+            again = await client.post("/remnawave-webhook", data=raw, headers={panel_events.SIGNATURE_HEADER: _sign(raw)})
+            await asyncio.sleep(0)
+            return unsigned.status, forged.status, first.status, again.status
+
+    assert asyncio.run(scenario()) == (401, 401, 200, 200)
+    assert handled == ["user.disabled"]
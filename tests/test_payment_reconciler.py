@@ -0,0 +1,145 @@
+import asyncio
+import sqlite3
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from shop_bot.data_manager import database, fulfilment, payment_reconciler
+from shop_bot.modules import heleket_api, yookassa_api
+from shop_bot.utils import json_codec
+from shop_bot.utils.http import close_session
+
+USER_ID = 700201
+
+class ProviderStub:
+    """GET /v3/payments/{id} как у YooKassa и POST /v1/payment/info как у Heleket."""
+
+    def __init__(self):
+        self.yookassa: dict[str, dict] = {}
+        self.heleket: dict[str, str] = {}
+        self.requests: list[str] = []
+        self.fail_with: int | None = None
+
+    async def yookassa_payment(self, request: web.Request) -> web.Response:
+        self.requests.append(f"yookassa {request.match_info['payment_id']}")
+        if self.fail_with:
+            return web.json_response({"type": "error"}, status=self.fail_with)
+        payment = self.yookassa.get(request.match_info["payment_id"])
+        if not payment:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response({"id": request.match_info["payment_id"], **payment})
+
+    async def heleket_info(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        order_id = json_codec.loads(body)["order_id"]
+        self.requests.append(f"heleket {order_id}")
+        if request.headers.get("sign") != heleket_api.sign_body(body, "stub-key"):
+            return web.json_response({"state": 1, "message": "bad sign"}, status=401)
+        if self.fail_with:
+            return web.json_response({"state": 1}, status=self.fail_with)
+        status = self.heleket.get(order_id)
+        if status is None:
+            return web.json_response({"state": 1, "message": "not found"}, status=404)
+        return web.json_response({"state": 0, "result": {"uuid": f"hk-{order_id}", "order_id": order_id, "payment_status": status}})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/v3/payments/{payment_id}", self.yookassa_payment)
+        app.router.add_post("/v1/payment/info", self.heleket_info)
+        return app
+
+@pytest.fixture
+def stub(monkeypatch):
+    monkeypatch.setattr(yookassa_api, "SHOP_ID", "stub-shop")
+    monkeypatch.setattr(yookassa_api, "SECRET_KEY", "stub-secret")
+    monkeypatch.setattr(heleket_api, "MERCHANT_ID", "stub-merchant")
+    monkeypatch.setattr(heleket_api, "API_KEY", "stub-key")
+    monkeypatch.setattr(yookassa_api, "API_URL", yookassa_api.API_URL)
+    monkeypatch.setattr(heleket_api, "API_URL", heleket_api.API_URL)
+    return ProviderStub()
+
+def _cycles(stub: ProviderStub, times: int = 1) -> list[dict]:
+    async def main():
+        server = TestServer(stub.app())
+        await server.start_server()
+        yookassa_api.API_URL = str(server.make_url("/v3"))
+        heleket_api.API_URL = str(server.make_url("/v1"))
+        try:
+            return [await payment_reconciler.run_reconcile_cycle() for _ in range(times)]
+        finally:
+            await close_session()
+            await server.close()
+    return asyncio.run(main())
+
+def _order(order_id: str, provider: str, payment_id: str | None = None, age: str = "-1 hour") -> str:
+    assert database.create_pending_order(order_id, {"user_id": USER_ID, "provider": provider, "plan_id": "buy_1_month",
+                                                    "action": "new", "key_id": 0, "months": 1, "price": 199.0})
+    if payment_id:
+        database.set_pending_order_payment_id(order_id, payment_id)
+    with sqlite3.connect(database.DB_FILE) as conn:
+        conn.execute("UPDATE pending_orders SET created_at = datetime('now', ?) WHERE order_id = ?", (age, order_id))
+    return order_id
+
+def _status(order_id: str) -> str:
+    return database.get_pending_order(order_id)["status"]
+
+def _queued() -> list[tuple]:
+    with sqlite3.connect(database.DB_FILE) as conn:
+        return conn.execute("SELECT provider, provider_payment_id FROM payments ORDER BY provider, provider_payment_id").fetchall()
+
+def test_yookassa_decisions(stub):
+    _order("paid", "yookassa", "yk-paid")
+    _order("canceled", "yookassa", "yk-canceled")
+    _order("waiting", "yookassa", "yk-waiting")
+    _order("captured-unpaid", "yookassa", "yk-unpaid")
+    stub.yookassa.update({
+        "yk-paid": {"status": "succeeded", "paid": True},
+        "yk-canceled": {"status": "canceled", "paid": False},
+        "yk-waiting": {"status": "pending", "paid": False},
+        "yk-unpaid": {"status": "succeeded", "paid": False},
+    })
+
+    first, second = _cycles(stub, 2)
+    assert first == {"checked": 4, "paid": 1, "canceled": 1, "expired": 0}
+    assert _queued() == [("yookassa", "yk-paid")]
+    assert [_status(o) for o in ("paid", "canceled", "waiting", "captured-unpaid")] == ["paid", "canceled", "pending", "pending"]
+    # Решённые заказы из сверки уходят, ожидающие проверяются снова
+    assert second == {"checked": 2, "paid": 0, "canceled": 0, "expired": 0}
+
+def test_heleket_decisions_use_signed_requests(stub):
+    for order_id, status in (("h-paid", "paid"), ("h-over", "paid_over"), ("h-cancel", "cancel"), ("h-check", "check")):
+        _order(order_id, "heleket")
+        stub.heleket[order_id] = status
+
+    assert _cycles(stub) == [{"checked": 4, "paid": 2, "canceled": 1, "expired": 0}]
+    assert _queued() == [("heleket", "hk-h-over"), ("heleket", "hk-h-paid")]
+    assert [_status(o) for o in ("h-paid", "h-over", "h-cancel", "h-check")] == ["paid", "paid", "canceled", "pending"]
+
+def test_late_webhook_after_reconcile_is_not_queued_twice(stub):
+    _order("paid", "yookassa", "yk-paid")
+    stub.yookassa["yk-paid"] = {"status": "succeeded", "paid": True}
+    _cycles(stub)
+    assert not fulfilment.enqueue("yookassa", "yk-paid", {"order_id": "paid"})
+    assert _queued() == [("yookassa", "yk-paid")]
+
+@pytest.mark.parametrize("status", [401, 500])
+def test_provider_errors_leave_orders_pending(stub, status):
+    stub.fail_with = status
+    _order("y1", "yookassa", "yk-1")
+    _order("h1", "heleket")
+
+    assert _cycles(stub) == [{"checked": 2, "paid": 0, "canceled": 0, "expired": 0}]
+    assert _status("y1") == _status("h1") == "pending"
+    assert _queued() == []
+
+def test_order_selection(stub):
+    _order("fresh", "yookassa", "yk-fresh", age="-1 minute")
+    _order("abandoned", "yookassa", "yk-old", age="-3 days")
+    _order("no-invoice", "yookassa")
+    _order("stars", "stars", age="-1 hour")
+
+    assert _cycles(stub) == [{"checked": 1, "paid": 0, "canceled": 0, "expired": 1}]
+    # Заказ без счёта YooKassa не запрашивается, свежий и чужие — не выбираются
+    assert stub.requests == []
+    assert [_status(o) for o in ("fresh", "abandoned", "no-invoice", "stars")] == ["pending", "expired", "pending", "pending"]
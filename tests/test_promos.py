@@ -0,0 +1,120 @@
+import asyncio
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+from shop_bot.bot import handlers, keyboards, outbound
+from shop_bot.bot.callbacks import PromosPage, PromoToggle
+from shop_bot.data_manager import database
+
+ADMIN_ID = 700401
+LONG_CODE = "SPRING-2026-" + "X" * 60
+
+class FakeCallback:
+    def __init__(self, user_id: int = ADMIN_ID):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=user_id), message_id=1)
+        self.answers: list[str] = []
+
+    async def answer(self, text: str = None, show_alert: bool = False, **kwargs):
+        self.answers.append(text)
+
+@pytest.fixture
+def screens(monkeypatch):
+    """Экраны, которые обработчики показали бы админу: (текст, клавиатура)."""
+    monkeypatch.setattr(handlers, "ADMIN_ID", str(ADMIN_ID))
+    shown = []
+
+    async def edit_text(message, text, reply_markup=None, **kwargs):
+        shown.append((text, reply_markup))
+        return True
+
+    monkeypatch.setattr(outbound, "edit_text", edit_text)
+    return shown
+
+def _buttons(markup) -> list[str]:
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+def _rowid(code: str) -> int:
+    with sqlite3.connect(database.DB_FILE) as conn:
+        return conn.execute("SELECT rowid FROM promo_codes WHERE code = ?", (code,)).fetchone()[0]
+
+@pytest.mark.parametrize("code", ["A:B:C", LONG_CODE])
+def test_toggle_button_fits_any_code(code):
+    database.create_promo(code, 10, 0, 0)
+    promo_id = _rowid(code)
+
+    data = _buttons(keyboards.create_admin_promo_toggle_keyboard(promo_id, True))[0]
+    assert len(data.encode()) <= 64
+    assert PromoToggle.unpack(data).promo_id == promo_id
+    assert database.get_promo_by_id(promo_id)["code"] == code
+
+def test_toggle_handler_flips_promo(screens):
+    database.create_promo("SPRING", 10, 0, 0)
+    promo_id = _rowid("SPRING")
+
+    callback = FakeCallback()
+    asyncio.run(handlers.admin_promo_toggle(callback, PromoToggle(promo_id=promo_id)))
+    assert database.get_promo("SPRING") is None
+    asyncio.run(handlers.admin_promo_toggle(callback, PromoToggle(promo_id=promo_id)))
+    assert database.get_promo("SPRING")["active"]
+    asyncio.run(handlers.admin_promo_toggle(callback, PromoToggle(promo_id=promo_id + 100)))
+    assert callback.answers == ["Выключено", "Включено", "Нет такого кода"]
+
+def test_toggle_handler_requires_admin(screens):
+    database.create_promo("SPRING", 10, 0, 0)
+    callback = FakeCallback(user_id=1)
+    asyncio.run(handlers.admin_promo_toggle(callback, PromoToggle(promo_id=_rowid("SPRING"))))
+    assert callback.answers == ["Нет доступа"]
+    assert database.get_promo("SPRING")["active"]
+
+def _page(callback: FakeCallback, screens: list, data: PromosPage = None) -> tuple[list[str], dict]:
+    """Показывает страницу списка; возвращает коды на ней и навигацию {'back'/'next': PromosPage}."""
+    if data is None:
+        asyncio.run(handlers.admin_promo_list(callback))
+    else:
+        asyncio.run(handlers.admin_promos_page(callback, data))
+    text, markup = screens[-1]
+    nav = {}
+    for packed in _buttons(markup):
+        assert len(packed.encode()) <= 64
+        if packed.startswith(PromosPage.__prefix__):
+            page = PromosPage.unpack(packed)
+            nav["back" if page.back else "next"] = page
+    return text.split("\n")[1:], nav
+
+def test_promo_list_pages_through_codes_with_colons(screens, monkeypatch):
+    monkeypatch.setattr(handlers, "PROMOS_PAGE_SIZE", 4)
+    codes = [f"BATCH:{i:02d}" for i in range(9)] + [LONG_CODE]
+    for code in codes:
+        database.create_promo(code, 10, 0, 0)
+
+    callback = FakeCallback()
+    seen, pages = [], []
+    lines, nav = _page(callback, screens)
+    while True:
+        pages.append(lines)
+        seen += [line.split(": ")[0] for line in lines]  # "<код>: 10% / ..."
+        if "next" not in nav:
+            break
+        lines, nav = _page(callback, screens, nav["next"])
+
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert seen == codes
+    # Назад с последней страницы — снова вторая
+    lines, nav = _page(callback, screens, nav["back"])
+    assert lines == pages[1]
+    assert set(nav) == {"back", "next"}
+    lines, nav = _page(callback, screens, nav["back"])
+    assert lines == pages[0] and set(nav) == {"next"}
+
+def test_promos_page_keyset():
+    for code in ("B", "A", "C"):
+        database.create_promo(code, 10, 0, 0)
+    first, more = database.get_promos_page(limit=2)
+    assert [p["code"] for p in first] == ["B", "A"] and more
+    rest, more = database.get_promos_page(first[-1]["id"], limit=2)
+    assert [p["code"] for p in rest] == ["C"] and not more
+    back, more = database.get_promos_page(rest[0]["id"], limit=2, backward=True)
+    assert back == first and not more
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from shop_bot.data_manager import database, panel_events, scheduler
+
+class _Stop(Exception):
+    pass
+
+def _run_monitor(monkeypatch, iterations: int, clock: list[float]) -> list[bool]:
+    """Прогоняет iterations проходов монитора; возвращает auto_renew_only каждого прохода."""
+    passes = []
+    sleeps = []
+
+    async def fake_cycle(bot, session, auto_renew_only=False):
+        passes.append(auto_renew_only)
+        return 0, 0, 0
+
+    async def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+        if len(sleeps) >= iterations:
+            raise _Stop
+
+    monkeypatch.setattr(scheduler, "run_monitor_cycle", fake_cycle)
+    monkeypatch.setattr(scheduler.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(scheduler.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(scheduler, "get_session", lambda: None)
+    monkeypatch.delenv("ADMIN_TELEGRAM_ID", raising=False)
+
+    with pytest.raises(_Stop):
+        asyncio.run(scheduler.start_subscription_monitor(None))
+    assert set(sleeps) == {scheduler.CHECK_INTERVAL_SECONDS}
+    return passes
+
+def test_without_webhooks_every_pass_polls_the_panel(monkeypatch):
+    monkeypatch.setattr(panel_events, "WEBHOOK_SECRET", None)
+    assert _run_monitor(monkeypatch, 3, [1000.0]) == [False, False, False]
+
+def test_with_webhooks_full_poll_runs_once_per_reconcile_interval(monkeypatch):
+    monkeypatch.setattr(panel_events, "WEBHOOK_SECRET", "panel-secret")
+    monkeypatch.setattr(scheduler, "RECONCILE_INTERVAL_SECONDS", 3 * scheduler.CHECK_INTERVAL_SECONDS)
+    # Между сверками проходы остаются каждые CHECK_INTERVAL_SECONDS, но только по автопродлению
+    assert _run_monitor(monkeypatch, 7, [1000.0]) == [False, True, True, False, True, True, False]
+
+def test_auto_renew_only_selects_users_with_auto_renew():
+    for telegram_id, auto_renew in ((1, True), (2, False)):
+        database.register_user_if_not_exists(telegram_id, f"user{telegram_id}")
+        database.set_auto_renew(telegram_id, auto_renew)
+        database.add_new_key(telegram_id, f"uuid-{telegram_id}", f"user{telegram_id}-key1@kitsura.fun", 0)
+    assert [u["user_id"] for u in database.get_all_vpn_users(auto_renew_only=True)] == [1]
+    assert sorted(u["user_id"] for u in database.get_all_vpn_users()) == [1, 2]
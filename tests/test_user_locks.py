@@ -0,0 +1,97 @@
+import asyncio
+import contextlib
+import gc
+from datetime import datetime
+
+import pytest
+
+from shop_bot.modules import panel_stub, remnawave_api
+from shop_bot.utils.http import close_session
+from shop_bot.utils.locks import KeyedLock
+
+pytestmark = pytest.mark.usefixtures("panel_config")
+
+GB = 1024 ** 3
+EXTENSIONS = 120
+PACKS = 40
+
+def _days(user: dict, before: str) -> float:
+    parse = lambda v: datetime.fromisoformat(v.replace('Z', '+00:00'))
+    return (parse(user["expireAt"]) - parse(before)).total_seconds() / 86400
+
+def test_keyed_lock_is_per_key_and_released():
+    locks = KeyedLock()
+
+    async def scenario():
+        running = {1: 0, 2: 0}
+        peak = {1: 0, 2: 0}
+        overlap = []
+
+        async def hold(key):
+            async with locks(key):
+                running[key] += 1
+                peak[key] = max(peak[key], running[key])
+                overlap.append(running[1] and running[2])
+                await asyncio.sleep(0.001)
+                running[key] -= 1
+
+        assert locks(1) is locks(1) and locks(1) is not locks(2)
+        await asyncio.gather(*(hold(key) for key in (1, 2) * 20))
+        return peak, any(overlap)
+
+    peak, keys_overlapped = asyncio.run(scenario())
+    assert peak == {1: 1, 2: 1}
+    assert keys_overlapped
+    gc.collect()
+    assert len(locks) == 0
+
+def _stress(stub: panel_stub.PanelStub, extensions: dict[str, int], packs: dict[str, int]):
+    """Одновременно запускает продления на 1 день и пакеты по 1 ГБ: {telegram_id: сколько}."""
+    async def scenario():
+        await stub.start()
+        remnawave_api.BASE_URL = stub.base_url
+        try:
+            ops = []
+            for telegram_id, count in extensions.items():
+                email = stub.users[stub.by_telegram_id[int(telegram_id)]]["email"]
+                ops += [remnawave_api.provision_key(email, days=1, telegram_id=telegram_id) for _ in range(count)]
+            for telegram_id, count in packs.items():
+                email = stub.users[stub.by_telegram_id[int(telegram_id)]]["email"]
+                ops += [remnawave_api.add_extra_traffic(email, 1, telegram_id=telegram_id) for _ in range(count)]
+            return await asyncio.gather(*ops)
+        finally:
+            await close_session()
+            await stub.stop()
+    return asyncio.run(scenario())
+
+def test_concurrent_extensions_and_packs_all_apply():
+    stub = panel_stub.PanelStub(latency=0.002, jitter=0.003, seed=1)
+    # seed_users возвращает сами записи заглушки, после нагрузки в них итоговое состояние
+    mixed, extended, packed = stub.seed_users(3, first_telegram_id=910000)
+    before = {u["uuid"]: (u["expireAt"], u["trafficLimitBytes"]) for u in (mixed, extended, packed)}
+    ids = {name: str(u["telegramId"]) for name, u in (("mixed", mixed), ("extended", extended), ("packed", packed))}
+
+    results = _stress(stub, {ids["mixed"]: EXTENSIONS, ids["extended"]: EXTENSIONS},
+                      {ids["mixed"]: PACKS, ids["packed"]: PACKS})
+
+    assert all(results)
+    # Пакет трафика переписывает expireAt прочитанным значением: без замка он затирал бы продления
+    for user in (mixed, extended):
+        assert round(_days(user, before[user["uuid"]][0])) == EXTENSIONS
+    assert packed["trafficLimitBytes"] == before[packed["uuid"]][1] + PACKS * GB
+    assert packed["expireAt"] == before[packed["uuid"]][0]
+    assert len(stub.users) == 3
+    gc.collect()
+    assert len(remnawave_api.user_locks) == 0
+
+def test_without_user_locks_updates_are_lost(monkeypatch):
+    # Проверка самого теста: без замков та же нагрузка теряет обновления
+    monkeypatch.setattr(remnawave_api, "user_locks", lambda key: contextlib.nullcontext())
+    stub = panel_stub.PanelStub(latency=0.002, jitter=0.003, seed=1)
+    extended, packed = stub.seed_users(2, first_telegram_id=920000)
+    expire_at, limit = extended["expireAt"], packed["trafficLimitBytes"]  # заглушка меняет эти словари на месте
+
+    _stress(stub, {str(extended["telegramId"]): EXTENSIONS}, {str(packed["telegramId"]): PACKS})
+
+    assert 0 < round(_days(extended, expire_at)) < EXTENSIONS
+    assert limit < packed["trafficLimitBytes"] < limit + PACKS * GB
@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher
+from aiohttp.test_utils import TestClient, TestServer
+
+from shop_bot.data_manager import database, fulfilment
+from shop_bot.webhook_server.app import create_webhook_app, register_telegram_webhook
+
+USER_ID = 700301
+
+def _order(order_id: str, provider: str) -> str:
+    assert database.create_pending_order(order_id, {"user_id": USER_ID, "provider": provider, "plan_id": "buy_1_month",
+                                                    "action": "new", "key_id": 0, "months": 1, "price": 199.0})
+    return order_id
+
+def _yookassa(payment_id: str, order_id: str, event: str = "payment.succeeded") -> dict:
+    return {"type": "notification", "event": event,
+            "object": {"id": payment_id, "status": "succeeded", "paid": True, "metadata": {"order_id": order_id}}}
+
+def _serve(app, scenario):
+    async def main():
+        async with TestClient(TestServer(app)) as client:
+            return await scenario(client)
+    return asyncio.run(main())
+
+def test_payment_routes_enqueue_known_orders():
+    _order("ord-yk", "yookassa")
+    _order("ord-hk", "heleket")
+
+    async def scenario(client):
+        responses = [
+            await client.post("/yookassa-webhook", json=_yookassa("yk-1", "ord-yk")),
+            await client.post("/yookassa-webhook", json=_yookassa("yk-1", "ord-yk")),
+            await client.post("/yookassa-webhook", json=_yookassa("yk-2", "ord-yk", event="payment.waiting_for_capture")),
+            await client.post("/yookassa-webhook", json=_yookassa("yk-3", "forged")),
+            await client.post("/crypto-webhook", json={"status": "paid", "uuid": "hk-1", "order_id": "ord-hk"}),
+            await client.post("/crypto-webhook", json={"status": "check", "uuid": "hk-2", "order_id": "ord-hk"}),
+            await client.get("/cryptobot-webhook", params={"status": "paid", "invoice_id": "cb-1", "user_id": str(USER_ID)}),
+        ]
+        return [r.status for r in responses]
+
+    assert _serve(create_webhook_app(None, fulfilment.enqueue), scenario) == [200] * 7
+    assert database.get_payment("yookassa", "yk-1")["status"] == "received"
+    assert database.get_payment("heleket", "hk-1") is not None
+    for provider, payment_id in (("yookassa", "yk-2"), ("yookassa", "yk-3"), ("heleket", "hk-2"), ("cryptobot", "cb-1")):
+        assert database.get_payment(provider, payment_id) is None
+    assert database.get_pending_order("ord-yk")["status"] == "paid"
+
+def test_unreadable_body_and_queue_failure_return_500():
+    def unavailable(provider, payment_id, metadata):
+        raise RuntimeError("Payment queue unavailable")
+
+    async def scenario(client):
+        broken = await client.post("/yookassa-webhook", data=b"{not json")
+        failed = await client.post("/yookassa-webhook", json=_yookassa("yk-1", "ord-yk"))
+        return broken.status, failed.status
+
+    # 500 — провайдер повторит доставку
+    assert _serve(create_webhook_app(None, unavailable), scenario) == (500, 500)
+
+def test_slow_queue_writes_do_not_block_the_loop():
+    """Запись в очередь идёт в пуле потоков: цикл событий остаётся отзывчивым."""
+    WRITE_SECONDS = 0.05
+    calls = []
+
+    def slow_enqueue(provider, payment_id, metadata):
+        time.sleep(WRITE_SECONDS)  # как запись SQLite под _enqueue_lock
+        calls.append(payment_id)
+        return True
+
+    async def scenario(client):
+        lag = 0.0
+        stop = asyncio.Event()
+
+        async def probe():
+            nonlocal lag
+            while not stop.is_set():
+                started = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lag = max(lag, time.perf_counter() - started - 0.005)
+
+        prober = asyncio.create_task(probe())
+        started = time.perf_counter()
+        responses = await asyncio.gather(*(client.post("/yookassa-webhook", json=_yookassa(f"yk-{i}", "ord")) for i in range(32)))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await prober
+        return [r.status for r in responses], lag, elapsed
+
+    statuses, lag, elapsed = _serve(create_webhook_app(None, slow_enqueue), scenario)
+    assert statuses == [200] * 32 and len(calls) == 32
+    # В цикле 32 записи заняли бы 1.6 с и задержали бы пробу на WRITE_SECONDS каждая
+    assert lag < WRITE_SECONDS
+    assert elapsed < 32 * WRITE_SECONDS
+
+def test_telegram_route_requires_secret_token():
+    bot = Bot("42:TEST")
+    dispatcher = Dispatcher()
+    received = []
+
+    @dispatcher.message()
+    async def record(message):
+        received.append(message.text)
+
+    app = create_webhook_app(bot, fulfilment.enqueue)
+    register_telegram_webhook(app, dispatcher, bot, "/telegram", "s3cret")
+    update = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": USER_ID, "type": "private"},
+                                          "from": {"id": USER_ID, "is_bot": False, "first_name": "T"}, "text": "/start"}}
+
+    async def scenario(client):
+        forged = await client.post("/telegram", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        accepted = await client.post("/telegram", json=update, headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"})
+        for _ in range(20):
+            if received:
+                break
+            await asyncio.sleep(0.01)
+        return forged.status, accepted.status
+
+    assert _serve(app, scenario) == (401, 200)
+    assert received == ["/start"]
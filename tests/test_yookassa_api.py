@@ -0,0 +1,191 @@
+import asyncio
+import base64
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from shop_bot.modules import yookassa_api
+from shop_bot.utils import json_codec
+
+PAYLOAD = {
+    "amount": {"value": "199.00", "currency": "RUB"},
+    "capture": True,
+    "confirmation": {"type": "redirect", "return_url": "https://t.me/bot"},
+    "description": "VPN 1 мес.",
+    "metadata": {"order_id": "ord-1"},
+}
+
+class YooKassaStub:
+    """Минимальный /v3/payments: запоминает запросы, отвечает как API YooKassa."""
+
+    def __init__(self):
+        self.requests: list[dict] = []
+        self.payments: dict[str, dict] = {}
+        self.by_idempotence_key: dict[str, str] = {}
+        self.fail_with: int | None = None
+        self.raw_body: bytes | None = None
+        self.latency = 0.0
+
+    async def create(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = json_codec.loads(await request.read())
+        self.requests.append({"method": "POST", "headers": dict(request.headers), "body": body})
+        if self.fail_with:
+            return web.json_response({"type": "error", "code": "invalid_request"}, status=self.fail_with)
+        if self.raw_body is not None:
+            return web.Response(body=self.raw_body, content_type="application/json")
+        key = request.headers["Idempotence-Key"]
+        if key not in self.by_idempotence_key:
+            payment_id = f"2d{len(self.payments):06d}-000f-5000-8000-18db351245c7"
+            self.payments[payment_id] = {
+                "id": payment_id, "status": "pending", "paid": False,
+                "amount": body["amount"], "metadata": body.get("metadata", {}),
+                "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}"},
+            }
+            self.by_idempotence_key[key] = payment_id
+        return web.json_response(self.payments[self.by_idempotence_key[key]])
+
+    async def get(self, request: web.Request) -> web.Response:
+        self.requests.append({"method": "GET", "headers": dict(request.headers), "path": request.path})
+        payment = self.payments.get(request.match_info["payment_id"])
+        if not payment:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        return web.json_response(payment)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v3/payments", self.create)
+        app.router.add_get("/v3/payments/{payment_id}", self.get)
+        return app
+
+@pytest.fixture
+def stub(monkeypatch):
+    stub = YooKassaStub()
+    monkeypatch.setattr(yookassa_api, "SHOP_ID", "123456")
+    monkeypatch.setattr(yookassa_api, "SECRET_KEY", "test_secret")
+    return stub
+
+def _serve(stub: YooKassaStub, scenario):
+    """Выполняет scenario(session) против заглушки на локальном порту."""
+    async def main():
+        server = TestServer(stub.app())
+        await server.start_server()
+        yookassa_api.API_URL = str(server.make_url("/v3"))
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await scenario(session)
+        finally:
+            await server.close()
+    return asyncio.run(main())
+
+@pytest.fixture(autouse=True)
+def restore_api_url():
+    saved = yookassa_api.API_URL
+    yield
+    yookassa_api.API_URL = saved
+
+def test_create_payment_request_and_parse(stub):
+    payment = _serve(stub, lambda session: yookassa_api.create_payment(PAYLOAD, "ord-1", session=session))
+
+    request = stub.requests[0]
+    assert request["body"] == PAYLOAD
+    assert request["headers"]["Idempotence-Key"] == "ord-1"
+    expected_auth = base64.b64encode(b"123456:test_secret").decode()
+    assert request["headers"]["Authorization"] == f"Basic {expected_auth}"
+    assert payment["status"] == "pending"
+    assert payment["metadata"] == {"order_id": "ord-1"}
+    assert yookassa_api.confirmation_url(payment).startswith("https://yoomoney.ru/checkout/")
+
+def test_same_idempotence_key_returns_same_payment(stub):
+    async def scenario(session):
+        first = await yookassa_api.create_payment(PAYLOAD, "ord-1", session=session)
+        again = await yookassa_api.create_payment(PAYLOAD, "ord-1", session=session)
+        other = await yookassa_api.create_payment(PAYLOAD, "ord-2", session=session)
+        return first, again, other
+
+    first, again, other = _serve(stub, scenario)
+    assert first["id"] == again["id"] != other["id"]
+    assert len(stub.payments) == 2
+
+def test_random_idempotence_key_when_not_given(stub):
+    async def scenario(session):
+        await yookassa_api.create_payment(PAYLOAD, session=session)
+        await yookassa_api.create_payment(PAYLOAD, session=session)
+
+    _serve(stub, scenario)
+    keys = [r["headers"]["Idempotence-Key"] for r in stub.requests]
+    assert len(set(keys)) == 2 and all(keys)
+
+def test_get_payment(stub):
+    async def scenario(session):
+        created = await yookassa_api.create_payment(PAYLOAD, "ord-1", session=session)
+        stub.payments[created["id"]].update(status="succeeded", paid=True)
+        return created, await yookassa_api.get_payment(created["id"], session=session), await yookassa_api.get_payment("missing", session=session)
+
+    created, fetched, missing = _serve(stub, scenario)
+    assert fetched["id"] == created["id"]
+    assert fetched["status"] == "succeeded" and fetched["paid"] is True
+    assert missing is None
+    assert stub.requests[-1]["path"] == "/v3/payments/missing"
+
+@pytest.mark.parametrize("status", [400, 401, 500])
+def test_error_status_returns_none(stub, status):
+    stub.fail_with = status
+    assert _serve(stub, lambda session: yookassa_api.create_payment(PAYLOAD, "ord-1", session=session)) is None
+    assert len(stub.requests) == 1
+
+def test_unparseable_body_returns_none(stub):
+    stub.raw_body = b"<html>gateway timeout</html>"
+    payment = _serve(stub, lambda session: yookassa_api.create_payment(PAYLOAD, "ord-1", session=session))
+    assert payment is None
+    assert yookassa_api.confirmation_url(payment) is None
+
+def test_unreachable_api_returns_none(stub):
+    async def scenario(session):
+        yookassa_api.API_URL = "http://127.0.0.1:9/v3"
+        return await yookassa_api.create_payment(PAYLOAD, "ord-1", session=session)
+
+    assert _serve(stub, scenario) is None
+
+def test_missing_credentials_skip_request(stub, monkeypatch):
+    monkeypatch.setattr(yookassa_api, "SECRET_KEY", None)
+    assert _serve(stub, lambda session: yookassa_api.create_payment(PAYLOAD, "ord-1", session=session)) is None
+    assert stub.requests == []
+
+def test_concurrent_invoice_creation_keeps_loop_responsive(stub):
+    INVOICES, LATENCY, PROBE_INTERVAL = 100, 0.2, 0.01
+    stub.latency = LATENCY
+
+    async def scenario(session):
+        loop = asyncio.get_running_loop()
+        lag = []
+        stop = asyncio.Event()
+
+        async def probe():
+            while not stop.is_set():
+                started = loop.time()
+                await asyncio.sleep(PROBE_INTERVAL)
+                lag.append(loop.time() - started - PROBE_INTERVAL)
+
+        prober = asyncio.create_task(probe())
+        started = loop.time()
+        payments = await asyncio.gather(*(yookassa_api.create_payment(PAYLOAD, f"ord-{i}", session=session) for i in range(INVOICES)))
+        elapsed = loop.time() - started
+        stop.set()
+        await prober
+        return payments, max(lag), elapsed
+
+    payments, max_lag, elapsed = _serve(stub, scenario)
+    assert all(yookassa_api.confirmation_url(p) for p in payments)
+    assert len(stub.payments) == INVOICES
+    # Запросы ждут API параллельно, а цикл всё это время обслуживает другие задачи
+    assert elapsed < INVOICES * LATENCY / 10
+    assert max_lag < 0.1
+
+def test_confirmation_url_parsing():
+    assert yookassa_api.confirmation_url(None) is None
+    assert yookassa_api.confirmation_url({"id": "p1"}) is None
+    assert yookassa_api.confirmation_url({"confirmation": {"confirmation_url": "https://pay"}}) == "https://pay"